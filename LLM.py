@@ -1,37 +1,205 @@
+import json
 import os
-import requests
+from typing import Any, Dict, Iterator, List
 
-OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+import metrics
+import net
+from cache import LRUCache, SingleFlight, SQLiteCache, TieredCache, cache_key
+from llm_pool import Endpoint, EndpointPool
+
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
 MODEL_NAME = "meta-llama/llama-3-8b-instruct" 
 
-def call_llama(prompt: str, max_tokens: int = 300, temperature: float = 0.3) -> str:
+# LLM_CACHE_DB enables the on-disk tier (e.g. "state/llm_cache.sqlite")
+_CACHE = TieredCache(
+    LRUCache(
+        max_entries=int(os.getenv("LLM_CACHE_SIZE", "256")),
+        max_bytes=int(os.getenv("LLM_CACHE_BYTES", str(8 * 1024 * 1024))),
+    ),
+    SQLiteCache(os.environ["LLM_CACHE_DB"], ttl=float(os.getenv("LLM_CACHE_TTL", "86400"))) if os.getenv("LLM_CACHE_DB") else None,
+)
+
+# identical prompts already in flight share one upstream call
+_INFLIGHT = SingleFlight()
+
+# LLM_ENDPOINTS="model-a,model-b@http://host/v1/chat/completions" adds alternates that
+# slow calls are hedged to and failing ones fail over to (see llm_pool.py)
+ENDPOINTS = EndpointPool.from_env(MODEL_NAME)
+
+LLM_TOKENS = metrics.counter("llm_tokens_total", "Tokens billed by OpenRouter (usage field), by kind.")
+metrics.gauges("llm_cache", "LLM response cache counters (hits, misses, coalesced calls, entries).", "stat", lambda: cache_stats())
+metrics.gauges("llm_endpoints", "LLM endpoint latency quantiles and breaker state.", "stat", lambda: ENDPOINTS.stats())
+
+
+def cache_stats() -> Dict[str, int]:
+    out = _CACHE.stats()
+    out["coalesced"] = _INFLIGHT.coalesced
+    return out
+
+
+def _messages(prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": "You are a helpful assistant that summarizes and plans from short documents."},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def _headers() -> Dict[str, str]:
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if not api_key:
+        raise RuntimeError("OPENROUTER_API_KEY not set in environment")
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+
+
+def call_llama(prompt: str, max_tokens: int = 300, temperature: float = 0.3, use_cache: bool = True) -> str:
     """
     Call a chat-style LLM (Llama 8B via OpenRouter) and return the assistant text.
     Expects OPENROUTER_API_KEY in env.
     Raises requests.HTTPError on non-200 responses.
+    Identical requests (model, messages, max_tokens, temperature) are answered from
+    the response cache, or share the call already in flight, unless use_cache=False.
+    With several ENDPOINTS the call is hedged/failed over between them.
     """
-    api_key = os.getenv("OPENROUTER_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENROUTER_API_KEY not set in environment")
+    headers = _headers()
+    payload: Dict[str, Any] = {
+        "model": ENDPOINTS.endpoints[0].model,
+        "messages": _messages(prompt),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
+    key = cache_key(payload["model"], payload["messages"], max_tokens, temperature)
+    if use_cache:
+        cached = _CACHE.get(key)
+        if cached is not None:
+            return cached
+
+    def attempt(ep: Endpoint) -> str:
+        resp = net.request("openrouter", "POST", ep.url or OPENROUTER_URL, headers=headers,
+                           json=dict(payload, model=ep.model), retries=_retries())
+        resp.raise_for_status()
+        data = resp.json()
+        _record_usage(data)
+        return _extract_text(data)
+
+    def fetch() -> str:
+        text = ENDPOINTS.call(attempt)
+        if use_cache:
+            _CACHE.set(key, text)
+        return text
+
+    return _INFLIGHT.do(key, fetch) if use_cache else fetch()
+
+
+def call_llama_stream(prompt: str, max_tokens: int = 300, temperature: float = 0.3, use_cache: bool = True) -> Iterator[str]:
+    """
+    Streaming variant of call_llama: yields text deltas from OpenRouter's SSE stream
+    as they arrive. A cache hit is yielded as one chunk; a completed stream is cached.
+    Streams fail over between ENDPOINTS until one answers, but are not hedged.
+    """
+    headers = _headers()
+    payload: Dict[str, Any] = {
+        "model": ENDPOINTS.endpoints[0].model,
+        "messages": _messages(prompt),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stream": True,
+        "usage": {"include": True},
     }
 
-    payload = {
-        "model": MODEL_NAME,
-        "messages": [
-            {"role": "system", "content": "You are a helpful assistant that summarizes and plans from short documents."},
-            {"role": "user", "content": prompt},
-        ],
+    key = cache_key(payload["model"], payload["messages"], max_tokens, temperature)
+    if use_cache:
+        cached = _CACHE.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    def open_stream(ep: Endpoint):
+        resp = net.request("openrouter", "POST", ep.url or OPENROUTER_URL, headers=headers,
+                           json=dict(payload, model=ep.model), stream=True, retries=_retries())
+        try:
+            resp.raise_for_status()
+        except Exception:
+            resp.close()
+            raise
+        return resp
+
+    resp = ENDPOINTS.first(open_stream)
+    with resp:
+        parts: List[str] = []
+        for line in resp.iter_lines(decode_unicode=False):
+            # SSE: "data: {...}" events, ": comment" keep-alives, "data: [DONE]" terminator
+            if not line or not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            if "error" in chunk:
+                raise RuntimeError("LLM stream error: %s" % (chunk["error"],))
+            _record_usage(chunk)
+            for choice in chunk.get("choices") or []:
+                delta = (choice.get("delta") or {}).get("content") or choice.get("text") or ""
+                if delta:
+                    parts.append(delta)
+                    yield delta
+    if use_cache and parts:
+        _CACHE.set(key, "".join(parts))
+
+
+async def acall_llama(prompt: str, max_tokens: int = 300, temperature: float = 0.3, use_cache: bool = True) -> str:
+    """
+    Async call_llama on a pooled httpx client; shares the response cache and
+    hedges between ENDPOINTS like call_llama.
+    """
+    headers = _headers()
+    payload: Dict[str, Any] = {
+        "model": ENDPOINTS.endpoints[0].model,
+        "messages": _messages(prompt),
         "max_tokens": max_tokens,
         "temperature": temperature,
     }
 
-    resp = requests.post(OPENROUTER_URL, headers=headers, json=payload, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
+    key = cache_key(payload["model"], payload["messages"], max_tokens, temperature)
+    if use_cache:
+        cached = _CACHE.get(key)
+        if cached is not None:
+            return cached
+
+    async def attempt(ep: Endpoint) -> str:
+        resp = await net.arequest("openrouter", "POST", ep.url or OPENROUTER_URL, headers=headers,
+                                  json=dict(payload, model=ep.model), retries=_retries())
+        resp.raise_for_status()
+        data = resp.json()
+        _record_usage(data)
+        return _extract_text(data)
+
+    text = await ENDPOINTS.acall(attempt)
+    if use_cache:
+        _CACHE.set(key, text)
+    return text
+
+
+def _retries():
+    # with alternates, a failing endpoint is left to the pool's failover instead of
+    # being retried in place
+    return 0 if ENDPOINTS.failover else None
+
+
+def _record_usage(data: dict):
+    usage = data.get("usage") or {}
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if isinstance(usage.get(kind), (int, float)):
+            LLM_TOKENS.inc(usage[kind], kind=kind[:-len("_tokens")], model=str(data.get("model") or MODEL_NAME))
+
+
+def _extract_text(data: dict) -> str:
     try:
         return data["choices"][0]["message"]["content"]
     except Exception:
@@ -1,12 +1,68 @@
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, send_file, Response
-from graph import ResearchGraph
-from datetime import datetime
-from io import BytesIO
+from flask import Flask, request, jsonify, render_template_string, redirect, url_for, send_file, Response, stream_with_context, g
+from engine import node_trace
+from export import PdfExporter, pdf_unavailable
+from graph import BATCH_WORKERS, ResearchGraph, wants_plan
+from jobs import JOB_WAIT_MAX, JobQueue, QueueFull
+import base64
+import gzip
 import json
 import os
+import time
+
+import metrics
+from cache import cache_key
 
 app = Flask(__name__)
 G = ResearchGraph()
+EXPORTS = PdfExporter(G.store)
+
+HTTP_SECONDS = metrics.histogram("http_request_seconds", "Flask request handling time by endpoint (streaming bodies excluded).")
+HTTP_REQUESTS = metrics.counter("http_requests_total", "Requests by endpoint and status code.")
+
+HISTORY_PAGE = 20
+SHORT_QUERY_WORDS = 8  # questions this short (without plan keywords) are scheduled first
+HISTORY_MAX_PAGE = 200
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))
+_GZIP_TYPES = ('application/json', 'text/html', 'text/plain')
+
+
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def _count_request(response):
+    endpoint = request.endpoint or "unknown"
+    HTTP_REQUESTS.inc(endpoint=endpoint, status=str(response.status_code))
+    if hasattr(g, "started"):
+        HTTP_SECONDS.observe(time.perf_counter() - g.started, endpoint=endpoint)
+    return response
+
+
+@app.after_request
+def _gzip(response):
+    """
+    gzip buffered text/JSON bodies over GZIP_MIN_BYTES for clients that accept it.
+    Streams and files are left alone.
+    """
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in _GZIP_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 LOGIN = """
 <!doctype html>
@@ -49,7 +105,7 @@ LOGIN = """
       </form>
 
       <div class="muted">
-        This demo stores session history locally on the server (state.json) and ties entries to the name you enter.
+        This demo stores session history locally on the server (state/ folder) and ties entries to the name you enter.
       </div>
 
       <div class="center" style="margin-top:22px">
@@ -257,12 +313,19 @@ WORKSPACE = """
         localStorage.setItem('rga_lastq', q);
 
         try {
-          const res = await fetch('/api/run', {
-            method: 'POST',
-            headers: {'Content-Type':'application/json'},
-            body: JSON.stringify({ session_id: name, query: q, chat_mode: chatMode, user_name: name })
-          });
-          const j = await res.json();
+          const payload = JSON.stringify({ session_id: name, query: q, chat_mode: chatMode, user_name: name });
+          let j = null;
+          if (window.ReadableStream && window.TextDecoder) {
+            j = await runStream(payload);
+          } else {
+            const res = await fetch('/api/run', {
+              method: 'POST',
+              headers: {'Content-Type':'application/json'},
+              body: payload
+            });
+            j = await res.json();
+            renderDocs(j.docs);
+          }
           // convert markdown bold to HTML and insert as innerHTML
           document.getElementById('summary-box').innerHTML = mdToHtml(j.summary || 'No summary returned.');
           if (j.plan && j.plan.plan){
@@ -271,20 +334,6 @@ WORKSPACE = """
           } else {
             document.getElementById('plan-panel').style.display = 'none';
           }
-          if (j.docs && j.docs.length){
-            const dl = document.getElementById('docs-list'); dl.innerHTML = '';
-            j.docs.forEach(d=>{
-              const el = document.createElement('div'); el.className='doc-item';
-              const title = document.createElement('div'); title.className='doc-title';
-              if (d.url){ title.innerHTML = `<a href="${escapeHtml(d.url)}" target="_blank" style="color:inherit;text-decoration:none">${escapeHtml(d.title || d.id)}</a>`; }
-              else { title.textContent = d.title || d.id; }
-              const snip = document.createElement('div'); snip.className='doc-snippet'; snip.textContent = (d.text || '').slice(0,220);
-              el.appendChild(title); el.appendChild(snip); dl.appendChild(el);
-            });
-            document.getElementById('docs-panel').style.display = 'block';
-          } else {
-            document.getElementById('docs-panel').style.display = 'none';
-          }
           addRecentLocal(q);
           await refreshRecent();
           await showHistory();
@@ -294,6 +343,71 @@ WORKSPACE = """
         }
       }
 
+      // reads NDJSON events from /api/run/stream, rendering summary/plan tokens as they arrive
+      async function runStream(payload){
+        const res = await fetch('/api/run/stream', {
+          method: 'POST',
+          headers: {'Content-Type':'application/json'},
+          body: payload
+        });
+        if (!res.ok || !res.body) throw new Error('Request failed (' + res.status + ')');
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        const text = { summary: '', plan: '' };
+        let buf = '';
+        let result = null;
+        const handle = (ev) => {
+          if (ev.event === 'docs') {
+            renderDocs(ev.docs);
+          } else if (ev.event === 'token') {
+            text[ev.field] += ev.text;
+            if (ev.field === 'plan') {
+              document.getElementById('plan-box').innerHTML = mdToHtml(text.plan);
+              document.getElementById('plan-panel').style.display = 'block';
+            } else {
+              document.getElementById('summary-box').innerHTML = mdToHtml(text.summary);
+            }
+          } else if (ev.event === 'reset') {
+            text[ev.field] = '';
+          } else if (ev.event === 'done') {
+            result = ev.result;
+          } else if (ev.event === 'error') {
+            throw new Error(ev.error || 'Request failed');
+          }
+        };
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buf += decoder.decode(value, { stream: true });
+          let nl;
+          while ((nl = buf.indexOf('\\n')) >= 0) {
+            const line = buf.slice(0, nl);
+            buf = buf.slice(nl + 1);
+            if (line.trim()) handle(JSON.parse(line));
+          }
+        }
+        if (buf.trim()) handle(JSON.parse(buf));
+        if (!result) throw new Error('Stream ended early');
+        return result;
+      }
+
+      function renderDocs(docs){
+        if (docs && docs.length){
+          const dl = document.getElementById('docs-list'); dl.innerHTML = '';
+          docs.forEach(d=>{
+            const el = document.createElement('div'); el.className='doc-item';
+            const title = document.createElement('div'); title.className='doc-title';
+            if (d.url){ title.innerHTML = `<a href="${escapeHtml(d.url)}" target="_blank" style="color:inherit;text-decoration:none">${escapeHtml(d.title || d.id)}</a>`; }
+            else { title.textContent = d.title || d.id; }
+            const snip = document.createElement('div'); snip.className='doc-snippet'; snip.textContent = (d.text || '').slice(0,220);
+            el.appendChild(title); el.appendChild(snip); dl.appendChild(el);
+          });
+          document.getElementById('docs-panel').style.display = 'block';
+        } else {
+          document.getElementById('docs-panel').style.display = 'none';
+        }
+      }
+
       function escapeHtml(unsafe){ if (unsafe===null||unsafe===undefined) return ''; return String(unsafe).replaceAll('&','&amp;').replaceAll('<','&lt;').replaceAll('>','&gt;').replaceAll('"','&quot;'); }
 
       function addRecentLocal(q){
@@ -312,31 +426,17 @@ WORKSPACE = """
         container.innerHTML = '';
         if (!name) return;
         try {
-          const res = await fetch('/api/history?name=' + encodeURIComponent(name));
+          const res = await fetch('/api/history?limit=50&fields=query&name=' + encodeURIComponent(name));
           if (!res.ok) return;
-          const data = await res.json();
-          let items = [];
-          if (data && typeof data === 'object') {
-            Object.values(data).forEach(session => {
-              if (session && Array.isArray(session.history)) {
-                session.history.forEach(h => {
-                  if (h && h.query) items.push(h.query);
-                });
-              }
-            });
-          }
-          if (!items || items.length === 0) return;
+          const page = await res.json();
           const seen = new Set();
-          const unique = [];
-          for (let i = items.length - 1; i >= 0; i--){
-            const q = items[i];
-            if (!seen.has(q)){
-              seen.add(q);
-              unique.push(q);
+          const top = [];
+          (page.entries || []).forEach(h => {
+            if (h.query && !seen.has(h.query) && top.length < 10){
+              seen.add(h.query);
+              top.push(h.query);
             }
-          }
-          unique.reverse();
-          const top = unique.slice(0, 10);
+          });
           top.forEach(q => {
             const el = document.createElement('div');
             el.className = 'recent-item';
@@ -349,25 +449,80 @@ WORKSPACE = """
         }
       }
 
+      // history is fetched a page at a time, newest first; the next page loads when
+      // the end of the list scrolls into view
+      const HISTORY_PAGE = 20;
+      let historyGen = 0, historyCursor = null, historyLoading = false, historyObserver = null;
+
       async function showHistory(){
-        const name = NAME;
-        if (!name) return;
+        if (!NAME) return;
+        historyGen++;
+        historyCursor = null;
+        historyLoading = false;
+        document.getElementById('history-entries').innerHTML = '';
+        await loadHistoryPage();
+      }
+
+      async function loadHistoryPage(){
+        if (historyLoading) return;
+        historyLoading = true;
+        const gen = historyGen;
+        const first = !historyCursor;
+        const container = document.getElementById('history-entries');
         try {
-          const res = await fetch('/api/history?name=' + encodeURIComponent(name));
-          if (!res.ok){
-            document.getElementById('history-entries').innerHTML = '<div class="meta">No history found for this user.</div>';
-            return;
+          let url = '/api/history?name=' + encodeURIComponent(NAME) + '&limit=' + HISTORY_PAGE
+            + '&fields=timestamp,mode,query,summary&max_chars=1000';
+          if (historyCursor) url += '&before=' + encodeURIComponent(historyCursor);
+          const res = await fetch(url);
+          if (!res.ok) throw new Error('Request failed (' + res.status + ')');
+          const page = await res.json();
+          if (gen !== historyGen) return;
+          if (first && !page.entries.length){
+            container.innerHTML = '<div class="meta">No history found for this user.</div>';
           }
-          const data = await res.json();
-          renderHistory(data);
+          renderHistory(page.entries);
+          historyCursor = page.next_cursor;
         } catch (err){
-          document.getElementById('history-entries').innerHTML = '<div class="meta">Unable to load history.</div>';
+          if (gen === historyGen && first) container.innerHTML = '<div class="meta">Unable to load history.</div>';
+        } finally {
+          if (gen === historyGen){
+            historyLoading = false;
+            watchHistoryEnd();
+          }
         }
       }
-      function renderHistory(data){
-        const container = document.getElementById('history-entries'); container.innerHTML=''; const keys = Object.keys(data||{}); if(keys.length===0){ container.innerHTML='<div class="meta">No history found for this user.</div>'; return; }
-        keys.forEach(sid=>{ const session = data[sid]; const hdr = document.createElement('div'); hdr.className='meta'; hdr.textContent='Session: '+sid+' — '+(session.user && session.user.name ? session.user.name : ''); container.appendChild(hdr);
-          (session.history||[]).slice().reverse().forEach(entry=>{ const e=document.createElement('div'); e.className='history-entry'; const meta=document.createElement('div'); meta.className='meta'; meta.textContent=entry.timestamp + ' • ' + (entry.mode||''); const q=document.createElement('div'); q.style.fontWeight='700'; q.style.marginTop='6px'; q.textContent=entry.query; const summary=document.createElement('div'); summary.style.marginTop='8px'; summary.innerHTML = mdToHtml((entry.summary||'').slice(0,1000)); e.appendChild(meta); e.appendChild(q); e.appendChild(summary); container.appendChild(e); }); });
+
+      function watchHistoryEnd(){
+        let sentinel = document.getElementById('history-more');
+        if (!sentinel){
+          sentinel = document.createElement('div');
+          sentinel.id = 'history-more';
+          sentinel.className = 'meta';
+          document.getElementById('history-entries').after(sentinel);
+        }
+        sentinel.textContent = historyCursor ? 'Loading more…' : '';
+        if (!historyCursor) return;
+        if (!window.IntersectionObserver){
+          sentinel.textContent = 'Load more';
+          sentinel.style.cursor = 'pointer';
+          sentinel.onclick = loadHistoryPage;
+          return;
+        }
+        if (!historyObserver){
+          historyObserver = new IntersectionObserver(seen => {
+            if (historyCursor && seen.some(e => e.isIntersecting)) loadHistoryPage();
+          });
+          historyObserver.observe(sentinel);
+        }
+        // a short page can leave the sentinel in view, which fires no new intersection
+        if (sentinel.offsetParent !== null && sentinel.getBoundingClientRect().top < window.innerHeight) {
+          setTimeout(loadHistoryPage, 0);
+        }
+      }
+
+      function renderHistory(entries){
+        const container = document.getElementById('history-entries');
+        (entries || []).forEach(entry=>{ const e=document.createElement('div'); e.className='history-entry'; const meta=document.createElement('div'); meta.className='meta'; meta.textContent=entry.timestamp + ' • ' + (entry.mode||'') + ' • ' + entry.session_id; const q=document.createElement('div'); q.style.fontWeight='700'; q.style.marginTop='6px'; q.textContent=entry.query; const summary=document.createElement('div'); summary.style.marginTop='8px'; summary.innerHTML = mdToHtml(entry.summary||''); e.appendChild(meta); e.appendChild(q); e.appendChild(summary); container.appendChild(e); });
       }
 
       // PDF export: request blob and download
@@ -413,136 +568,327 @@ def workspace():
     return render_template_string(WORKSPACE, name=name)
 
 
-@app.route('/api/run', methods=['POST'])
-def api_run():
-    body = request.get_json() or {}
+def _run_args(body):
     session_id = body.get('session_id') or body.get('user_name') or 'user1'
     query = body.get('query', '')
     chat_mode = bool(body.get('chat_mode', False))
     user_name = body.get('user_name', None)
     if not user_name:
         user_name = session_id
+    return session_id, query, chat_mode, user_name
+
+
+def _wants_timings(body):
+    """
+    Per-request span breakdown (and graph node trace): {"timings": true} in the body or ?timings=1.
+    """
+    return bool(body.get('timings')) or request.args.get('timings') in ('1', 'true')
+
+
+def _run_job(payload):
+    with metrics.trace() as spans, node_trace() as nodes:
+        res = G.run(payload['session_id'], payload['query'],
+                    chat_mode=payload['chat_mode'], user_name=payload['user_name'])
+    if payload.get('timings'):
+        res['timings'] = spans
+        res['nodes'] = nodes
+    return res
+
+
+JOBS = JobQueue(_run_job)
+metrics.gauges("run_queue", "Run job queue state.", "stat", JOBS.stats)
+
+
+def _job_priority(body, query, chat_mode):
+    """
+    Explicit "priority" in the body, else high for chat-mode and short questions
+    that won't get a plan, normal for full retrieval + plan runs.
+    """
+    if body.get('priority'):
+        return str(body['priority'])
+    if chat_mode or (len(query.split()) <= SHORT_QUERY_WORDS and not wants_plan(query)):
+        return 'high'
+    return 'normal'
+
+
+def _queue_full(e):
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@app.route('/api/run', methods=['POST'])
+def api_run():
+    """
+    Runs the query in this request. Job mode: with {"async": true} or ?async=1 the
+    run goes on the job queue and the response is 202 with a job to poll at
+    /api/jobs/<id> (?wait=N long-polls); an explicit "priority" also queues it, and
+    the request waits for the result. 429 + Retry-After when the queue is full.
+    """
+    body = request.get_json() or {}
+    session_id, query, chat_mode, user_name = _run_args(body)
+    if not query:
+        return jsonify({'error': 'missing query'}), 400
+    payload = {'session_id': session_id, 'query': query, 'chat_mode': chat_mode,
+               'user_name': user_name, 'timings': _wants_timings(body)}
+    use_async = body.get('async') or request.args.get('async') in ('1', 'true')
+    if not use_async and not body.get('priority'):
+        return jsonify(_run_job(payload))
+    try:
+        job = JOBS.submit(payload, _job_priority(body, query, chat_mode), key=session_id)
+    except QueueFull as e:
+        return _queue_full(e)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if use_async:
+        job['status_url'] = url_for('api_job', job_id=job['job'])
+        response = jsonify(job)
+        response.status_code = 202
+        response.headers['Location'] = job['status_url']
+        return response
+
+    while job['status'] not in ('done', 'error'):
+        job = JOBS.status(job['job'], wait=JOB_WAIT_MAX) or {'status': 'error', 'error': 'job expired'}
+    if job['status'] == 'error':
+        return jsonify({'error': job['error']}), 500
+    return jsonify(job['result'])
+
+
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    """
+    Job status; the run's response is under "result" once status is "done".
+    ?wait=N blocks up to N seconds (max 25) for it to finish.
+    """
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return jsonify({'error': 'wait must be a number'}), 400
+    job = JOBS.status(job_id, wait=wait)
+    if job is None:
+        return jsonify({'error': 'unknown or expired job'}), 404
+    return jsonify(job)
+
+
+@app.route('/api/run/stream', methods=['POST'])
+def api_run_stream():
+    """
+    Same as /api/run, but streams NDJSON events (docs, summary/plan tokens, done)
+    while the LLM generates. History is saved when the stream completes.
+    """
+    body = request.get_json() or {}
+    session_id, query, chat_mode, user_name = _run_args(body)
     if not query:
         return jsonify({'error': 'missing query'}), 400
-    res = G.run(session_id, query, chat_mode=chat_mode, user_name=user_name)
-    return jsonify(res)
+
+    def generate():
+        try:
+            for event in G.run_stream(session_id, query, chat_mode=chat_mode, user_name=user_name):
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        except Exception as e:
+            yield json.dumps({"event": "error", "error": str(e)}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+BATCH_MAX = int(os.getenv('BATCH_MAX', '100'))
+
+
+@app.route('/api/run_batch', methods=['POST'])
+def api_run_batch():
+    """
+    Run a list of queries for one session: {"queries": [...], "workers": n, ...}.
+    Streams one NDJSON line per query as it finishes (result or error event with its index),
+    then {"event": "done"}. History is appended in submission order.
+    """
+    body = request.get_json() or {}
+    session_id, _, chat_mode, user_name = _run_args(body)
+    queries = body.get('queries')
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({'error': 'queries must be a non-empty list of strings'}), 400
+    if len(queries) > BATCH_MAX:
+        return jsonify({'error': f'at most {BATCH_MAX} queries per batch'}), 400
+    try:
+        workers = int(body.get('workers') or BATCH_WORKERS)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'workers must be an integer'}), 400
+    workers = max(1, min(workers, BATCH_MAX))
+
+    def generate():
+        try:
+            for event in G.run_many(session_id, queries, chat_mode=chat_mode, user_name=user_name, workers=workers):
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+            yield json.dumps({"event": "done", "count": len(queries)}) + "\n"
+        except Exception as e:
+            yield json.dumps({"event": "error", "error": str(e)}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _sessions_for_name(name: str):
+    """
+    Return {session_id: session} for sessions whose id or stored user name matches,
+    using the store's name index so only that user's logs are read.
+    """
+    out = {}
+    for s_id in G.store.sessions_for_name(name):
+        session = G.store.get_session(s_id)
+        if session is not None:
+            out[s_id] = session
+    return out
+
+
+def _encode_cursor(offsets):
+    return base64.urlsafe_b64encode(json.dumps(offsets, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor):
+    try:
+        offsets = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if isinstance(offsets, dict) and all(isinstance(v, int) for v in offsets.values()):
+            return offsets
+    except ValueError:
+        pass
+    raise ValueError('invalid cursor')
+
+
+def _clip_entry(entry, max_chars):
+    entry = dict(entry)
+    if isinstance(entry.get('summary'), str):
+        entry['summary'] = entry['summary'][:max_chars]
+    if isinstance(entry.get('plan'), dict) and isinstance(entry['plan'].get('plan'), str):
+        entry['plan'] = dict(entry['plan'], plan=entry['plan']['plan'][:max_chars])
+    return entry
+
+
+def _history_page(session_ids, limit, before=None, fields=None, max_chars=None):
+    """
+    Newest-first page of entries merged across session logs. Each log is read
+    backwards from the cursor, which maps session id -> byte offset to resume
+    below, so a page costs O(limit) whatever the history length.
+    """
+    offsets = _decode_cursor(before) if before else {}
+    streams = {}
+    for s_id in session_ids:
+        if offsets.get(s_id, 1) <= 0:
+            continue  # exhausted on an earlier page
+        it = G.store.iter_reverse(s_id, end=offsets.get(s_id))
+        head = next(it, None)
+        if head is not None:
+            streams[s_id] = (head, it)
+        else:
+            offsets[s_id] = 0
+
+    entries = []
+    while streams and len(entries) < limit:
+        s_id = max(streams, key=lambda k: (streams[k][0][1].get('timestamp') or '', k))
+        (offset, entry), it = streams[s_id]
+        offsets[s_id] = offset
+        if fields:
+            entry = {k: entry[k] for k in fields if k in entry}
+        if max_chars:
+            entry = _clip_entry(entry, max_chars)
+        entry['session_id'] = s_id
+        entries.append(entry)
+        head = next(it, None)
+        if head is None:
+            del streams[s_id]
+            offsets[s_id] = 0
+        else:
+            streams[s_id] = (head, it)
+    return {'entries': entries, 'next_cursor': _encode_cursor(offsets) if streams else None}
+
+
+def _int_arg(key, default, lo, hi):
+    try:
+        value = int(request.args.get(key, default))
+    except ValueError:
+        raise ValueError(f'{key} must be an integer')
+    return max(lo, min(hi, value))
 
 
 @app.route('/api/history')
 def api_history():
-    from graph import load_state
+    """
+    A user's (name) or one session's (session_id) history.
+    With limit or before: {"entries": [...newest first, each with session_id],
+    "next_cursor"}; pass next_cursor back as `before` for the next page.
+    fields=timestamp,query,... keeps only those keys; max_chars clips summaries/plans.
+    Without them, the legacy {session_id: session} blob. Either way the response
+    carries an ETag over the logs' versions and the query, and If-None-Match
+    gets a 304.
+    """
     sid = request.args.get('session_id', None)
     name = request.args.get('name', None)
 
     if not sid and not name:
         return jsonify({"error": "missing session_id or name parameter"}), 400
 
-    state = load_state()
-    sessions = state.get('sessions', {})
-
-    if sid:
-        return jsonify(sessions.get(sid, {}))
-
-    if name:
-        name_norm = name.strip().lower()
-        out = {}
-        for s_id, sdata in sessions.items():
-            user_meta = sdata.get("user") or {}
-            stored_name = (user_meta.get("name") or sdata.get("user_name") or "").strip().lower()
-            if s_id.strip().lower() == name_norm or stored_name == name_norm:
-                out[s_id] = sdata
-        return jsonify(out)
-
-    return jsonify({})
+    session_ids = [sid] if sid else G.store.sessions_for_name(name)
+    etag = cache_key('history', [(s_id, G.store.version(s_id)) for s_id in session_ids],
+                     sorted(request.args.items(multi=True)))[:32]
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif 'limit' in request.args or 'before' in request.args:
+        fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+        try:
+            limit = _int_arg('limit', HISTORY_PAGE, 1, HISTORY_MAX_PAGE)
+            max_chars = _int_arg('max_chars', 0, 0, 1_000_000)
+            page = _history_page(session_ids, limit, request.args.get('before'), fields, max_chars)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        response = jsonify(page)
+    elif sid:
+        response = jsonify(G.store.get_session(sid) or {})
+    else:
+        response = jsonify(_sessions_for_name(name))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @app.route('/api/export_pdf')
 def api_export_pdf():
     """
-    Generate a readable PDF containing the user's history.
-    Uses reportlab.platypus Paragraph to support basic bold rendering.
+    Readable PDF of the user's history (basic bold rendering via reportlab Paragraph).
+    PDFs are cached per history version and sent with an ETag; If-None-Match gets a
+    304. ?async=1 starts a background export and returns 202 with a status URL.
     """
     name = request.args.get('name', '').strip()
     if not name:
         return jsonify({"error": "missing name parameter"}), 400
 
-    from graph import load_state
-    state = load_state()
-    sessions = state.get('sessions', {})
-
-    name_norm = name.lower()
-    user_sessions = {}
-    for s_id, sdata in sessions.items():
-        user_meta = sdata.get("user") or {}
-        stored_name = (user_meta.get("name") or sdata.get("user_name") or "").strip().lower()
-        if s_id.strip().lower() == name_norm or stored_name == name_norm:
-            user_sessions[s_id] = sdata
-
-    if not user_sessions:
+    session_ids, etag = EXPORTS.version(name)
+    if not session_ids:
         return jsonify({"error": "no history found for this user"}), 404
-
-    try:
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.lib.pagesizes import letter
-        from reportlab.lib.units import inch
-        from reportlab.lib.enums import TA_LEFT
-    except Exception as e:
-        return Response("PDF export requires the 'reportlab' package. Install with: pip install reportlab\n\nError: " + str(e), status=501, mimetype='text/plain')
-
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter,
-                            leftMargin=0.7*inch, rightMargin=0.7*inch,
-                            topMargin=0.7*inch, bottomMargin=0.7*inch)
-
-    styles = getSampleStyleSheet()
-    h1 = ParagraphStyle('Heading1', parent=styles['Heading1'], fontName='Helvetica-Bold', fontSize=16, spaceAfter=8)
-    normal = ParagraphStyle('Normal', parent=styles['Normal'], fontName='Helvetica', fontSize=10, leading=14, alignment=TA_LEFT)
-    small = ParagraphStyle('Small', parent=styles['Normal'], fontName='Helvetica', fontSize=9, leading=12)
-
-    story = []
-    story.append(Paragraph(f"AI Research Assistant — History for {name}", h1))
-    story.append(Paragraph(f"Exported: {datetime.utcnow().isoformat()}Z", small))
-    story.append(Spacer(1, 12))
-
-    import re, html
-    def md_to_html_for_pdf(s: str) -> str:
-        if not s:
-            return ''
-        escaped = html.escape(s)
-        converted = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', escaped)
-        paragraphs = converted.split('\\n\\n')
-        html_parts = []
-        for p in paragraphs:
-            p = p.replace('\\n', '<br/>')
-            html_parts.append(p)
-        return '<br/><br/>'.join(html_parts)
-
-    for s_id, sdata in user_sessions.items():
-        story.append(Paragraph(f"Session: {s_id}", ParagraphStyle('sesh', parent=h1, fontSize=12)))
-        story.append(Spacer(1, 6))
-        history = sdata.get('history', [])
-        if not history:
-            story.append(Paragraph("(no entries)", normal))
-            story.append(Spacer(1, 8))
-            continue
-
-        for entry in history:
-            ts = entry.get('timestamp', '')
-            q = entry.get('query', '')
-            summary = entry.get('summary') or ''
-            q_html = md_to_html_for_pdf(q)
-            summary_html = md_to_html_for_pdf(summary)
-            story.append(Paragraph(f"<b>{html.escape(ts)}</b> — Query: {q_html}", normal))
-            story.append(Spacer(1, 4))
-            story.append(Paragraph(f"<b>Summary:</b> {summary_html}", normal))
-            story.append(Spacer(1, 8))
-
-        story.append(Spacer(1, 10))
-
-    doc.build(story)
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name=f"{name}_history.pdf", mimetype="application/pdf")
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    path = EXPORTS.cached(name, etag)
+    if path is None:
+        missing = pdf_unavailable()
+        if missing:
+            return Response(missing, status=501, mimetype='text/plain')
+        if request.args.get('async') in ('1', 'true'):
+            job = EXPORTS.start(name, session_ids, etag)
+            job['status_url'] = url_for('api_export_pdf_status', job=job['job'])
+            job['download_url'] = url_for('api_export_pdf', name=name)
+            return jsonify(job), 202
+        path = EXPORTS.export(name, session_ids, etag)
+    return send_file(path, as_attachment=True, download_name=f"{name}_history.pdf",
+                     mimetype="application/pdf", etag=etag, max_age=0)
+
+
+@app.route('/api/export_pdf/status')
+def api_export_pdf_status():
+    job = request.args.get('job', '').strip()
+    if not job:
+        return jsonify({"error": "missing job parameter"}), 400
+    return jsonify(EXPORTS.status(job))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+import json
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs
+
+import metrics
+
+from app import G, _run_args, app as flask_app
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    _flask_asgi = WsgiToAsgi(flask_app)
+except ImportError:
+    _flask_asgi = None
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _send_json(send, status: int, payload: Dict[str, Any]):
+    data = json.dumps(payload).encode("utf-8")
+    headers: List[Tuple[bytes, bytes]] = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(data)).encode()),
+    ]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": data})
+
+
+async def _api_run(scope, receive, send):
+    try:
+        body = json.loads(await _read_body(receive) or b"{}")
+    except ValueError:
+        body = {}
+    if not isinstance(body, dict):
+        body = {}
+    session_id, query, chat_mode, user_name = _run_args(body)
+    if not query:
+        await _send_json(send, 400, {"error": "missing query"})
+        return
+    try:
+        with metrics.trace() as spans:
+            res = await G.arun(session_id, query, chat_mode=chat_mode, user_name=user_name)
+    except Exception as e:
+        await _send_json(send, 500, {"error": str(e)})
+        return
+    if body.get("timings") or parse_qs(scope.get("query_string", b"").decode()).get("timings", [""])[0] in ("1", "true"):
+        res["timings"] = spans
+    await _send_json(send, 200, res)
+
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point (uvicorn asgi:app). POST /api/run is served on the event loop via
+    ResearchGraph.arun; every other route is handed to the Flask app (needs asgiref).
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] == "http" and scope["path"] == "/api/run" and scope["method"] == "POST":
+        await _api_run(scope, receive, send)
+        return
+    if _flask_asgi is None:
+        await _send_json(send, 501, {"error": "Serving Flask routes over ASGI requires 'asgiref'. Install with: pip install asgiref"})
+        return
+    await _flask_asgi(scope, receive, send)
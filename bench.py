@@ -0,0 +1,543 @@
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+UPSTREAMS = ("openrouter", "wikipedia", "ddg")
+BENCHES = ("retriever", "retriever_external", "summarizer", "graph_run", "persistence", "export_pdf")
+
+QUERY_TOPICS = (
+    "retrieval augmented generation",
+    "summarize research papers",
+    "langgraph state machines",
+    "vector database indexing",
+    "prompt engineering for small models",
+    "evaluation of question answering",
+)
+SAMPLE_DOCS = [
+    {"id": "bench-1", "title": "RAG notes", "text": "Retrieval-augmented generation grounds the answer in retrieved passages. " * 6},
+    {"id": "bench-2", "title": "BM25 notes", "text": "BM25 ranks passages by term frequency with length normalization. " * 6},
+]
+
+
+def _filler(size: int) -> str:
+    words = ("retrieval", "summary", "passage", "ranking", "context", "model", "answer", "query")
+    out: List[str] = []
+    n = 0
+    while n < size:
+        w = words[len(out) % len(words)]
+        out.append(w)
+        n += len(w) + 1
+    return " ".join(out)[:size]
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: Dict[str, Any]):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _answer(self) -> Optional[Dict[str, Any]]:
+        fake: FakeUpstream = self.server.fake  # type: ignore[attr-defined]
+        fail = fake.delay()
+        if fail:
+            self._send(503, {"error": "injected failure"})
+            return None
+        return {"text": _filler(fake.payload)}
+
+    def do_GET(self):
+        fake: FakeUpstream = self.server.fake  # type: ignore[attr-defined]
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        answer = self._answer()
+        if answer is None:
+            return
+        if fake.kind == "wikipedia":
+            if params.get("list") == "search":
+                self._send(200, {"query": {"search": [{"ns": 0, "title": params.get("srsearch", "").title()}]}})
+            else:
+                title = params.get("titles", "")
+                self._send(200, {"query": {"pages": {"1": {"pageid": 1, "ns": 0, "title": title,
+                                                           "extract": f"{title}. {answer['text']}"}}}})
+        elif fake.kind == "ddg":
+            self._send(200, {"AbstractText": answer["text"], "AbstractURL": "http://ddg.invalid/a",
+                             "RelatedTopics": [{"Text": f"related {i}", "FirstURL": f"http://ddg.invalid/{i}"} for i in range(3)]})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        fake: FakeUpstream = self.server.fake  # type: ignore[attr-defined]
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        answer = self._answer()
+        if answer is None:
+            return
+        if fake.kind != "openrouter":
+            self._send(404, {"error": "not found"})
+            return
+        prompt = body.get("messages", [{}])[-1].get("content", "")
+        text = answer["text"]
+        if "### PLAN" in prompt:
+            text = f"### SUMMARY\n{text}\n### PLAN\n1. Read the sources.\n2. Draft the answer.\n3. Review it."
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for word in text.split(" "):
+                self.wfile.write(("data: " + json.dumps({"choices": [{"delta": {"content": word + " "}}]}) + "\n\n").encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+            return
+        self._send(200, {"choices": [{"message": {"content": text}}],
+                         "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4,
+                                   "total_tokens": (len(prompt) + len(text)) // 4}})
+
+
+class _FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients giving up on a slow answer (deadlines, hedges) are expected here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeUpstream:
+    """
+    Local HTTP stand-in for OpenRouter, Wikipedia or DuckDuckGo answering in the
+    real response format, with a configurable latency (plus uniform jitter),
+    response text size in bytes and failure rate (injected 503s).
+    """
+
+    def __init__(self, kind: str, latency: float = 0.05, jitter: float = 0.0, payload: int = 600, fail_rate: float = 0.0):
+        if kind not in UPSTREAMS:
+            raise ValueError(f"kind must be one of {', '.join(UPSTREAMS)}")
+        self.kind = kind
+        self.latency = latency
+        self.jitter = jitter
+        self.payload = payload
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._server: Optional[_FakeServer] = None
+
+    def delay(self) -> bool:
+        # sleeps for this request's latency; True if it should fail
+        with self._lock:
+            self.requests += 1
+            fail = random.random() < self.fail_rate
+            self.failures += fail
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        return fail
+
+    def start(self) -> str:
+        self._server = _FakeServer(("127.0.0.1", 0), _FakeHandler)
+        self._server.fake = self  # type: ignore[attr-defined]
+        threading.Thread(target=self._server.serve_forever, name=f"fake-{self.kind}", daemon=True).start()
+        return self.url
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2] if self._server else ("127.0.0.1", 0)
+        path = {"openrouter": "/api/v1/chat/completions", "wikipedia": "/w/api.php", "ddg": "/"}[self.kind]
+        return f"http://{host}:{port}{path}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"latency": self.latency, "jitter": self.jitter, "payload": self.payload,
+                "fail_rate": self.fail_rate, "requests": self.requests, "failures": self.failures}
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+    p50/p90/p95/p99/max/mean in milliseconds of samples given in seconds
+    (nearest-rank).
+    """
+    if not samples:
+        return {}
+    s = sorted(samples)
+
+    def rank(p: float) -> float:
+        return s[min(len(s), max(1, math.ceil(p / 100 * len(s)))) - 1]
+
+    out = {f"p{p}": rank(p) for p in (50, 90, 95, 99)}
+    out["max"] = s[-1]
+    out["mean"] = sum(s) / len(s)
+    return {k: round(v * 1000, 2) for k, v in out.items()}
+
+
+def measure(fn: Callable[[int], Any], iterations: int, concurrency: int = 1) -> Dict[str, Any]:
+    """
+    Call fn(i) for i in range(iterations) on `concurrency` threads; latency
+    percentiles, throughput (calls/s over the wall time) and error count.
+    """
+    samples: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def one(i: int):
+        t = time.perf_counter()
+        try:
+            fn(i)
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+            return
+        with lock:
+            samples.append(time.perf_counter() - t)
+
+    started = time.perf_counter()
+    if concurrency <= 1:
+        for i in range(iterations):
+            one(i)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, range(iterations)))
+    wall = time.perf_counter() - started
+    out: Dict[str, Any] = {"calls": iterations, "concurrency": concurrency, "errors": len(errors),
+                           "seconds": round(wall, 3), "throughput": round(iterations / wall, 2) if wall else None,
+                           "latency_ms": percentiles(samples)}
+    if errors:
+        out["first_error"] = errors[0][:200]
+    return out
+
+
+def _entry(i: int, name: str) -> Dict[str, Any]:
+    return {
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "query": f"{QUERY_TOPICS[i % len(QUERY_TOPICS)]} (turn {i})",
+        "summary": _filler(400),
+        "plan": None,
+        "mode": "retrieval",
+        "user": {"name": name},
+    }
+
+
+class Suite:
+    """
+    The offline benchmark: starts the three fake upstreams, points the app at them
+    through its environment settings (OPENROUTER_URL, WIKIPEDIA_API_URL, DDG_URL,
+    STATE_DIR), and runs each bench in a throwaway working directory holding a
+    copy of the knowledge folder. Modules that read those settings at import time
+    (graph, LLM, store, app) are imported only after the environment is set, so
+    run it in a fresh process.
+    """
+
+    def __init__(
+        self,
+        iterations: int = 50,
+        concurrency: int = 4,
+        latency: float = 0.05,
+        jitter: float = 0.01,
+        payload: int = 600,
+        fail_rate: float = 0.0,
+        history_sizes: List[int] = (10, 100, 1000, 10000),
+        export_sizes: List[int] = (50, 500),
+        knowledge: Optional[str] = None
+    ):
+        self.iterations = iterations
+        self.concurrency = concurrency
+        self.history_sizes = list(history_sizes)
+        self.export_sizes = list(export_sizes)
+        self.knowledge = knowledge or _default_knowledge()
+        self.fakes = {kind: FakeUpstream(kind, latency, jitter, payload, fail_rate) for kind in UPSTREAMS}
+        self.workdir: Optional[str] = None
+        self._cwd = os.getcwd()
+        self._run_id = f"{os.getpid()}-{int(time.time())}"
+
+    def __enter__(self) -> "Suite":
+        self.workdir = tempfile.mkdtemp(prefix="bench-")
+        if self.knowledge and os.path.isdir(self.knowledge):
+            shutil.copytree(self.knowledge, os.path.join(self.workdir, "knowledge"),
+                            ignore=shutil.ignore_patterns(".knowledge_index*"))
+        else:
+            os.makedirs(os.path.join(self.workdir, "knowledge"))
+        os.makedirs(os.path.join(self.workdir, "empty"))
+        urls = {kind: fake.start() for kind, fake in self.fakes.items()}
+        os.environ.update({
+            "OPENROUTER_URL": urls["openrouter"],
+            "OPENROUTER_API_KEY": "bench",
+            "WIKIPEDIA_API_URL": urls["wikipedia"],
+            "DDG_URL": urls["ddg"],
+            "STATE_DIR": os.path.join(self.workdir, "state"),
+        })
+        os.environ.pop("LLM_ENDPOINTS", None)
+        os.environ.pop("LLM_CACHE_DB", None)
+        os.chdir(self.workdir)
+        return self
+
+    def __exit__(self, *exc):
+        os.chdir(self._cwd)
+        for fake in self.fakes.values():
+            fake.stop()
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _query(self, bench: str, i: int) -> str:
+        # unique per bench and call, so the LLM and retrieval caches never answer for the upstreams
+        return f"{QUERY_TOPICS[i % len(QUERY_TOPICS)]} {bench} {self._run_id}-{i}"
+
+    def bench_retriever(self) -> Dict[str, Any]:
+        # the knowledge folder first, the upstreams for whatever it can't cover
+        from graph import retriever_node
+        from retrieval import get_index
+        index = get_index("knowledge")
+        return measure(lambda i: retriever_node(self._query("retriever", i), docs_folder="knowledge", index=index),
+                       self.iterations, self.concurrency)
+
+    def bench_retriever_external(self) -> Dict[str, Any]:
+        # an empty knowledge folder, so every call goes to Wikipedia and DuckDuckGo
+        from graph import retriever_node
+        from retrieval import get_index
+        index = get_index("empty")
+        return measure(lambda i: retriever_node(self._query("external", i), docs_folder="empty", index=index),
+                       self.iterations, self.concurrency)
+
+    def bench_summarizer(self) -> Dict[str, Any]:
+        from graph import summarizer_node
+        return measure(lambda i: summarizer_node(self._query("summarizer", i), SAMPLE_DOCS), self.iterations, self.concurrency)
+
+    def bench_graph_run(self) -> Dict[str, Any]:
+        # every third query asks for a plan; sessions are spread over the workers
+        import app
+        return measure(lambda i: app.G.run(f"bench-run-{i % self.concurrency}",
+                                           ("how to implement " if i % 3 == 0 else "") + self._query("run", i),
+                                           user_name="bench"),
+                       self.iterations, self.concurrency)
+
+    def bench_persistence(self) -> Dict[str, Any]:
+        from memory import ConversationMemory
+        from store import SessionStore
+        out: Dict[str, Any] = {}
+        for size in self.history_sizes:
+            store = SessionStore(os.path.join(self.workdir, f"persist-{size}"), legacy_file=None, compact_interval=0)
+            memory = ConversationMemory(store)
+            sid = f"persist-{size}"
+            for i in range(size):
+                store.append_entry(sid, _entry(i, "bench"))
+            n = self.iterations
+            out[str(size)] = {
+                "append_entry": measure(lambda i: store.append_entry(f"persist-{size}-{i % self.concurrency}", _entry(i, "bench")),
+                                        n, self.concurrency),
+                "session_meta": measure(lambda i: store.session_meta(sid), n, self.concurrency),
+                "memory_context": measure(lambda i: memory.context(sid), n, self.concurrency),
+                "tail_20": measure(lambda i: store.tail(sid, 20), n, self.concurrency),
+                "history_full": measure(lambda i: store.history(sid), max(3, n // 10), 1),
+            }
+        return out
+
+    def bench_export_pdf(self) -> Dict[str, Any]:
+        from export import pdf_unavailable
+        missing = pdf_unavailable()
+        if missing:
+            return {"skipped": missing.splitlines()[0]}
+        import app
+        client = app.app.test_client()
+        out: Dict[str, Any] = {}
+        for size in self.export_sizes:
+            name = f"bench-export-{size}"
+            for i in range(size):
+                app.G.store.append_entry(f"{name}-{i % 4}", _entry(i, name))
+
+            def get(i: int, headers: Optional[Dict[str, str]] = None, expect: int = 200):
+                resp = client.get(f"/api/export_pdf?name={name}", headers=headers or {})
+                resp.get_data()
+                if resp.status_code != expect:
+                    raise RuntimeError(f"HTTP {resp.status_code}")
+                return resp
+
+            t = time.perf_counter()
+            first = get(0)
+            cold = round((time.perf_counter() - t) * 1000, 2)
+            etag = first.headers.get("ETag", "")
+            out[str(size)] = {
+                "cold_ms": cold,
+                "pdf_bytes": len(first.get_data()),
+                "cached": measure(get, self.iterations, self.concurrency),
+                "not_modified": measure(lambda i: get(i, {"If-None-Match": etag}, 304), self.iterations, self.concurrency),
+            }
+        return out
+
+    def run(self, only: Optional[List[str]] = None) -> Dict[str, Any]:
+        results: Dict[str, Any] = {}
+        for name in only or BENCHES:
+            if name not in BENCHES:
+                raise ValueError(f"unknown bench '{name}' (choose from {', '.join(BENCHES)})")
+            t = time.perf_counter()
+            results[name] = getattr(self, f"bench_{name}")()
+            print(f"{name}: {time.perf_counter() - t:.1f}s", file=sys.stderr)
+        return {
+            "meta": _meta(),
+            "config": {"iterations": self.iterations, "concurrency": self.concurrency,
+                       "history_sizes": self.history_sizes, "export_sizes": self.export_sizes},
+            "upstreams": {kind: fake.stats() for kind, fake in self.fakes.items()},
+            "results": results,
+        }
+
+
+def check_external(deadline: float = 1.0, slow: float = 3.0) -> List[Dict[str, Any]]:
+    """
+    Self-check for graph._fetch_external (and its async twin) against fake
+    Wikipedia/DuckDuckGo servers: with either or both upstreams answering in
+    `slow` seconds, a lookup under a `deadline` second budget must return within
+    it (plus a small slack), keeping whatever the fast upstream returned.
+    Returns one row per case; raises AssertionError on the first failure.
+    """
+    import asyncio
+
+    os.environ.pop("WIKI_DUMP_DIR", None)
+    os.environ.setdefault("STATE_DIR", tempfile.mkdtemp(prefix="check-external-"))
+    import graph
+
+    slack = 0.25
+    cases = [
+        ("both fast", 0.05, 0.05, {"wiki", "ddg"}),
+        ("ddg slow", 0.05, slow, {"wiki"}),
+        ("wikipedia slow", slow, 0.05, {"ddg"}),
+        ("both slow", slow, slow, set()),
+    ]
+    # one loop for every async case, warmed up so httpx client setup isn't timed
+    loop = asyncio.new_event_loop()
+    warm = FakeUpstream("ddg", 0.0)
+    graph.WIKIPEDIA_API_URL = graph.DDG_URL = warm.start()
+    loop.run_until_complete(graph._afetch_external(f"warm up {time.time_ns()}", [], 3, 5.0))
+    warm.stop()
+    rows = []
+    for label, wiki_latency, ddg_latency, expect in cases:
+        wiki, ddg = FakeUpstream("wikipedia", wiki_latency), FakeUpstream("ddg", ddg_latency)
+        graph.WIKIPEDIA_API_URL, graph.DDG_URL = wiki.start(), ddg.start()
+        try:
+            for path in ("sync", "async"):
+                # a fresh query each time, so the retrieval cache can't answer
+                query = f"deadline check {label} {path} {time.time_ns()}"
+                t = time.perf_counter()
+                if path == "sync":
+                    docs = graph._fetch_external(query, [], 3, deadline)
+                else:
+                    docs = loop.run_until_complete(graph._afetch_external(query, [], 3, deadline))
+                elapsed = time.perf_counter() - t
+                sources = {"wiki" if d["id"].startswith("wiki:") else "ddg" for d in docs}
+                rows.append({"case": label, "path": path, "seconds": round(elapsed, 3),
+                             "sources": sorted(sources), "docs": len(docs)})
+                assert elapsed <= deadline + slack, f"{label} ({path}): took {elapsed:.2f}s with a {deadline}s deadline"
+                assert sources == expect, f"{label} ({path}): got docs from {sorted(sources)}, expected {sorted(expect)}"
+        finally:
+            wiki.stop()
+            ddg.stop()
+    loop.close()
+    return rows
+
+
+def _default_knowledge() -> Optional[str]:
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in ("knowledge", "Knowledge"):
+        if os.path.isdir(os.path.join(here, name)):
+            return os.path.join(here, name)
+    return None
+
+
+def _meta() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {"timestamp": datetime.utcnow().isoformat() + "Z", "commit": commit,
+            "python": sys.version.split()[0], "platform": sys.platform, "cpus": os.cpu_count()}
+
+
+def _flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, Dict[str, Any]]:
+    # every measure() result, keyed by its path (e.g. "persistence.1000.append_entry")
+    out: Dict[str, Dict[str, Any]] = {}
+    for k, v in results.items():
+        if isinstance(v, dict) and "latency_ms" in v:
+            out[prefix + k] = v
+        elif isinstance(v, dict):
+            out.update(_flatten(v, f"{prefix}{k}."))
+    return out
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> List[str]:
+    """
+    One line per bench present in both reports: p50/p95 and throughput, old -> new.
+    """
+    before, after = _flatten(old.get("results", {})), _flatten(new.get("results", {}))
+    lines = []
+    for key in sorted(set(before) & set(after)):
+        a, b = before[key], after[key]
+
+        def change(x: Optional[float], y: Optional[float]) -> str:
+            if not x or y is None:
+                return f"{x} -> {y}"
+            return f"{x} -> {y} ({(y - x) / x * 100:+.0f}%)"
+
+        lines.append(f"{key}: p50 {change(a['latency_ms'].get('p50'), b['latency_ms'].get('p50'))} ms, "
+                     f"p95 {change(a['latency_ms'].get('p95'), b['latency_ms'].get('p95'))} ms, "
+                     f"throughput {change(a.get('throughput'), b.get('throughput'))}/s")
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Offline benchmarks against local stand-ins for OpenRouter, Wikipedia and DuckDuckGo")
+    parser.add_argument("--only", default="", help=f"Comma-separated benches ({', '.join(BENCHES)}); default all.")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05, help="Upstream latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Uniform +/- jitter on the latency.")
+    parser.add_argument("--payload", type=int, default=600, help="Upstream response text size in bytes.")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of upstream requests answered with 503.")
+    parser.add_argument("--history-sizes", default="10,100,1000,10000")
+    parser.add_argument("--export-sizes", default="50,500")
+    parser.add_argument("--out", help="Write the JSON report here instead of stdout.")
+    parser.add_argument("--compare", help="Earlier JSON report to diff against (printed to stderr).")
+    parser.add_argument("--check-external", action="store_true",
+                        help="Only check that external retrieval keeps its deadline when an upstream is slow.")
+    parser.add_argument("--deadline", type=float, default=1.0, help="Retrieval deadline for --check-external.")
+    args = parser.parse_args()
+
+    if args.check_external:
+        for row in check_external(args.deadline, max(args.latency, args.deadline * 3)):
+            print(json.dumps(row))
+        print("external retrieval deadline: ok", file=sys.stderr)
+        sys.exit(0)
+
+    def sizes(s: str) -> List[int]:
+        return [int(x) for x in s.split(",") if x.strip()]
+
+    with Suite(args.iterations, args.concurrency, args.latency, args.jitter, args.payload, args.fail_rate,
+               sizes(args.history_sizes), sizes(args.export_sizes)) as suite:
+        report = suite.run([b.strip() for b in args.only.split(",") if b.strip()] or None)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print("\n".join(compare(json.load(f), report)), file=sys.stderr)
@@ -0,0 +1,99 @@
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+PROMPT_BUDGET = int(os.getenv("PROMPT_BUDGET", "2000"))             # prompt tokens, template included
+PROMPT_QUERY_TOKENS = int(os.getenv("PROMPT_QUERY_TOKENS", "256"))  # cap for the question itself
+PROMPT_CONTEXT_SHARE = float(os.getenv("PROMPT_CONTEXT_SHARE", "0.25"))
+MIN_DOC_TOKENS = 32  # a doc that can't keep at least this much text is dropped instead of trimmed
+ELLIPSIS = " …"
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def _piece_tokens(piece: str) -> int:
+    # BPE vocabularies hold most short words whole and split longer ones into
+    # roughly 4-byte chunks; punctuation is usually a token of its own
+    if len(piece) <= 4:
+        return 1
+    return (len(piece.encode("utf-8")) + 3) // 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast local token estimate for Llama-style BPE tokenizers (within ~10-15% on
+    English prose), so budgeting needs no tokenizer download or network call.
+    """
+    return sum(_piece_tokens(m.group()) for m in _PIECE_RE.finditer(text or ""))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Longest prefix of text that fits max_tokens (estimated), cut between pieces,
+    with an ellipsis when anything was removed.
+    """
+    used = 0
+    cut = 0  # end of the longest prefix that still leaves room for the ellipsis
+    for m in _PIECE_RE.finditer(text):
+        used += _piece_tokens(m.group())
+        if used > max_tokens:
+            return text[:cut].rstrip() + ELLIPSIS if cut else ""
+        if used < max_tokens:
+            cut = m.end()
+    return text
+
+
+def fit(
+    query: str,
+    docs: List[Dict[str, str]],
+    context: str = "",
+    budget: int = PROMPT_BUDGET,
+    overhead: int = 0
+) -> Tuple[str, List[Dict[str, str]], str, Dict[str, Any]]:
+    """
+    Fit the variable parts of a prompt into `budget` tokens (`overhead` is the fixed
+    template). The query is capped first, then docs (in rank order) and the previous
+    context share what is left: context gets up to PROMPT_CONTEXT_SHARE of it, or more
+    if the docs don't need the rest. The doc on the boundary is trimmed; docs after
+    the budget runs out are dropped. Returns (query, docs, context, report), where
+    report = {"budget", "tokens", "cuts": [...]} describes what was trimmed or dropped.
+    """
+    cuts: List[Dict[str, Any]] = []
+    available = start = max(0, budget - overhead)
+
+    q_tokens = estimate_tokens(query)
+    q_cap = min(PROMPT_QUERY_TOKENS, available)
+    if q_tokens > q_cap:
+        query = truncate_tokens(query, q_cap)
+        cuts.append({"part": "query", "action": "trimmed", "tokens": q_tokens, "kept": estimate_tokens(query)})
+    available -= estimate_tokens(query)
+
+    costs = [(estimate_tokens(d.get("title", "")) + 2, estimate_tokens(d.get("text", ""))) for d in docs]
+    docs_need = sum(t + x for t, x in costs)
+    c_tokens = estimate_tokens(context)
+    c_cap = max(int(available * PROMPT_CONTEXT_SHARE), available - docs_need)
+    if c_tokens > c_cap:
+        if c_cap >= MIN_DOC_TOKENS:
+            context = truncate_tokens(context, c_cap)
+            cuts.append({"part": "context", "action": "trimmed", "tokens": c_tokens, "kept": estimate_tokens(context)})
+        else:
+            context = ""
+            cuts.append({"part": "context", "action": "dropped", "tokens": c_tokens})
+    available -= estimate_tokens(context)
+
+    fitted: List[Dict[str, str]] = []
+    for doc, (title_cost, text_cost) in zip(docs, costs):
+        if title_cost + text_cost <= available:
+            fitted.append(doc)
+            available -= title_cost + text_cost
+        elif available - title_cost >= MIN_DOC_TOKENS:
+            trimmed = dict(doc, text=truncate_tokens(doc.get("text", ""), available - title_cost))
+            kept = estimate_tokens(trimmed["text"])
+            fitted.append(trimmed)
+            available -= title_cost + kept
+            cuts.append({"part": "doc", "id": doc.get("id"), "action": "trimmed", "tokens": text_cost, "kept": kept})
+        else:
+            cuts.append({"part": "doc", "id": doc.get("id"), "action": "dropped", "tokens": text_cost})
+
+    report = {"budget": budget, "tokens": overhead + start - available, "cuts": cuts}
+    return query, fitted, context, report
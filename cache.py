@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+
+def cache_key(*parts: Any) -> str:
+    """
+    Stable sha256 key over JSON-serializable parts.
+    """
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU bounded by entry count and (optionally) total value size.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: str, value: Any, size: int = 0):
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._sizes.pop(key)
+                del self._data[key]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            while self._data and (
+                len(self._data) > self.max_entries
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                old, _ = self._data.popitem(last=False)
+                self._bytes -= self._sizes.pop(old)
+
+    def delete(self, key: str):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+                self._bytes -= self._sizes.pop(key)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    """
+    On-disk string cache with a TTL. One connection per thread; WAL mode so readers
+    don't block the writer.
+    """
+
+    def __init__(self, path: str, ttl: float = 86400.0, table: str = "cache"):
+        self.path = path
+        self.ttl = ttl
+        self.table = table
+        self._local = threading.local()
+        self._writes = 0
+        with self._conn() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            d = os.path.dirname(self.path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._conn().execute(f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._conn() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+            self._writes += 1
+            if self._writes % 500 == 0:
+                conn.execute(f"DELETE FROM {self.table} WHERE expires < ?", (time.time(),))
+
+
+class TieredCache:
+    """
+    Memory LRU in front of an optional SQLite tier, with hit/miss counters.
+    Disk hits are promoted to memory.
+    """
+
+    def __init__(self, memory: LRUCache, disk: Optional[SQLiteCache] = None):
+        self.memory = memory
+        self.disk = disk
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            return value
+        if self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except sqlite3.Error:
+                value = None
+            if value is not None:
+                self.memory.set(key, value, size=len(value))
+                self._count("disk_hits")
+                return value
+        self._count("misses")
+        return None
+
+    def set(self, key: str, value: str):
+        self.memory.set(key, value, size=len(value))
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except sqlite3.Error:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            out = dict(self._stats)
+        out["memory_entries"] = len(self.memory)
+        return out
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key: the first caller runs fn, the
+    others wait for and share its result (or exception). Nothing is kept afterwards.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, "_Call"] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SWRCache:
+    """
+    TTL cache for JSON-serializable values with separate lifetimes for hits and
+    misses (negative caching) and stale-while-revalidate: after its TTL an entry is
+    still served for up to `stale_ttl` seconds while it is refetched in the background.
+    Memory LRU in front of an optional SQLite tier that survives restarts.
+    """
+
+    def __init__(
+        self,
+        memory: LRUCache,
+        disk: Optional[SQLiteCache] = None,
+        hit_ttl: float = 3600.0,
+        miss_ttl: float = 300.0,
+        stale_ttl: float = 86400.0,
+        refresh_workers: int = 2
+    ):
+        self.memory = memory
+        self.disk = disk
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self.stale_ttl = stale_ttl
+        self._flight = SingleFlight()
+        self._refreshing: Set[str] = set()
+        self._pool = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix="cache-refresh")
+        self._stats = {"fresh": 0, "stale": 0, "misses": 0, "refreshes": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def lookup(self, key: str) -> Tuple[Optional[Any], str]:
+        """
+        Returns (value, state) with state "fresh", "stale" or "miss" (value None).
+        """
+        record = self.memory.get(key)
+        if record is None and self.disk is not None:
+            try:
+                raw = self.disk.get(key)
+            except sqlite3.Error:
+                raw = None
+            if raw is not None:
+                record = json.loads(raw)
+                self.memory.set(key, record, size=len(raw))
+        now = time.time()
+        if record is not None and now < record["expires"]:
+            self._count("fresh")
+            return record["value"], "fresh"
+        if record is not None and now < record["expires"] + self.stale_ttl:
+            self._count("stale")
+            return record["value"], "stale"
+        self._count("misses")
+        return None, "miss"
+
+    def put(self, key: str, value: Any, negative: bool = False):
+        ttl = self.miss_ttl if negative else self.hit_ttl
+        record = {"value": value, "expires": time.time() + ttl}
+        raw = json.dumps(record, ensure_ascii=False)
+        self.memory.set(key, record, size=len(raw))
+        if self.disk is not None:
+            try:
+                self.disk.set(key, raw, ttl=ttl + self.stale_ttl)
+            except sqlite3.Error:
+                pass
+
+    def refresh(self, key: str, fetch: Callable[[], Any], is_miss: Callable[[Any], bool] = lambda v: not v):
+        """
+        Refetch `key` on the background pool (at most one refresh per key at a time).
+        Fetch errors keep the stale entry.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            self._stats["refreshes"] += 1
+
+        def run():
+            try:
+                value = fetch()
+                self.put(key, value, negative=is_miss(value))
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._pool.submit(run)
+
+    def get_or_fetch(
+        self,
+        key: str,
+        fetch: Callable[[], Any],
+        refresh: Optional[Callable[[], Any]] = None,
+        is_miss: Callable[[Any], bool] = lambda v: not v
+    ) -> Any:
+        """
+        Cached value for `key`, calling `fetch` on a miss (concurrent misses share one
+        call; exceptions propagate and nothing is cached). Stale entries are returned
+        at once and refreshed with `refresh` (defaults to `fetch`).
+        """
+        value, state = self.lookup(key)
+        if state == "stale":
+            self.refresh(key, refresh or fetch, is_miss)
+        if state != "miss":
+            return value
+
+        def load() -> Any:
+            value = fetch()
+            self.put(key, value, negative=is_miss(value))
+            return value
+
+        return self._flight.do(key, load)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            out = dict(self._stats)
+        out["memory_entries"] = len(self.memory)
+        return out
@@ -0,0 +1,250 @@
+import json
+import math
+import os
+import struct
+import threading
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from retrieval import KnowledgeIndex, tokenize
+
+try:
+    import numpy as np
+except ImportError:  # dense retrieval is optional
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking on this platform
+    fcntl = None
+
+DENSE_DIM = 512
+MATRIX_FILE = ".dense_vectors.npy"
+ROWS_FILE = ".dense_rows.jsonl"
+LOCK_FILE = ".dense.lock"
+_HEADER_LEN = 128
+
+
+def _bucket(token: str, dim: int) -> Tuple[int, float]:
+    h = zlib.crc32(token.encode("utf-8"))
+    return h % dim, (1.0 if (h >> 31) & 1 == 0 else -1.0)
+
+
+def encode(text: str, dim: int = DENSE_DIM, idf: Optional[Dict[str, float]] = None):
+    """
+    Hashing-trick embedding: each token is hashed to a signed bucket and weighted by
+    1 + log(tf), optionally times idf. Returns an L2-normalized float32 vector.
+    """
+    vec = np.zeros(dim, dtype=np.float32)
+    for token, tf in Counter(tokenize(text)).items():
+        i, sign = _bucket(token, dim)
+        weight = 1.0 + math.log(tf)
+        if idf is not None:
+            weight *= idf.get(token, 0.0)
+        vec[i] += sign * weight
+    norm = float(np.linalg.norm(vec))
+    if norm > 0:
+        vec /= norm
+    return vec
+
+
+def _write_header(fh, rows: int, dim: int):
+    """
+    Write a .npy v1.0 header padded to a fixed length so the row count can be
+    rewritten in place when rows are appended.
+    """
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, dim)
+    body_len = _HEADER_LEN - 10
+    header = header.ljust(body_len - 1) + "\n"
+    fh.seek(0)
+    fh.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", body_len) + header.encode("latin1"))
+
+
+def _signature(text: str) -> int:
+    return zlib.crc32(text.encode("utf-8"))
+
+
+class DenseIndex:
+    """
+    Dense passage vectors kept in an append-only memory-mapped .npy matrix.
+
+    Row i of the matrix belongs to line i of the rows file ({"pid", "sig"}). Rows whose
+    passage changed or disappeared from the KnowledgeIndex are masked out at query time;
+    new passages are appended without rewriting the existing matrix. Writers in
+    different worker processes take an exclusive lock on .dense.lock and reload the
+    files first, so appends and compactions never interleave.
+    """
+
+    def __init__(self, index: KnowledgeIndex, dim: int = DENSE_DIM, matrix_file: Optional[str] = None, rows_file: Optional[str] = None):
+        if np is None:
+            raise RuntimeError("Dense retrieval requires the 'numpy' package. Install with: pip install numpy")
+        self.index = index
+        self.dim = dim
+        self.matrix_file = matrix_file or os.path.join(index.docs_folder, MATRIX_FILE)
+        self.rows_file = rows_file or os.path.join(index.docs_folder, ROWS_FILE)
+        self.lock_file = os.path.join(os.path.dirname(os.path.abspath(self.matrix_file)), LOCK_FILE)
+        self.rows: List[Dict[str, Any]] = []
+        self._live = None
+        self._matrix = None
+        self._generation = -1
+        self._lock = threading.RLock()
+        self._file_depth = 0
+        self._load()
+        self.sync()
+
+    @contextmanager
+    def _file_lock(self):
+        # re-entrant within a thread holding self._lock (compact() runs sync() under it)
+        if fcntl is None or self._file_depth:
+            self._file_depth += 1
+            try:
+                yield
+            finally:
+                self._file_depth -= 1
+            return
+        with open(self.lock_file, "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            self._file_depth += 1
+            try:
+                yield
+            finally:
+                self._file_depth -= 1
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _load(self):
+        self.rows = []
+        if not os.path.exists(self.rows_file) or not os.path.exists(self.matrix_file):
+            return
+        try:
+            with open(self.rows_file, "r", encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            matrix = np.load(self.matrix_file, mmap_mode="r")
+        except Exception:
+            return
+        if matrix.ndim != 2 or matrix.shape[1] != self.dim:
+            return
+        # a crash between the two appends can leave one side longer; trust the shorter
+        self.rows = rows[:matrix.shape[0]]
+
+    def _open_matrix(self):
+        if not self.rows:
+            self._matrix = None
+            return
+        matrix = np.load(self.matrix_file, mmap_mode="r")
+        self._matrix = matrix[:len(self.rows)]
+
+    def _append(self, items: List[Tuple[str, int, Any]]):
+        if not os.path.exists(self.matrix_file) or not self.rows:
+            with open(self.matrix_file, "wb") as fh:
+                _write_header(fh, 0, self.dim)
+            open(self.rows_file, "w").close()
+        block = np.stack([vec for _, _, vec in items]).astype("<f4")
+        with open(self.matrix_file, "r+b") as fh:
+            fh.seek(_HEADER_LEN + len(self.rows) * self.dim * 4)
+            fh.write(block.tobytes())
+            fh.truncate()
+            _write_header(fh, len(self.rows) + len(items), self.dim)
+        with open(self.rows_file, "a", encoding="utf-8") as f:
+            for pid, sig, _ in items:
+                f.write(json.dumps({"pid": pid, "sig": sig}) + "\n")
+        self.rows.extend({"pid": pid, "sig": sig} for pid, sig, _ in items)
+
+    def sync(self) -> int:
+        """
+        Embed passages the KnowledgeIndex has but the matrix does not, and recompute
+        the live-row mask. Returns the number of appended rows.
+        """
+        with self._lock:
+            self.index.refresh()
+            with self.index._lock:
+                current = {pid: _signature(p["text"]) for pid, p in self.index.passages.items()}
+                texts = {pid: p["text"] for pid, p in self.index.passages.items()}
+                self._generation = self.index.generation
+            with self._file_lock():
+                # another worker may have appended or compacted since we last read the files
+                self._load()
+                stored = {(r["pid"], r["sig"]) for r in self.rows}
+                items = [(pid, sig, encode(texts[pid], self.dim)) for pid, sig in current.items() if (pid, sig) not in stored]
+                if items:
+                    self._append(items)
+            self._live = np.array([current.get(r["pid"]) == r["sig"] for r in self.rows], dtype=bool)
+            self._open_matrix()
+            return len(items)
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[float, str]]:
+        """
+        Score every live row with one matrix-vector product and take the top-k
+        with argpartition. Returns [(score, passage id)] best first.
+        """
+        self.index.refresh()
+        if self.index.generation != self._generation:
+            self.sync()
+        with self._lock:
+            matrix, live, rows = self._matrix, self._live, self.rows
+        if matrix is None or not len(rows):
+            return []
+        idf: Dict[str, float] = {}
+        with self.index._lock:
+            n = max(len(self.index.passages), 1)
+            for term in set(tokenize(query)):
+                df = len(self.index.postings.get(term, {}))
+                idf[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        q = encode(query, self.dim, idf=idf)
+        if not q.any():
+            return []
+        scores = np.asarray(matrix @ q, dtype=np.float32)
+        scores[~live] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), rows[i]["pid"]) for i in top if scores[i] > 0]
+
+    def compact(self):
+        """
+        Rewrite the matrix keeping only live rows.
+        """
+        with self._lock, self._file_lock():
+            self.sync()
+            if self._matrix is None:
+                return
+            keep = np.flatnonzero(self._live)
+            data = np.array(self._matrix[keep], dtype="<f4")
+            rows = [self.rows[i] for i in keep]
+            suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            tmp, tmp_rows = self.matrix_file + suffix, self.rows_file + suffix
+            try:
+                with open(tmp, "wb") as fh:
+                    _write_header(fh, len(rows), self.dim)
+                    fh.write(data.tobytes())
+                with open(tmp_rows, "w", encoding="utf-8") as f:
+                    for r in rows:
+                        f.write(json.dumps(r) + "\n")
+                self._matrix = None
+                os.replace(tmp, self.matrix_file)
+                os.replace(tmp_rows, self.rows_file)
+            finally:
+                for path in (tmp, tmp_rows):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self.rows = rows
+            self._live = np.ones(len(rows), dtype=bool)
+            self._open_matrix()
+
+
+_DENSE: Dict[str, DenseIndex] = {}
+_DENSE_LOCK = threading.Lock()
+
+
+def get_dense_index(index: KnowledgeIndex) -> DenseIndex:
+    """
+    Return the shared dense index for a KnowledgeIndex, syncing it on first use.
+    """
+    key = os.path.abspath(index.docs_folder)
+    with _DENSE_LOCK:
+        dense = _DENSE.get(key)
+        if dense is None:
+            dense = DenseIndex(index)
+            _DENSE[key] = dense
+        return dense
@@ -0,0 +1,316 @@
+import asyncio
+import contextvars
+import copy
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from cache import LRUCache, SingleFlight, cache_key
+
+GRAPH_WORKERS = int(os.getenv("GRAPH_WORKERS", "8"))
+MEMO_SIZE = int(os.getenv("GRAPH_MEMO_SIZE", "512"))
+MEMO_TTL = float(os.getenv("GRAPH_MEMO_TTL", "300"))
+
+_node_trace: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar("node_trace", default=None)
+
+
+class Node:
+    """
+    One step of a Graph. fn is called with the named `inputs` as keyword arguments
+    and returns its single output, or a dict with every name in `outputs`.
+    `after` names values the node waits for without receiving them; `when` sees
+    them along with the inputs and can skip the node (its outputs are then None).
+    memoize=True caches outputs for `memo_ttl` seconds keyed on the input values,
+    which must be JSON-serializable; concurrent identical calls share one execution.
+    `afn` is the coroutine version of fn used by Graph.arun (fn runs on a worker
+    thread there if it is not given).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[..., Any],
+        inputs: Sequence[str],
+        outputs: Sequence[str],
+        when: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        after: Sequence[str] = (),
+        memoize: bool = False,
+        memo_ttl: float = MEMO_TTL,
+        afn: Optional[Callable[..., Awaitable[Any]]] = None
+    ):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.when = when
+        self.after = tuple(after)
+        self.memoize = memoize
+        self.memo_ttl = memo_ttl
+        self.afn = afn
+
+    def __repr__(self) -> str:
+        after = f" after {', '.join(self.after)}" if self.after else ""
+        return f"Node({self.name}: {', '.join(self.inputs)} -> {', '.join(self.outputs)}{after})"
+
+    @property
+    def needs(self) -> Tuple[str, ...]:
+        """
+        Every value that must exist before the node runs: inputs, then `after`.
+        """
+        return self.inputs + tuple(a for a in self.after if a not in self.inputs)
+
+
+class Graph:
+    """
+    Declarative DAG of Nodes. Edges come from matching output and input names;
+    inputs nothing produces must be passed to run(). Nodes whose inputs are all
+    available run concurrently on a shared thread pool (a lone ready node runs in
+    the calling thread); arun() runs them as tasks on the event loop instead. Each
+    run can be traced with node_trace().
+    """
+
+    def __init__(self, nodes: List[Node], workers: int = GRAPH_WORKERS, memo_size: int = MEMO_SIZE):
+        self.nodes = list(nodes)
+        self.producers: Dict[str, Node] = {}
+        for node in self.nodes:
+            for out in node.outputs:
+                if out in self.producers:
+                    raise ValueError(f"output '{out}' is produced by both {self.producers[out].name} and {node.name}")
+                self.producers[out] = node
+        self.inputs: Set[str] = {i for n in self.nodes for i in n.needs if i not in self.producers}
+        self.order = self._toposort()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="graph")
+        self._memo = LRUCache(max_entries=memo_size)
+        self._flight = SingleFlight()
+        self._aflight: Dict[Tuple[int, str], List[Any]] = {}  # (loop, key) -> [task, waiters]
+
+    def _toposort(self) -> List[Node]:
+        order: List[Node] = []
+        state: Dict[str, int] = {}  # 1 = visiting, 2 = done
+
+        def visit(node: Node, path: Tuple[str, ...]):
+            if state.get(node.name) == 2:
+                return
+            if state.get(node.name) == 1:
+                raise ValueError("cycle in graph: " + " -> ".join(path + (node.name,)))
+            state[node.name] = 1
+            for i in node.needs:
+                if i in self.producers:
+                    visit(self.producers[i], path + (node.name,))
+            state[node.name] = 2
+            order.append(node)
+
+        for node in self.nodes:
+            visit(node, ())
+        return order
+
+    def edges(self) -> List[Tuple[str, str, str]]:
+        """
+        (producer, consumer, value name) for every dependency, `after` ones included.
+        """
+        return [(self.producers[i].name, n.name, i) for n in self.order for i in n.needs if i in self.producers]
+
+    def _start(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        missing = self.inputs - set(inputs)
+        if missing:
+            raise ValueError(f"missing graph inputs: {', '.join(sorted(missing))}")
+        return dict(inputs)
+
+    def run(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Execute every node; returns the state (inputs plus all outputs). The first
+        node error is raised once running nodes have finished; nothing new starts
+        after it.
+        """
+        state = self._start(inputs)
+        waiting = list(self.order)
+        running: Dict[Future, Node] = {}
+        started = time.perf_counter()
+        error: Optional[BaseException] = None
+
+        while waiting or running:
+            ready = [n for n in waiting if all(i in state for i in n.needs)] if error is None else []
+            for node in ready:
+                waiting.remove(node)
+            if ready and not running and len(ready) == 1:
+                node = ready[0]
+                try:
+                    state.update(self._execute(node, state, started))
+                except Exception as e:
+                    error = e
+                continue
+            for node in ready:
+                ctx = contextvars.copy_context()
+                running[self._pool.submit(ctx.run, self._execute, node, dict(state), started)] = node
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                try:
+                    state.update(future.result())
+                except Exception as e:
+                    if error is None:
+                        error = e
+        if error is not None:
+            raise error
+        return state
+
+    async def arun(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        run() on the running event loop: each ready node is a task awaiting its afn
+        (or fn on a worker thread). Same error handling; if the caller is cancelled,
+        so are the running nodes.
+        """
+        state = self._start(inputs)
+        waiting = list(self.order)
+        running: Dict["asyncio.Task[Dict[str, Any]]", Node] = {}
+        started = time.perf_counter()
+        error: Optional[BaseException] = None
+        try:
+            while waiting or running:
+                ready = [n for n in waiting if all(i in state for i in n.needs)] if error is None else []
+                for node in ready:
+                    waiting.remove(node)
+                    running[asyncio.ensure_future(self._aexecute(node, dict(state), started))] = node
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    running.pop(task)
+                    try:
+                        state.update(task.result())
+                    except Exception as e:
+                        if error is None:
+                            error = e
+        finally:
+            for task in running:
+                task.cancel()
+        if error is not None:
+            raise error
+        return state
+
+    def _execute(self, node: Node, state: Dict[str, Any], started: float) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        status = "ok"
+        try:
+            args = {i: state[i] for i in node.inputs}
+            if node.when is not None and not node.when({i: state[i] for i in node.needs}):
+                status = "skipped"
+                return {out: None for out in node.outputs}
+            if not node.memoize:
+                return self._call(node, args)
+            key = cache_key(node.name, [args[i] for i in node.inputs])
+            hit = self._memo_hit(key)
+            if hit is not None:
+                status = "memo"
+                return hit
+
+            def compute() -> Dict[str, Any]:
+                outputs = self._call(node, args)
+                self._memo.set(key, (time.monotonic() + node.memo_ttl, outputs))
+                return outputs
+
+            return copy.deepcopy(self._flight.do(key, compute))
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self._trace(node, status, t0, started)
+
+    async def _aexecute(self, node: Node, state: Dict[str, Any], started: float) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        status = "ok"
+        try:
+            args = {i: state[i] for i in node.inputs}
+            if node.when is not None and not node.when({i: state[i] for i in node.needs}):
+                status = "skipped"
+                return {out: None for out in node.outputs}
+            if not node.memoize:
+                return await self._acall(node, args)
+            key = cache_key(node.name, [args[i] for i in node.inputs])
+            hit = self._memo_hit(key)
+            if hit is not None:
+                status = "memo"
+                return hit
+            # tasks belong to one event loop, so calls only coalesce within a loop;
+            # the shared call is cancelled once every caller waiting on it is
+            flight = (id(asyncio.get_running_loop()), key)
+            shared = self._aflight.get(flight)
+            if shared is None:
+                async def compute() -> Dict[str, Any]:
+                    outputs = await self._acall(node, args)
+                    self._memo.set(key, (time.monotonic() + node.memo_ttl, outputs))
+                    return outputs
+
+                task = asyncio.ensure_future(compute())
+                shared = self._aflight[flight] = [task, 0]
+                task.add_done_callback(lambda _: self._aflight.pop(flight, None))
+            shared[1] += 1
+            try:
+                return copy.deepcopy(await asyncio.shield(shared[0]))
+            finally:
+                shared[1] -= 1
+                if not shared[1] and not shared[0].done():
+                    shared[0].cancel()
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self._trace(node, status, t0, started)
+
+    def _memo_hit(self, key: str) -> Optional[Dict[str, Any]]:
+        hit = self._memo.get(key)
+        if hit is not None and hit[0] > time.monotonic():
+            return copy.deepcopy(hit[1])
+        return None
+
+    @staticmethod
+    def _trace(node: Node, status: str, t0: float, started: float):
+        spans = _node_trace.get()
+        if spans is not None:
+            spans.append({
+                "node": node.name,
+                "status": status,
+                "start_ms": round((t0 - started) * 1000, 2),
+                "ms": round((time.perf_counter() - t0) * 1000, 2),
+                "thread": threading.current_thread().name,
+            })
+
+    @staticmethod
+    def _call(node: Node, args: Dict[str, Any]) -> Dict[str, Any]:
+        return Graph._outputs(node, node.fn(**args))
+
+    @staticmethod
+    async def _acall(node: Node, args: Dict[str, Any]) -> Dict[str, Any]:
+        if node.afn is not None:
+            result = await node.afn(**args)
+        else:
+            result = await asyncio.to_thread(node.fn, **args)
+        return Graph._outputs(node, result)
+
+    @staticmethod
+    def _outputs(node: Node, result: Any) -> Dict[str, Any]:
+        if len(node.outputs) == 1:
+            return {node.outputs[0]: result}
+        if not isinstance(result, dict) or set(node.outputs) - set(result):
+            raise TypeError(f"node {node.name} must return a dict with {', '.join(node.outputs)}")
+        return {out: result[out] for out in node.outputs}
+
+
+@contextmanager
+def node_trace() -> Iterator[List[Dict[str, Any]]]:
+    """
+    Collect per-node records for graph runs inside the block:
+    {"node", "status": ok|memo|skipped|error, "start_ms" (from run start), "ms", "thread"}.
+    """
+    spans: List[Dict[str, Any]] = []
+    token = _node_trace.set(spans)
+    try:
+        yield spans
+    finally:
+        _node_trace.reset(token)
@@ -0,0 +1,292 @@
+import glob
+import html
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cache import SingleFlight, cache_key
+from store import SessionStore
+
+EXPORT_FORMAT = 2          # bump when the PDF layout changes, so cached files are rebuilt
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+STORY_WINDOW = 64          # flowables kept ahead of the layout engine
+
+_JOB_RE = re.compile(r"[0-9a-f]+-[0-9a-f]+")
+
+
+def pdf_unavailable() -> Optional[str]:
+    """
+    Error message if reportlab can't be imported, else None.
+    """
+    try:
+        import reportlab  # noqa: F401
+    except Exception as e:
+        return "PDF export requires the 'reportlab' package. Install with: pip install reportlab\n\nError: " + str(e)
+    return None
+
+
+def _md_to_html(s: str) -> str:
+    if not s:
+        return ''
+    converted = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', html.escape(s))
+    # blank lines separate paragraphs, single newlines break lines (the old exporter
+    # split on a literal backslash-n, so real newlines collapsed into spaces)
+    return '<br/><br/>'.join(p.replace('\n', '<br/>') for p in converted.split('\n\n'))
+
+
+def _top_up(story: List[Any], source: Iterator[Any], window: int = STORY_WINDOW):
+    """
+    Refill `story` from `source` once it is down to `window` flowables, up to twice that.
+    """
+    if len(story) >= window:
+        return
+    for f in source:
+        story.append(f)
+        if len(story) >= 2 * window:
+            return
+
+
+def _story(store: SessionStore, name: str, session_ids: List[str]) -> Iterator[Any]:
+    from reportlab.lib.enums import TA_LEFT
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    from reportlab.platypus import Paragraph, Spacer
+
+    styles = getSampleStyleSheet()
+    h1 = ParagraphStyle('Heading1', parent=styles['Heading1'], fontName='Helvetica-Bold', fontSize=16, spaceAfter=8)
+    h2 = ParagraphStyle('sesh', parent=h1, fontSize=12)
+    normal = ParagraphStyle('Normal', parent=styles['Normal'], fontName='Helvetica', fontSize=10, leading=14, alignment=TA_LEFT)
+    small = ParagraphStyle('Small', parent=styles['Normal'], fontName='Helvetica', fontSize=9, leading=12)
+
+    yield Paragraph(f"AI Research Assistant — History for {html.escape(name)}", h1)
+    yield Paragraph(f"Exported: {datetime.utcnow().isoformat()}Z", small)
+    yield Spacer(1, 12)
+
+    for s_id in session_ids:
+        yield Paragraph(f"Session: {html.escape(s_id)}", h2)
+        yield Spacer(1, 6)
+        empty = True
+        for entry in store.iter_entries(s_id):
+            empty = False
+            ts = entry.get('timestamp', '')
+            yield Paragraph(f"<b>{html.escape(ts)}</b> — Query: {_md_to_html(entry.get('query', ''))}", normal)
+            yield Spacer(1, 4)
+            yield Paragraph(f"<b>Summary:</b> {_md_to_html(entry.get('summary') or '')}", normal)
+            yield Spacer(1, 8)
+        if empty:
+            yield Paragraph("(no entries)", normal)
+            yield Spacer(1, 8)
+        yield Spacer(1, 10)
+
+
+def render_pdf(store: SessionStore, name: str, session_ids: List[str], out: Any, lazy: bool = True):
+    """
+    Write the history PDF for `session_ids` to `out` (path or binary file object).
+    With lazy=False the whole story is built in memory first (the old behaviour;
+    kept for the benchmark).
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate
+
+    source = _story(store, name, session_ids)
+    story: List[Any] = []
+    if lazy:
+        _top_up(story, source)
+    else:
+        story = list(source)
+
+    class StreamingDocTemplate(SimpleDocTemplate):
+        # build() lays out the story one handle_flowable() call at a time, popping
+        # from the front of the list it was given; refill that list after each call
+        # (handle_flowable also sees reportlab's own lists, which are left alone)
+        def handle_flowable(self, flowables):
+            super().handle_flowable(flowables)
+            if lazy and flowables is story:
+                _top_up(story, source)
+
+    doc = StreamingDocTemplate(out, pagesize=letter,
+                               leftMargin=0.7*inch, rightMargin=0.7*inch,
+                               topMargin=0.7*inch, bottomMargin=0.7*inch)
+    doc.build(story)
+
+
+class PdfExporter:
+    """
+    History PDFs cached on disk per user, keyed by an etag over the user's session
+    logs (ids, sizes, mtimes), so a repeat download of an unchanged history is a
+    file send. Exports can run synchronously (concurrent requests for the same
+    version share one render) or as background jobs polled via status().
+    """
+
+    def __init__(self, store: SessionStore, root: Optional[str] = None, workers: int = EXPORT_WORKERS):
+        self.store = store
+        self.root = os.path.abspath(root or os.path.join(store.root, "exports"))
+        os.makedirs(self.root, exist_ok=True)
+        self._flight = SingleFlight()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-export")
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def version(self, name: str) -> Tuple[List[str], str]:
+        """
+        (session ids, etag) for a user's current history. Stats files only.
+        """
+        session_ids = self.store.sessions_for_name(name)
+        etag = cache_key(EXPORT_FORMAT, name, [(sid, self.store.version(sid)) for sid in session_ids])[:32]
+        return session_ids, etag
+
+    def _user_key(self, name: str) -> str:
+        return cache_key(name)[:16]
+
+    def path(self, name: str, etag: str) -> str:
+        return os.path.join(self.root, f"{self._user_key(name)}-{etag}.pdf")
+
+    def job_id(self, name: str, etag: str) -> str:
+        return f"{self._user_key(name)}-{etag}"
+
+    def cached(self, name: str, etag: str) -> Optional[str]:
+        path = self.path(name, etag)
+        return path if os.path.exists(path) else None
+
+    def export(self, name: str, session_ids: List[str], etag: str) -> str:
+        """
+        Path of the PDF for this history version, rendering it if needed.
+        """
+        path = self.path(name, etag)
+        if os.path.exists(path):
+            return path
+        return self._flight.do(path, lambda: self._render(name, session_ids, etag))
+
+    def _render(self, name: str, session_ids: List[str], etag: str) -> str:
+        path = self.path(name, etag)
+        if os.path.exists(path):
+            return path
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            render_pdf(self.store, name, session_ids, tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        # older versions of this user's export are no longer reachable
+        for old in glob.glob(os.path.join(self.root, f"{self._user_key(name)}-*.pdf")):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        return path
+
+    def start(self, name: str, session_ids: List[str], etag: str) -> Dict[str, Any]:
+        """
+        Queue a background export (no-op if it is cached or already queued).
+        """
+        job = self.job_id(name, etag)
+        with self._lock:
+            if self.cached(name, etag) or self._jobs.get(job, {}).get("status") in ("queued", "running"):
+                return self.status(job)
+            self._jobs[job] = {"job": job, "status": "queued", "name": name}
+
+        def run():
+            with self._lock:
+                self._jobs[job]["status"] = "running"
+            try:
+                self.export(name, session_ids, etag)
+                state = {"status": "done"}
+            except Exception as e:
+                state = {"status": "error", "error": str(e)}
+            with self._lock:
+                self._jobs[job].update(state)
+
+        self._pool.submit(run)
+        return self.status(job)
+
+    def status(self, job: str) -> Dict[str, Any]:
+        """
+        {"job", "status": queued|running|done|error|unknown, ...}. A cached file counts
+        as done even if the job ran in another worker process.
+        """
+        with self._lock:
+            info = dict(self._jobs.get(job) or {"job": job, "status": "unknown"})
+        if not _JOB_RE.fullmatch(job):
+            return info
+        if info["status"] != "error" and os.path.exists(os.path.join(self.root, f"{job}.pdf")):
+            info["status"] = "done"
+        info.pop("name", None)
+        return info
+
+
+def _timed_render(store: SessionStore, name: str, session_ids: List[str], out: str, lazy: bool) -> Dict[str, Any]:
+    # render in a forked child so each mode's peak RSS is measured on its own
+    import time
+    started = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            render_pdf(store, name, session_ids, out, lazy=lazy)
+            code = 0
+        finally:
+            os._exit(code)
+    _, status, usage = os.wait4(pid, 0)
+    if status:
+        raise RuntimeError(f"render failed in child (status {status})")
+    return {"seconds": round(time.perf_counter() - started, 2),
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+            "pdf_mb": round(os.path.getsize(out) / 2**20, 2)}
+
+
+def benchmark(entries: int = 10_000, sessions: int = 4, root: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Export a synthetic history of `entries` entries: in-memory story (old path) vs
+    incremental story, then a cached repeat. Reports seconds and peak RSS per mode.
+    """
+    import shutil
+    import tempfile
+    import time
+
+    root = root or tempfile.mkdtemp(prefix="export-bench-")
+    store = SessionStore(root, legacy_file=None, compact_interval=0)
+    sentence = "Retrieval-augmented generation grounds the **answer** in retrieved passages. "
+    for i in range(entries):
+        store.append_entry(f"bench-{i % sessions}", {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "query": f"How do I implement step {i} of the pipeline?",
+            "summary": sentence * 4 + "\n\n" + sentence * 2,
+            "plan": None,
+            "mode": "retrieval",
+            "user": {"name": "bench"},
+        })
+    exporter = PdfExporter(store)
+    session_ids, etag = exporter.version("bench")
+    out: Dict[str, Any] = {"entries": entries, "sessions": len(session_ids)}
+    for label, lazy in (("in_memory", False), ("incremental", True)):
+        out[label] = _timed_render(store, "bench", session_ids, os.path.join(root, f"{label}.pdf"), lazy)
+
+    # the cached path: first export renders, the repeat only stats the logs
+    exporter.export("bench", session_ids, etag)
+    t = time.perf_counter()
+    exporter.export("bench", *exporter.version("bench"))
+    out["cached_export_ms"] = round((time.perf_counter() - t) * 1000, 2)
+    shutil.rmtree(root, ignore_errors=True)
+    return out
+
+
+if __name__ == "__main__":
+    import argparse, json, sys
+    parser = argparse.ArgumentParser(description="History PDF export tools")
+    parser.add_argument("--bench", action="store_true", help="Benchmark exporting a synthetic history.")
+    parser.add_argument("--entries", type=int, default=10_000)
+    parser.add_argument("--sessions", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.bench:
+        missing = pdf_unavailable()
+        if missing:
+            sys.exit(missing)
+        print(json.dumps(benchmark(args.entries, args.sessions), indent=2))
+    else:
+        parser.print_help()
@@ -1,141 +1,430 @@
-import json
+import asyncio
+import contextvars
 import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
-import requests
-import wikipedia
+import metrics
+import net
+from budget import estimate_tokens, fit
+from cache import LRUCache, SingleFlight, SQLiteCache, SWRCache, cache_key
+from engine import Graph, Node, node_trace
+from LLM import acall_llama, call_llama, call_llama_stream
+from retrieval import KnowledgeIndex, get_index
+from memory import ConversationMemory
+from store import SessionStore, get_store
+from wikidump import get_wiki_dump
 
-from LLM import call_llama
+T = TypeVar("T")
 
-STATE_FILE = "state.json"
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "bm25")
+PLAN_KEYWORDS = ("plan", "action", "next step", "how to", "implement")
+RETRIEVAL_DEADLINE = float(os.getenv("RETRIEVAL_DEADLINE", "6"))
+DDG_URL = os.getenv("DDG_URL", "https://api.duckduckgo.com/")
+WIKIPEDIA_API_URL = os.getenv("WIKIPEDIA_API_URL", "https://en.wikipedia.org/w/api.php")
+# ask for summary and plan in one completion when the query wants a plan
+FUSED_PLAN = os.getenv("FUSED_PLAN", "1") != "0"
+FUSED_SUMMARY_MARK = "### SUMMARY"
+FUSED_PLAN_MARK = "### PLAN"
+
+# set by ResearchGraph.run_stream: the LLM nodes stream their tokens to it
+_STREAM: contextvars.ContextVar[Optional[Callable[[Dict[str, Any]], None]]] = contextvars.ContextVar("graph_stream", default=None)
+
+_EXTERNAL_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+# identical retrievals already in flight (e.g. within a batch) share one lookup
+_RETRIEVAL_FLIGHT = SingleFlight()
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+
+# Wikipedia / DuckDuckGo answers by (source, normalized query). Misses expire sooner
+# than hits; expired entries are served for RETRIEVAL_STALE_TTL more seconds while
+# refreshed in the background. RETRIEVAL_CACHE_DB keeps them across restarts.
+_EXTERNAL_CACHE = SWRCache(
+    LRUCache(max_entries=int(os.getenv("RETRIEVAL_CACHE_SIZE", "2048"))),
+    SQLiteCache(os.environ["RETRIEVAL_CACHE_DB"], table="retrieval") if os.getenv("RETRIEVAL_CACHE_DB") else None,
+    hit_ttl=float(os.getenv("RETRIEVAL_HIT_TTL", "21600")),
+    miss_ttl=float(os.getenv("RETRIEVAL_MISS_TTL", "900")),
+    stale_ttl=float(os.getenv("RETRIEVAL_STALE_TTL", "86400")),
+)
+
+
+def _external_key(source: str, query: str) -> str:
+    return cache_key(source, " ".join(query.lower().split()))
+
+
+async def _acached(
+    source: str,
+    query: str,
+    afetch: Callable[[], Awaitable[List[Dict[str, str]]]],
+    refresh: Callable[[], List[Dict[str, str]]]
+) -> List[Dict[str, str]]:
+    """
+    _EXTERNAL_CACHE.get_or_fetch for the async path: misses await `afetch`,
+    stale entries are refreshed with the blocking `refresh` on the cache's pool.
+    """
+    key = _external_key(source, query)
+    value, state = _EXTERNAL_CACHE.lookup(key)
+    if state == "stale":
+        _EXTERNAL_CACHE.refresh(key, refresh)
+    if state != "miss":
+        return value
+    value = await afetch()
+    _EXTERNAL_CACHE.put(key, value, negative=not value)
+    return value
+
+
+def external_cache_stats() -> Dict[str, int]:
+    return _EXTERNAL_CACHE.stats()
+
+
+metrics.gauges("retrieval_cache", "Wikipedia/DuckDuckGo cache counters (fresh, stale, misses, refreshes, entries).", "stat", external_cache_stats)
 
 
 def load_state() -> Dict[str, Any]:
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"sessions": {}}
+    """
+    Return every session in the legacy {"sessions": {...}} shape.
+    Reads all logs; request paths should use the SessionStore directly.
+    """
+    return get_store().load_all()
 
 
 def save_state(state: Dict[str, Any]):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2, ensure_ascii=False)
+    get_store().replace_all(state)
 
 
-def _ddg_instant_answer(query: str) -> List[Dict[str, str]]:
+def _ddg_docs(query: str, data: Dict[str, Any]) -> List[Dict[str, str]]:
+    docs: List[Dict[str, str]] = []
+
+    abstract = data.get("AbstractText", "") or data.get("Answer", "")
+    if abstract:
+        docs.append({"id": "ddg_abstract", "title": f"DuckDuckGo: {query}", "text": abstract})
+
+    related = data.get("RelatedTopics", []) or []
+    count = 0
+    for item in related:
+        if isinstance(item, dict):
+            text = item.get("Text") or item.get("Result") or ""
+            name = item.get("Name") or ""
+            if text:
+                docs.append({"id": f"ddg_rel_{count}", "title": name or f"Related {count}", "text": text})
+                count += 1
+            if count >= 2:
+                break
+    return docs
+
+
+def _ddg_params(query: str) -> Dict[str, Any]:
+    return {"q": query, "format": "json", "no_html": 1, "skip_disambig": 1}
+
+
+def _ddg_fetch(query: str, timeout: Optional[float] = None, deadline: Optional[float] = None) -> List[Dict[str, str]]:
+    r = net.request("ddg", "GET", DDG_URL, params=_ddg_params(query), timeout=timeout, deadline=deadline)
+    r.raise_for_status()
+    return _ddg_docs(query, r.json())
+
+
+async def _addg_fetch(query: str, deadline: Optional[float] = None) -> List[Dict[str, str]]:
+    r = await net.arequest("ddg", "GET", DDG_URL, params=_ddg_params(query), deadline=deadline)
+    r.raise_for_status()
+    return _ddg_docs(query, r.json())
+
+
+@metrics.timed("retrieve.ddg")
+def _ddg_instant_answer(query: str, timeout: Optional[float] = None, deadline: Optional[float] = None) -> List[Dict[str, str]]:
     """
     Call DuckDuckGo Instant Answer (no API key). Returns a small list of docs (may be empty).
+    Answers, including empty ones, are cached (see _EXTERNAL_CACHE).
     """
     try:
-        url = "https://api.duckduckgo.com/"
-        params = {"q": query, "format": "json", "no_html": 1, "skip_disambig": 1}
-        r = requests.get(url, params=params, timeout=8)
-        r.raise_for_status()
-        data = r.json()
-        docs: List[Dict[str, str]] = []
-
-        abstract = data.get("AbstractText", "") or data.get("Answer", "")
-        if abstract:
-            docs.append({"id": "ddg_abstract", "title": f"DuckDuckGo: {query}", "text": abstract})
-
-        related = data.get("RelatedTopics", []) or []
-        count = 0
-        for item in related:
-            if isinstance(item, dict):
-                text = item.get("Text") or item.get("Result") or ""
-                name = item.get("Name") or ""
-                if text:
-                    docs.append({"id": f"ddg_rel_{count}", "title": name or f"Related {count}", "text": text})
-                    count += 1
-                if count >= 2:
-                    break
-        return docs
+        return _EXTERNAL_CACHE.get_or_fetch(
+            _external_key("ddg", query),
+            lambda: _ddg_fetch(query, timeout=timeout, deadline=deadline),
+            refresh=lambda: _ddg_fetch(query),
+        )
     except Exception:
         return []
 
 
-def _wiki_summary(query: str) -> List[Dict[str, str]]:
+@metrics.timed("retrieve.ddg")
+async def _addg_instant_answer(query: str, deadline: Optional[float] = None) -> List[Dict[str, str]]:
+    try:
+        return await _acached("ddg", query, lambda: _addg_fetch(query, deadline=deadline), lambda: _ddg_fetch(query))
+    except Exception:
+        return []
+
+
+def _wiki_search_params(query: str) -> Dict[str, Any]:
+    return {"action": "query", "list": "search", "srsearch": query, "srlimit": 3, "srprop": "", "format": "json"}
+
+
+def _wiki_extract_params(title: str) -> Dict[str, Any]:
+    return {
+        "action": "query", "prop": "extracts|pageprops", "explaintext": 1, "exsentences": 3,
+        "redirects": 1, "titles": title, "format": "json",
+    }
+
+
+def _wiki_top_title(data: Dict[str, Any]) -> Optional[str]:
+    hits = data.get("query", {}).get("search", [])
+    return hits[0]["title"] if hits else None
+
+
+def _wiki_doc(title: str, data: Dict[str, Any]) -> List[Dict[str, str]]:
+    pages = data.get("query", {}).get("pages", {})
+    page = next(iter(pages.values()), {})
+    if "missing" in page or "disambiguation" in (page.get("pageprops") or {}):
+        return []
+    summary = page.get("extract") or ""
+    if not summary:
+        return []
+    return [{"id": f"wiki:{title}", "title": f"Wikipedia: {title}", "text": summary}]
+
+
+def _wiki_fetch(query: str, deadline: Optional[float] = None) -> List[Dict[str, str]]:
+    r = net.request("wikipedia", "GET", WIKIPEDIA_API_URL, params=_wiki_search_params(query), deadline=deadline)
+    r.raise_for_status()
+    title = _wiki_top_title(r.json())
+    if not title:
+        return []
+    r = net.request("wikipedia", "GET", WIKIPEDIA_API_URL, params=_wiki_extract_params(title), deadline=deadline)
+    r.raise_for_status()
+    return _wiki_doc(title, r.json())
+
+
+async def _awiki_fetch(query: str, deadline: Optional[float] = None) -> List[Dict[str, str]]:
+    r = await net.arequest("wikipedia", "GET", WIKIPEDIA_API_URL, params=_wiki_search_params(query), deadline=deadline)
+    r.raise_for_status()
+    title = _wiki_top_title(r.json())
+    if not title:
+        return []
+    r = await net.arequest("wikipedia", "GET", WIKIPEDIA_API_URL, params=_wiki_extract_params(title), deadline=deadline)
+    r.raise_for_status()
+    return _wiki_doc(title, r.json())
+
+
+@metrics.timed("retrieve.wikipedia")
+def _wiki_summary(query: str, deadline: Optional[float] = None) -> List[Dict[str, str]]:
     """
-    Attempt Wikipedia lookup. Returns a single doc with the page summary if found, else [].
+    Attempt Wikipedia lookup (MediaWiki API: top search hit, then its first 3 sentences).
+    Returns a single doc with the page summary if found, else [] (also for disambiguation pages).
+    Answers, including misses, are cached (see _EXTERNAL_CACHE).
+    With WIKI_DUMP_DIR pointing at an ingested dump (wikidump.py), the local index
+    answers instead and the network is not used (unless the dump can't be read).
     """
     try:
-        titles = wikipedia.search(query, results=3)
-        if not titles:
-            return []
-        title = titles[0]
-        summary = wikipedia.summary(title, sentences=3, auto_suggest=False)
-        return [{"id": f"wiki:{title}", "title": f"Wikipedia: {title}", "text": summary}]
+        dump = get_wiki_dump()
+        if dump is not None:
+            return dump.lookup(query, k=1)
+    except Exception:
+        pass  # incompatible or half-written dump: use the API
+    try:
+        return _EXTERNAL_CACHE.get_or_fetch(
+            _external_key("wikipedia", query),
+            lambda: _wiki_fetch(query, deadline=deadline),
+            refresh=lambda: _wiki_fetch(query),
+        )
     except Exception:
         return []
 
 
-def retriever_node(query: str, k: int = 3, docs_folder: str = "knowledge") -> List[Dict[str, str]]:
+@metrics.timed("retrieve.wikipedia")
+async def _awiki_summary(query: str, deadline: Optional[float] = None) -> List[Dict[str, str]]:
+    try:
+        dump = get_wiki_dump()
+        if dump is not None:
+            return await asyncio.to_thread(dump.lookup, query, 1)
+    except Exception:
+        pass  # incompatible or half-written dump: use the API
+    try:
+        return await _acached("wikipedia", query, lambda: _awiki_fetch(query, deadline=deadline), lambda: _wiki_fetch(query))
+    except Exception:
+        return []
+
+
+def _merge_docs(results: List[Dict[str, str]], docs: List[Dict[str, str]], k: int) -> bool:
     """
-    Enhanced retriever:
-      1) Prefer local knowledge files (token overlap ranking).
-      2) If local results < k, call Wikipedia for a short summary.
-      3) If still fewer, call DuckDuckGo Instant Answer and return those snippets.
-      4) Final fallback: mocked docs.
+    Append docs not already in results. Returns True once results holds k docs.
     """
-    results: List[Dict[str, str]] = []
+    for d in docs:
+        if all(d["id"] != ex["id"] for ex in results):
+            results.append(d)
+        if len(results) >= k:
+            return True
+    return len(results) >= k
+
 
-    if os.path.isdir(docs_folder):
-        files = [f for f in os.listdir(docs_folder) if f.lower().endswith(".txt")]
-        scores: List[tuple] = []
-        qtokens = set(query.lower().split())
-        for fname in files:
-            path = os.path.join(docs_folder, fname)
+def _fetch_external(query: str, results: List[Dict[str, str]], k: int, deadline: float) -> List[Dict[str, str]]:
+    """
+    Query Wikipedia and DuckDuckGo concurrently under one deadline.
+    Docs are merged in priority order (Wikipedia first) as each source finishes;
+    sources still running when the deadline passes are abandoned.
+    """
+    started = time.monotonic()
+    until = started + deadline
+    sources: List[Callable[[], List[Dict[str, str]]]] = [
+        lambda: _wiki_summary(query, deadline=until),
+        lambda: _ddg_instant_answer(query, deadline=until),
+    ]
+    # each source runs in a copy of this context so its spans land in the caller's trace
+    futures = [_EXTERNAL_POOL.submit(contextvars.copy_context().run, fn) for fn in sources]
+    merged = 0
+    pending = set(futures)
+    while merged < len(futures):
+        # merge the finished prefix so priority order is kept
+        while merged < len(futures) and futures[merged].done():
             try:
-                with open(path, "r", encoding="utf-8", errors="ignore") as fh:
-                    text = fh.read()
+                docs = futures[merged].result()
             except Exception:
-                text = ""
-            score = len(qtokens.intersection(set(text.lower().split())))
-            scores.append((score, fname, text))
-        scores.sort(reverse=True)
-        for score, fname, text in scores[:k]:
-            if text.strip():
-                results.append({"id": fname, "title": fname, "text": text[:2000]})
+                docs = []
+            merged += 1
+            if _merge_docs(results, docs, k):
+                break
+        if len(results) >= k or merged == len(futures):
+            break
+        remaining = deadline - (time.monotonic() - started)
+        if remaining <= 0:
+            break
+        pending = {f for f in pending if not f.done()}
+        wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+
+    if merged < len(futures):
+        # a lower-priority source may have answered while a higher one is still stuck
+        for f in futures[merged:]:
+            if f.done() and not f.cancelled():
+                try:
+                    docs = f.result()
+                except Exception:
+                    docs = []
+                if _merge_docs(results, docs, k):
+                    break
+            else:
+                f.cancel()
+    return results
+
+
+async def _afetch_external(query: str, results: List[Dict[str, str]], k: int, deadline: float) -> List[Dict[str, str]]:
+    """
+    Async _fetch_external: same priority merge, but stragglers are actually cancelled.
+    """
+    until = time.monotonic() + deadline
+    tasks = [
+        asyncio.ensure_future(_awiki_summary(query, deadline=until)),
+        asyncio.ensure_future(_addg_instant_answer(query, deadline=until)),
+    ]
+    try:
+        merged = 0
+        while merged < len(tasks):
+            while merged < len(tasks) and tasks[merged].done():
+                docs = tasks[merged].result() if not tasks[merged].cancelled() else []
+                merged += 1
+                if _merge_docs(results, docs, k):
+                    return results
+            remaining = until - time.monotonic()
+            if merged == len(tasks) or remaining <= 0:
+                break
+            await asyncio.wait([t for t in tasks if not t.done()], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        for t in tasks[merged:]:
+            if t.done() and not t.cancelled() and _merge_docs(results, t.result(), k):
+                break
+        return results
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+
+
+@metrics.timed("retrieve.local")
+def _local_docs(query: str, k: int, docs_folder: str, index: Optional[KnowledgeIndex], mode: str) -> List[Dict[str, str]]:
+    results: List[Dict[str, str]] = []
+    if index is None and os.path.isdir(docs_folder):
+        index = get_index(docs_folder)
+    if index is not None:
+        if mode == "dense":
+            from dense import get_dense_index
+            hits = get_dense_index(index).search(query, k=k)
+        else:
+            hits = index.search(query, k=k)
+        for score, pid in hits:
+            doc = index.passage(pid)
+            if doc:
+                results.append(doc)
+    return results
+
+
+def _mock_docs(query: str) -> List[Dict[str, str]]:
+    base = query.strip().split()[:3]
+    key = " ".join(base) if base else query
+    return [
+        {"id": "doc1", "title": f"{key} — intro", "text": f"Intro about {key}. Keep it short and actionable."},
+        {"id": "doc2", "title": f"{key} — use-cases", "text": f"Common use cases and quick examples for {key}."},
+        {"id": "doc3", "title": f"{key} — tips", "text": f"Helpful tips: split tasks, persist state, and iterate quickly."},
+    ]
+
+
+@metrics.timed("retrieve")
+def retriever_node(
+    query: str,
+    k: int = 3,
+    docs_folder: str = "knowledge",
+    index: Optional[KnowledgeIndex] = None,
+    mode: str = RETRIEVAL_MODE,
+    deadline: float = RETRIEVAL_DEADLINE
+) -> List[Dict[str, str]]:
+    """
+    Enhanced retriever:
+      1) Prefer local knowledge passages (BM25 ranking via the inverted index,
+         or hashed-embedding similarity when mode="dense").
+      2) If local results < k, query Wikipedia and DuckDuckGo Instant Answer in parallel,
+         keeping whatever arrives within `deadline` seconds (Wikipedia docs first).
+      3) Final fallback: mocked docs.
+    Concurrent calls for the same query share one lookup.
+    """
+    def retrieve() -> List[Dict[str, str]]:
+        results = _local_docs(query, k, docs_folder, index, mode)
         if len(results) >= k:
             return results[:k]
 
-    try:
-        wiki_docs = _wiki_summary(query)
-        for d in wiki_docs:
-            if all(d["id"] != ex["id"] for ex in results):
-                results.append(d)
-            if len(results) >= k:
-                return results[:k]
-    except Exception:
-        pass
+        _fetch_external(query, results, k, deadline)
 
-    try:
-        ddg_docs = _ddg_instant_answer(query)
-        for d in ddg_docs:
-            if all(d["id"] != ex["id"] for ex in results):
-                results.append(d)
-            if len(results) >= k:
-                return results[:k]
-    except Exception:
-        pass
+        if not results:
+            return _mock_docs(query)
+        return results[:k]
+
+    key = cache_key(query, k, os.path.abspath(docs_folder), mode)
+    return list(_RETRIEVAL_FLIGHT.do(key, retrieve))
+
+
+@metrics.timed("retrieve")
+async def aretriever_node(
+    query: str,
+    k: int = 3,
+    docs_folder: str = "knowledge",
+    index: Optional[KnowledgeIndex] = None,
+    mode: str = RETRIEVAL_MODE,
+    deadline: float = RETRIEVAL_DEADLINE
+) -> List[Dict[str, str]]:
+    """
+    Async retriever_node: the local index search runs in a worker thread, external
+    lookups run as tasks on the event loop.
+    """
+    results = await asyncio.to_thread(_local_docs, query, k, docs_folder, index, mode)
+    if len(results) >= k:
+        return results[:k]
+
+    await _afetch_external(query, results, k, deadline)
 
     if not results:
-        base = query.strip().split()[:3]
-        key = " ".join(base) if base else query
-        return [
-            {"id": "doc1", "title": f"{key} — intro", "text": f"Intro about {key}. Keep it short and actionable."},
-            {"id": "doc2", "title": f"{key} — use-cases", "text": f"Common use cases and quick examples for {key}."},
-            {"id": "doc3", "title": f"{key} — tips", "text": f"Helpful tips: split tasks, persist state, and iterate quickly."},
-        ]
+        return _mock_docs(query)
     return results[:k]
 
 
-def summarizer_node(query: str, docs: List[Dict[str, str]], context: str = "", chat_mode: bool = False) -> Dict[str, str]:
+def _summary_prompt(query: str, docs: List[Dict[str, str]], context: str = "", chat_mode: bool = False) -> Tuple[str, int, str]:
     """
-    If chat_mode=True -> answer directly using the LLM (chatbot-style).
-    Otherwise -> perform retrieval-augmented summarization (use docs).
-    Returns dict with keys: 'summary' and 'mode' ('chat' | 'retrieval' | 'fallback').
+    Build the summarizer prompt. Returns (prompt, max_tokens, mode).
     """
     if chat_mode:
         prompt = (
@@ -143,12 +432,8 @@ def summarizer_node(query: str, docs: List[Dict[str, str]], context: str = "", c
             f"User question: {query}\n\n"
             "If you're uncertain, say so and suggest where to verify."
         )
-        if context:
-            prompt = f"Previous context: {context}\n\n" + prompt
-        answer = call_llama(prompt, max_tokens=300, temperature=0.2)
-        return {"summary": answer, "mode": "chat"}
-
-    if docs and len(docs) > 0:
+        max_tokens, mode = 300, "chat"
+    elif docs and len(docs) > 0:
         joined = "\n\n".join(f"{d['title']}: {d['text']}" for d in docs)
         prompt = (
             f"Summarize the following documents concisely for the user who asked: '{query}'\n\n"
@@ -156,34 +441,231 @@ def summarizer_node(query: str, docs: List[Dict[str, str]], context: str = "", c
             "Provide a short (2-3 sentence) summary, followed by a 3-item actionable plan. "
             "Mark uncertainties if facts are unclear.\n\n"
         )
-        if context:
-            prompt = f"Previous context: {context}\n\n" + prompt
-        summary = call_llama(prompt, max_tokens=250, temperature=0.2)
-        return {"summary": summary, "mode": "retrieval"}
+        max_tokens, mode = 250, "retrieval"
     else:
         prompt = (
             f"You are a helpful assistant. Answer the user's question concisely.\n\n"
             f"User question: {query}\n\n"
             "If you're uncertain, say so and suggest where to verify."
         )
-        if context:
-            prompt = f"Previous context: {context}\n\n" + prompt
-        answer = call_llama(prompt, max_tokens=300, temperature=0.2)
-        return {"summary": answer, "mode": "fallback"}
+        max_tokens, mode = 300, "fallback"
+    if context:
+        prompt = f"Previous context: {context}\n\n" + prompt
+    return prompt, max_tokens, mode
 
 
-def planner_node(summary_text: str) -> Dict[str, Any]:
-    prompt = (
+@metrics.timed("llm.summarize")
+def summarizer_node(query: str, docs: List[Dict[str, str]], context: str = "", chat_mode: bool = False) -> Dict[str, str]:
+    """
+    If chat_mode=True -> answer directly using the LLM (chatbot-style).
+    Otherwise -> perform retrieval-augmented summarization (use docs).
+    Returns dict with keys: 'summary' and 'mode' ('chat' | 'retrieval' | 'fallback').
+    """
+    prompt, max_tokens, mode = _summary_prompt(query, docs, context, chat_mode)
+    summary = call_llama(prompt, max_tokens=max_tokens, temperature=0.2)
+    return {"summary": summary, "mode": mode}
+
+
+@metrics.timed("llm.summarize")
+async def asummarizer_node(query: str, docs: List[Dict[str, str]], context: str = "", chat_mode: bool = False) -> Dict[str, str]:
+    prompt, max_tokens, mode = _summary_prompt(query, docs, context, chat_mode)
+    summary = await acall_llama(prompt, max_tokens=max_tokens, temperature=0.2)
+    return {"summary": summary, "mode": mode}
+
+
+def summarizer_node_stream(
+    query: str,
+    docs: List[Dict[str, str]],
+    context: str = "",
+    chat_mode: bool = False
+) -> Tuple[str, Iterator[str]]:
+    """
+    Streaming summarizer_node. Returns (mode, iterator of text deltas).
+    """
+    prompt, max_tokens, mode = _summary_prompt(query, docs, context, chat_mode)
+    return mode, call_llama_stream(prompt, max_tokens=max_tokens, temperature=0.2)
+
+
+def _plan_prompt(summary_text: str) -> str:
+    return (
         f"Given the short summary below, produce a concise 3-step implementation plan (each step 10-25 words).\n\n"
         f"Summary:\n{summary_text}\n\nPlan:"
     )
-    plan_out = call_llama(prompt, max_tokens=200, temperature=0.2)
+
+
+@metrics.timed("llm.plan")
+def planner_node(summary_text: str) -> Dict[str, Any]:
+    plan_out = call_llama(_plan_prompt(summary_text), max_tokens=200, temperature=0.2)
+    return {"plan": plan_out}
+
+
+@metrics.timed("llm.plan")
+async def aplanner_node(summary_text: str) -> Dict[str, Any]:
+    plan_out = await acall_llama(_plan_prompt(summary_text), max_tokens=200, temperature=0.2)
     return {"plan": plan_out}
 
 
+def planner_node_stream(summary_text: str) -> Iterator[str]:
+    return call_llama_stream(_plan_prompt(summary_text), max_tokens=200, temperature=0.2)
+
+
+def _stream_tokens(field: str, tokens: Iterator[str], emit: Callable[[Dict[str, Any]], None]) -> str:
+    """
+    Pass each delta to `emit` as a token event for `field`; returns the full text.
+    """
+    parts: List[str] = []
+    for text in tokens:
+        parts.append(text)
+        emit({"event": "token", "field": field, "text": text})
+    return "".join(parts)
+
+
+def _fused_prompt(query: str, docs: List[Dict[str, str]], context: str = "", chat_mode: bool = False) -> Tuple[str, int, str]:
+    """
+    Summary prompt plus planner instructions, answered in two delimited sections.
+    """
+    prompt, max_tokens, mode = _summary_prompt(query, docs, context, chat_mode)
+    prompt += (
+        "\n\nAfter the answer, also produce a concise 3-step implementation plan (each step 10-25 words).\n"
+        "Reply in exactly this format and nothing else:\n"
+        f"{FUSED_SUMMARY_MARK}\n<the answer>\n{FUSED_PLAN_MARK}\n1. ...\n2. ...\n3. ..."
+    )
+    return prompt, max_tokens + 200, mode
+
+
+def _split_fused(text: str) -> Optional[Tuple[str, str]]:
+    """
+    Parse a fused completion into (summary, plan); None if either section is missing.
+    """
+    s = text.find(FUSED_SUMMARY_MARK)
+    p = text.find(FUSED_PLAN_MARK, s + 1 if s >= 0 else 0)
+    if s < 0 or p < 0:
+        return None
+    summary = text[s + len(FUSED_SUMMARY_MARK):p].strip()
+    plan = text[p + len(FUSED_PLAN_MARK):].strip()
+    if not summary or not plan:
+        return None
+    return summary, plan
+
+
+@metrics.timed("llm.fused")
+def fused_node(query: str, docs: List[Dict[str, str]], context: str = "", chat_mode: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Summarizer and planner in a single LLM call. Returns the same fields as
+    summarizer_node plus 'plan' ({"plan": text}, as planner_node), or None if the
+    reply could not be split (callers fall back to the two-call path).
+    """
+    prompt, max_tokens, mode = _fused_prompt(query, docs, context, chat_mode)
+    parts = _split_fused(call_llama(prompt, max_tokens=max_tokens, temperature=0.2))
+    if parts is None:
+        return None
+    return {"summary": parts[0], "plan": {"plan": parts[1]}, "mode": mode}
+
+
+@metrics.timed("llm.fused")
+async def afused_node(query: str, docs: List[Dict[str, str]], context: str = "", chat_mode: bool = False) -> Optional[Dict[str, Any]]:
+    prompt, max_tokens, mode = _fused_prompt(query, docs, context, chat_mode)
+    parts = _split_fused(await acall_llama(prompt, max_tokens=max_tokens, temperature=0.2))
+    if parts is None:
+        return None
+    return {"summary": parts[0], "plan": {"plan": parts[1]}, "mode": mode}
+
+
+def _emit_fused(text: str, sent: Dict[str, int], emit: Callable[[Dict[str, Any]], None], done: bool):
+    """
+    Emit what hasn't been sent yet of each section of a (partial) fused reply.
+    Until the reply is done, a tail that could be the start of the plan marker is
+    held back.
+    """
+    s = text.find(FUSED_SUMMARY_MARK)
+    if s < 0:
+        return
+    start = s + len(FUSED_SUMMARY_MARK)
+    p = text.find(FUSED_PLAN_MARK, start)
+    if p >= 0:
+        sections = [("summary", text[start:p]), ("plan", text[p + len(FUSED_PLAN_MARK):])]
+    else:
+        end = len(text) if done else max(start, len(text) - len(FUSED_PLAN_MARK) + 1)
+        sections = [("summary", text[start:end])]
+    for field, body in sections:
+        body = body.strip()
+        if len(body) > sent[field]:
+            emit({"event": "token", "field": field, "text": body[sent[field]:]})
+            sent[field] = len(body)
+
+
+def fused_node_stream(
+    query: str,
+    docs: List[Dict[str, str]],
+    context: str,
+    chat_mode: bool,
+    emit: Callable[[Dict[str, Any]], None]
+) -> Optional[Dict[str, Any]]:
+    """
+    Streaming fused_node: summary and plan tokens go to `emit` while the reply
+    arrives. If it can't be split after all, a reset event for each field already
+    streamed tells the client to drop those tokens, and None is returned.
+    """
+    prompt, max_tokens, mode = _fused_prompt(query, docs, context, chat_mode)
+    text = ""
+    sent = {"summary": 0, "plan": 0}
+    with metrics.span("llm.fused"):
+        for delta in call_llama_stream(prompt, max_tokens=max_tokens, temperature=0.2):
+            text += delta
+            _emit_fused(text, sent, emit, done=False)
+    _emit_fused(text, sent, emit, done=True)
+    parts = _split_fused(text)
+    if parts is None:
+        for field in ("summary", "plan"):
+            if sent[field]:
+                emit({"event": "reset", "field": field})
+        return None
+    return {"summary": parts[0], "plan": {"plan": parts[1]}, "mode": mode}
+
+
+@metrics.timed("budget")
+def budget_prompt(
+    query: str,
+    docs: List[Dict[str, str]],
+    context: str = "",
+    chat_mode: bool = False,
+    fused: bool = False
+) -> Tuple[str, List[Dict[str, str]], str, Dict[str, Any]]:
+    """
+    Trim query, previous context and docs so the summarizer (or fused) prompt fits
+    PROMPT_BUDGET estimated tokens. Returns (query, docs, context, report); see budget.fit.
+    """
+    template = _fused_prompt if fused else _summary_prompt
+    overhead = estimate_tokens(template("", [{"title": "", "text": ""}] if docs else [], "", chat_mode)[0])
+    return fit(query, docs, context, overhead=overhead)
+
+
+def wants_plan(query: str) -> bool:
+    lower = query.lower()
+    return any(k in lower for k in PLAN_KEYWORDS)
+
+
 class ResearchGraph:
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        docs_folder: str = "knowledge",
+        retrieval_mode: str = RETRIEVAL_MODE,
+        store: Optional[SessionStore] = None
+    ):
+        self.docs_folder = docs_folder
+        self.store = store or get_store()
+        self.retrieval_mode = retrieval_mode
+        self.index = get_index(docs_folder)
+        self.memory = ConversationMemory(self.store)
+        # only sessions with a run in progress keep their lock alive
+        self._async_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        nodes = self._nodes()
+        self.graph = Graph(nodes)
+        # run_many loads the session once for the whole batch
+        self.answer_graph = Graph([n for n in nodes if n.name != "session"])
+        if retrieval_mode == "dense":
+            from dense import get_dense_index
+            get_dense_index(self.index)
 
     def run(
         self,
@@ -192,29 +674,49 @@ class ResearchGraph:
         chat_mode: bool = False,
         user_name: Optional[str] = None
     ) -> Dict[str, Any]:
-        state = load_state()
-        sessions = state.setdefault("sessions", {})
+        # requests for the same session run one at a time (across worker processes too),
+        # so each one sees the previous answer as context; other sessions never wait
+        with metrics.span("run"), self.store.session_lock(session_id):
+            return self._run(session_id, query, chat_mode=chat_mode, user_name=user_name)
 
-        session = sessions.setdefault(session_id, {"history": [], "last_summary": "", "user_name": ""})
+    @metrics.timed("session.load")
+    def _session(self, session_id: str, user_name: Optional[str]) -> Dict[str, str]:
+        session = self.store.session_meta(session_id) or {"last_summary": "", "user_name": ""}
         if user_name:
             session["user_name"] = user_name
+        # recent turns + rolling summary of older ones (bounded, see memory.py)
+        session["context"] = self.memory.context(session_id)
+        return session
 
-        if chat_mode:
-            docs: List[Dict[str, str]] = []
-        else:
-            docs = retriever_node(query)
-
-        summary_res = summarizer_node(query, docs, context=session.get("last_summary", ""), chat_mode=chat_mode)
-        summary_text = summary_res.get("summary", "")
-        mode_used = summary_res.get("mode", "retrieval")
-
-        lower = query.lower()
-        plan_out = None
-        if any(k in lower for k in ("plan", "action", "next step", "how to", "implement")):
-            plan_out = planner_node(summary_text)
+    def _record(
+        self,
+        session_id: str,
+        session: Dict[str, str],
+        query: str,
+        docs: List[Dict[str, str]],
+        summary_text: str,
+        plan_out: Optional[Dict[str, Any]],
+        mode_used: str,
+        budget: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        with metrics.span("store.append"):
+            self.store.append_entry(session_id, self._entry(session, query, docs, summary_text, plan_out, mode_used, budget))
+        self.memory.note(session_id)
+        return self._result(session_id, session, docs, summary_text, plan_out, mode_used)
 
+    @staticmethod
+    def _entry(
+        session: Dict[str, str],
+        query: str,
+        docs: List[Dict[str, str]],
+        summary_text: str,
+        plan_out: Optional[Dict[str, Any]],
+        mode_used: str,
+        budget: Optional[Dict[str, Any]] = None,
+        timestamp: Optional[str] = None
+    ) -> Dict[str, Any]:
         entry = {
-            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "timestamp": timestamp or datetime.utcnow().isoformat() + "Z",
             "query": query,
             "docs": [{"id": d.get("id"), "title": d.get("title", d.get("id")), "url": d.get("url")} for d in docs],
             "summary": summary_text,
@@ -222,10 +724,20 @@ class ResearchGraph:
             "mode": mode_used,
             "user": {"name": session.get("user_name", "")},
         }
-        session["history"].append(entry)
-        session["last_summary"] = summary_text
-        save_state(state)
+        if budget is not None:
+            # estimated prompt size and what the budgeter trimmed/dropped to reach it
+            entry["budget"] = budget
+        return entry
 
+    @staticmethod
+    def _result(
+        session_id: str,
+        session: Dict[str, str],
+        docs: List[Dict[str, str]],
+        summary_text: str,
+        plan_out: Optional[Dict[str, Any]],
+        mode_used: str
+    ) -> Dict[str, Any]:
         return {
             "session_id": session_id,
             "session_name": session.get("user_name", ""),
@@ -235,6 +747,277 @@ class ResearchGraph:
             "mode": mode_used
         }
 
+    def _nodes(self) -> List[Node]:
+        """
+        The pipeline as a graph. Session loading and retrieval don't depend on each
+        other and run concurrently; then budgeting, and either the fused
+        summary+plan call or summarizer (+ planner). run(), arun() and run_stream()
+        all execute these nodes: arun() through their async versions, run_stream()
+        with the LLM nodes streaming to _STREAM.
+        """
+        return [
+            Node("session", self._session_node, inputs=("session_id", "user_name"), outputs=("session", "context"),
+                 afn=self._asession_node),
+            # not memoized: retriever_node already coalesces identical lookups, and its
+            # index and external cache decide how fresh the passages are
+            Node("retriever", self._retriever_node, inputs=("query", "chat_mode"), outputs=("docs",),
+                 afn=self._aretriever_node),
+            Node("budget", self._budget_node, inputs=("query", "docs", "context", "chat_mode"),
+                 outputs=("p_query", "p_docs", "p_context", "budget", "plan_wanted", "fuse")),
+            Node("fused", self._fused_node, inputs=("p_query", "p_docs", "p_context", "chat_mode"),
+                 outputs=("fused",), after=("fuse",), when=lambda a: a["fuse"], afn=self._afused_node),
+            Node("summarizer", self._summarizer_node, inputs=("p_query", "p_docs", "p_context", "chat_mode"),
+                 outputs=("summary", "mode"), after=("fused",), when=lambda a: a["fused"] is None,
+                 afn=self._asummarizer_node),
+            Node("planner", self._planner_node, inputs=("summary",), outputs=("plan",), after=("plan_wanted", "fused"),
+                 when=lambda a: a["plan_wanted"] and a["fused"] is None, memoize=True, afn=self._aplanner_node),
+        ]
+
+    def _session_node(self, session_id: str, user_name: Optional[str]) -> Dict[str, Any]:
+        session = self._session(session_id, user_name)
+        return {"session": session, "context": session.get("context", "")}
+
+    async def _asession_node(self, session_id: str, user_name: Optional[str]) -> Dict[str, Any]:
+        # arun doesn't hold the store's session lock; take it just for the read
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._locked, session_id, self._session_node, session_id, user_name)
+
+    def _retriever_node(self, query: str, chat_mode: bool) -> List[Dict[str, str]]:
+        docs = [] if chat_mode else retriever_node(query, docs_folder=self.docs_folder, index=self.index, mode=self.retrieval_mode)
+        emit = _STREAM.get()
+        if emit is not None:
+            emit({"event": "docs", "docs": docs})
+        return docs
+
+    async def _aretriever_node(self, query: str, chat_mode: bool) -> List[Dict[str, str]]:
+        if chat_mode:
+            return []
+        return await aretriever_node(query, docs_folder=self.docs_folder, index=self.index, mode=self.retrieval_mode)
+
+    @staticmethod
+    def _budget_node(query: str, docs: List[Dict[str, str]], context: str, chat_mode: bool) -> Dict[str, Any]:
+        plan_wanted = wants_plan(query)
+        fuse = plan_wanted and FUSED_PLAN
+        p_query, p_docs, p_context, report = budget_prompt(query, docs, context, chat_mode, fuse)
+        return {"p_query": p_query, "p_docs": p_docs, "p_context": p_context, "budget": report,
+                "plan_wanted": plan_wanted, "fuse": fuse}
+
+    @staticmethod
+    def _fused_node(p_query: str, p_docs: List[Dict[str, str]], p_context: str, chat_mode: bool) -> Optional[Dict[str, Any]]:
+        emit = _STREAM.get()
+        if emit is not None:
+            return fused_node_stream(p_query, p_docs, p_context, chat_mode, emit)
+        return fused_node(p_query, p_docs, context=p_context, chat_mode=chat_mode)
+
+    @staticmethod
+    async def _afused_node(p_query: str, p_docs: List[Dict[str, str]], p_context: str, chat_mode: bool) -> Optional[Dict[str, Any]]:
+        return await afused_node(p_query, p_docs, context=p_context, chat_mode=chat_mode)
+
+    @staticmethod
+    def _summarizer_node(p_query: str, p_docs: List[Dict[str, str]], p_context: str, chat_mode: bool) -> Dict[str, str]:
+        emit = _STREAM.get()
+        if emit is None:
+            summary_res = summarizer_node(p_query, p_docs, context=p_context, chat_mode=chat_mode)
+        else:
+            mode, tokens = summarizer_node_stream(p_query, p_docs, context=p_context, chat_mode=chat_mode)
+            with metrics.span("llm.summarize"):
+                summary_res = {"summary": _stream_tokens("summary", tokens, emit), "mode": mode}
+        return {"summary": summary_res.get("summary", ""), "mode": summary_res.get("mode", "retrieval")}
+
+    @staticmethod
+    async def _asummarizer_node(p_query: str, p_docs: List[Dict[str, str]], p_context: str, chat_mode: bool) -> Dict[str, str]:
+        summary_res = await asummarizer_node(p_query, p_docs, context=p_context, chat_mode=chat_mode)
+        return {"summary": summary_res.get("summary", ""), "mode": summary_res.get("mode", "retrieval")}
+
+    @staticmethod
+    def _planner_node(summary: str) -> Dict[str, Any]:
+        emit = _STREAM.get()
+        if emit is None:
+            return planner_node(summary)
+        with metrics.span("llm.plan"):
+            return {"plan": _stream_tokens("plan", planner_node_stream(summary), emit)}
+
+    @staticmethod
+    async def _aplanner_node(summary: str) -> Dict[str, Any]:
+        return await aplanner_node(summary)
+
+    @staticmethod
+    def _answer(state: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]], str]:
+        """
+        (summary, plan, mode) from a finished graph state.
+        """
+        fused = state.get("fused")
+        if fused is not None:
+            return fused["summary"], fused["plan"], fused["mode"]
+        return state["summary"], state["plan"], state["mode"]
+
+    def _run(
+        self,
+        session_id: str,
+        query: str,
+        chat_mode: bool = False,
+        user_name: Optional[str] = None
+    ) -> Dict[str, Any]:
+        state = self.graph.run({"session_id": session_id, "user_name": user_name, "query": query, "chat_mode": chat_mode})
+        summary_text, plan_out, mode_used = self._answer(state)
+        return self._record(session_id, state["session"], query, state["docs"], summary_text, plan_out, mode_used, state["budget"])
+
+    def _batch_one(
+        self,
+        query: str,
+        context: str,
+        chat_mode: bool
+    ) -> Tuple[List[Dict[str, str]], str, Optional[Dict[str, Any]], str, Dict[str, Any]]:
+        state = self.answer_graph.run({"query": query, "context": context, "chat_mode": chat_mode})
+        return (state["docs"],) + self._answer(state) + (state["budget"],)
+
+    def run_many(
+        self,
+        session_id: str,
+        queries: List[str],
+        chat_mode: bool = False,
+        user_name: Optional[str] = None,
+        workers: int = BATCH_WORKERS
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Run several queries for one session on a pool of `workers` threads. Yields
+          {"event": "result", "index": i, "query": q, "result": <same dict as run()>}   or
+          {"event": "error", "index": i, "query": q, "error": "..."}
+        as each query finishes. Every query sees the session context from before the
+        batch; history entries are appended in submission order (failed queries are
+        skipped) and stamped with their submission time. The session lock is only
+        held to read the context and to append, never while an event is yielded.
+        Identical retrievals and prompts in the batch hit upstream once.
+        """
+        with self.store.session_lock(session_id):
+            session = self._session(session_id, user_name)
+        context = session.get("context", "")
+
+        def append(entries: List[Dict[str, Any]]):
+            with self.store.session_lock(session_id), metrics.span("store.append"):
+                for entry in entries:
+                    self.store.append_entry(session_id, entry)
+
+        finished: Dict[int, Optional[Dict[str, Any]]] = {}
+        stamps: Dict[int, str] = {}
+        next_index = 0
+        pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(queries))), thread_name_prefix="batch")
+        try:
+            futures = {}
+            for i, q in enumerate(queries):
+                stamps[i] = datetime.utcnow().isoformat() + "Z"
+                futures[pool.submit(self._batch_one, q, context, chat_mode)] = i
+            for fut in as_completed(futures):
+                i = futures[fut]
+                try:
+                    docs, summary_text, plan_out, mode_used, report = fut.result()
+                except Exception as e:
+                    finished[i] = None
+                    event: Dict[str, Any] = {"event": "error", "index": i, "query": queries[i], "error": str(e)}
+                else:
+                    finished[i] = self._entry(session, queries[i], docs, summary_text, plan_out, mode_used, report, stamps[i])
+                    event = {"event": "result", "index": i, "query": queries[i],
+                             "result": self._result(session_id, session, docs, summary_text, plan_out, mode_used)}
+                ready: List[Dict[str, Any]] = []
+                while next_index in finished:
+                    entry = finished.pop(next_index)
+                    if entry is not None:
+                        ready.append(entry)
+                    next_index += 1
+                if ready:
+                    append(ready)
+                yield event
+        finally:
+            # the consumer went away early: keep what already finished, in order
+            pool.shutdown(wait=True, cancel_futures=True)
+            leftover = [finished[i] for i in sorted(finished) if finished[i] is not None]
+            if leftover:
+                append(leftover)
+            self.memory.note(session_id)
+
+    async def arun(
+        self,
+        session_id: str,
+        query: str,
+        chat_mode: bool = False,
+        user_name: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Async run(): same graph and result, but the nodes' async versions await on
+        pooled async clients instead of holding a thread. An asyncio lock queues a
+        session's requests in this process, so each sees the previous answer as
+        context. The store's session lock (thread-affine, cross-process) is only
+        taken for the context read and the append, each a short call on the default
+        executor, so no thread waits out the LLM round-trip; across worker processes,
+        requests for one session can overlap between those two points.
+        """
+        lock = self._async_locks.get(session_id)
+        if lock is None:
+            lock = self._async_locks[session_id] = asyncio.Lock()
+        with metrics.span("run"):
+            async with lock:
+                state = await self.graph.arun({"session_id": session_id, "user_name": user_name, "query": query, "chat_mode": chat_mode})
+                summary_text, plan_out, mode_used = self._answer(state)
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, self._locked, session_id, self._record,
+                    session_id, state["session"], query, state["docs"], summary_text, plan_out, mode_used, state["budget"]
+                )
+
+    def _locked(self, session_id: str, fn: Callable[..., T], *args: Any) -> T:
+        with self.store.session_lock(session_id):
+            return fn(*args)
+
+    def run_stream(
+        self,
+        session_id: str,
+        query: str,
+        chat_mode: bool = False,
+        user_name: Optional[str] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Generator version of run(), on the same graph. Yields events:
+          {"event": "docs", "docs": [...]}
+          {"event": "token", "field": "summary" | "plan", "text": "..."}  (as the LLM streams)
+          {"event": "reset", "field": "summary" | "plan"}  (a fused reply couldn't be split:
+                                                            drop that field's tokens so far)
+          {"event": "done", "result": <same dict as run()>}
+        run() itself goes on a helper thread, so the session lock is held for the
+        run only, never while the consumer reads; history is written when the run
+        finishes, even if the consumer stopped reading.
+        """
+        events: "queue.Queue[Any]" = queue.Queue()
+        streamed: Dict[str, bool] = {}
+
+        def emit(event: Dict[str, Any]):
+            if event["event"] == "docs":
+                event = {"event": "docs", "session_id": session_id, "docs": event["docs"]}
+            elif event["event"] in ("token", "reset"):
+                streamed[event["field"]] = event["event"] == "token"
+            events.put(event)
+
+        def work():
+            try:
+                result = self.run(session_id, query, chat_mode=chat_mode, user_name=user_name)
+            except Exception as e:
+                events.put(e)
+                return
+            if result["plan"] and not streamed.get("plan"):
+                # memoized plan: nothing was streamed for it
+                emit({"event": "token", "field": "plan", "text": result["plan"]["plan"]})
+            events.put({"event": "done", "result": result})
+
+        # the run's nodes see _STREAM (and the caller's trace) through this context
+        ctx = contextvars.copy_context()
+        ctx.run(_STREAM.set, emit)
+        threading.Thread(target=ctx.run, args=(work,), name="stream", daemon=True).start()
+        while True:
+            event = events.get()
+            if isinstance(event, Exception):
+                raise event
+            yield event
+            if event["event"] == "done":
+                return
+
 
 if __name__ == "__main__":
     import argparse, json
@@ -243,6 +1026,8 @@ if __name__ == "__main__":
     parser.add_argument("--query", "-q", default=None)
     parser.add_argument("--chat", action="store_true", help="Use LLM-only chat mode (no retrieval).")
     parser.add_argument("--name", default=None, help="User name to attach")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Run through the asyncio path (needs httpx).")
+    parser.add_argument("--trace", action="store_true", help="Print the per-node execution trace to stderr.")
     args = parser.parse_args()
 
     if not args.query:
@@ -253,5 +1038,13 @@ if __name__ == "__main__":
         q = args.query
 
     g = ResearchGraph()
-    out = g.run(sid, q, chat_mode=bool(args.chat), user_name=args.name)
+    with node_trace() as nodes:
+        if args.use_async:
+            out = asyncio.run(g.arun(sid, q, chat_mode=bool(args.chat), user_name=args.name))
+        else:
+            out = g.run(sid, q, chat_mode=bool(args.chat), user_name=args.name)
+    if args.trace:
+        import sys
+        for n in nodes:
+            print(f"{n['node']:<11} {n['status']:<8} +{n['start_ms']:>8.1f}ms {n['ms']:>8.1f}ms  {n['thread']}", file=sys.stderr)
     print(json.dumps(out, indent=2, ensure_ascii=False))
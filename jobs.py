@@ -0,0 +1,249 @@
+import collections
+import math
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+import metrics
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))               # concurrent queued runs per process
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "64"))          # queued (not running) jobs before 429
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "600"))     # finished jobs kept this long for polling
+JOB_AGING = float(os.getenv("JOB_AGING", "30"))                # a job waiting this long runs next, whatever its priority
+JOB_WAIT_MAX = 25.0                                            # cap for long-poll waits
+
+PRIORITIES = ("high", "normal", "low")
+
+JOBS_SUBMITTED = metrics.counter("jobs_submitted_total", "Jobs accepted by the run queue, by priority.")
+JOBS_REJECTED = metrics.counter("jobs_rejected_total", "Jobs refused because the run queue was full.")
+JOB_WAIT_SECONDS = metrics.histogram("job_wait_seconds", "Time jobs spent queued before a worker took them.")
+
+
+class QueueFull(Exception):
+    """
+    The queue is at capacity; retry_after is a hint in seconds.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"job queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LocalBackend:
+    """
+    In-process queue backend: one FIFO per priority level and a dict of job records.
+    Jobs with the same key (session) run one at a time: take() passes over a job
+    whose key is already running until release(key). A shared backend (e.g. Redis)
+    can replace it by providing the same methods: put, take, release, save, load,
+    queued, position, expired and drop.
+    """
+
+    def __init__(self, aging: float = JOB_AGING):
+        self.aging = aging
+        self._levels: Dict[str, Deque[str]] = {p: collections.deque() for p in PRIORITIES}
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._running_keys: Set[str] = set()
+        self._cond = threading.Condition()
+
+    def put(self, job: Dict[str, Any]):
+        with self._cond:
+            self._jobs[job["id"]] = job
+            self._levels[job["priority"]].append(job["id"])
+            self._cond.notify()
+
+    def _head(self, level: str) -> Optional[str]:
+        # first job of the level whose session isn't already running
+        for job_id in self._levels[level]:
+            if self._jobs[job_id].get("key") not in self._running_keys:
+                return job_id
+        return None
+
+    def _pick(self) -> Optional[str]:
+        heads = [(p, j) for p, j in ((p, self._head(p)) for p in PRIORITIES) if j]
+        if not heads:
+            return None
+        now = time.time()
+        # the oldest job past the aging limit goes first, so a stream of high
+        # priority work can't starve the rest
+        starving = [(self._jobs[j]["submitted"], p, j) for p, j in heads if now - self._jobs[j]["submitted"] >= self.aging]
+        level, job_id = (min(starving)[1:] if starving else heads[0])
+        self._levels[level].remove(job_id)
+        key = self._jobs[job_id].get("key")
+        if key is not None:
+            self._running_keys.add(key)
+        return job_id
+
+    def take(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            job_id = self._pick()
+            if job_id is None:
+                self._cond.wait(timeout)
+                job_id = self._pick()
+            return dict(self._jobs[job_id]) if job_id else None
+
+    def release(self, key: Optional[str]):
+        # the key's job finished: its next queued job may run
+        if key is None:
+            return
+        with self._cond:
+            self._running_keys.discard(key)
+            self._cond.notify_all()
+
+    def save(self, job: Dict[str, Any]):
+        with self._cond:
+            self._jobs[job["id"]] = job
+
+    def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def queued(self) -> int:
+        with self._cond:
+            return sum(len(q) for q in self._levels.values())
+
+    def position(self, job_id: str) -> Optional[int]:
+        # jobs ahead of this one, ignoring aging; None once it has left the queue
+        with self._cond:
+            ahead = 0
+            for p in PRIORITIES:
+                q = self._levels[p]
+                if job_id in q:
+                    return ahead + list(q).index(job_id)
+                ahead += len(q)
+            return None
+
+    def expired(self, before: float) -> List[str]:
+        with self._cond:
+            return [j for j, job in self._jobs.items() if (job.get("finished") or math.inf) < before]
+
+    def drop(self, job_id: str):
+        with self._cond:
+            self._jobs.pop(job_id, None)
+
+
+class JobQueue:
+    """
+    Bounded background execution for slow requests: submit() returns a job id at
+    once, `workers` threads run fn(payload) in priority order, and callers poll or
+    long-poll status(). Jobs submitted with the same key (a session id) never run
+    concurrently, so one session's backlog can't hold every worker while its runs
+    wait on each other; other sessions' jobs are taken in the meantime. When `max_queued` jobs are already waiting, submit() raises
+    QueueFull with a Retry-After estimate from recent run times.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[Dict[str, Any]], Any],
+        backend: Optional[LocalBackend] = None,
+        workers: int = JOB_WORKERS,
+        max_queued: int = JOB_QUEUE_MAX,
+        result_ttl: float = JOB_RESULT_TTL
+    ):
+        self.fn = fn
+        self.backend = backend or LocalBackend()
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._avg_seconds = 5.0  # moving average of run time, for Retry-After
+        self._running = 0
+        self._done = threading.Condition()
+        self._admit = threading.Lock()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+
+    def submit(self, payload: Dict[str, Any], priority: str = "normal", key: Optional[str] = None) -> Dict[str, Any]:
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+        self._sweep()
+        with self._admit:
+            queued = self.backend.queued()
+            if queued >= self.max_queued:
+                JOBS_REJECTED.inc(priority=priority)
+                raise QueueFull(self.retry_after(queued))
+            job = {
+                "id": uuid.uuid4().hex,
+                "status": "queued",
+                "priority": priority,
+                "payload": payload,
+                "key": key,
+                "submitted": time.time(),
+            }
+            self.backend.put(job)
+        JOBS_SUBMITTED.inc(priority=priority)
+        return self._public(job)
+
+    def retry_after(self, queued: Optional[int] = None) -> int:
+        """
+        Seconds until a queue slot is likely to free up.
+        """
+        queued = self.backend.queued() if queued is None else queued
+        waves = (queued - self.max_queued + 1) / self.workers
+        return int(min(60, max(1, math.ceil(self._avg_seconds * max(waves, 1 / self.workers)))))
+
+    def status(self, job_id: str, wait: float = 0.0) -> Optional[Dict[str, Any]]:
+        """
+        The job's public record, or None if unknown/expired. With wait > 0, block up
+        to that many seconds (capped at JOB_WAIT_MAX) for the job to finish.
+        """
+        deadline = time.monotonic() + min(max(wait, 0.0), JOB_WAIT_MAX)
+        with self._done:
+            while True:
+                job = self.backend.load(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] in ("done", "error") or remaining <= 0:
+                    break
+                self._done.wait(remaining)
+        if job is None:
+            return None
+        return self._public(job)
+
+    def _public(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        out = {k: job[k] for k in ("status", "priority", "submitted") if k in job}
+        out["job"] = job["id"]
+        for k in ("started", "finished", "result", "error"):
+            if job.get(k) is not None:
+                out[k] = job[k]
+        if job["status"] == "queued":
+            out["position"] = self.backend.position(job["id"])
+        return out
+
+    def _worker(self):
+        while True:
+            job = self.backend.take(timeout=5.0)
+            if job is None:
+                continue
+            job["status"] = "running"
+            job["started"] = time.time()
+            JOB_WAIT_SECONDS.observe(job["started"] - job["submitted"], priority=job["priority"])
+            self.backend.save(job)
+            with self._done:
+                self._running += 1
+            try:
+                job["result"] = self.fn(job["payload"])
+                job["status"] = "done"
+            except Exception as e:
+                job["error"] = str(e)
+                job["status"] = "error"
+            job["finished"] = time.time()
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (job["finished"] - job["started"])
+            self.backend.save(job)
+            self.backend.release(job.get("key"))
+            with self._done:
+                self._running -= 1
+                self._done.notify_all()
+
+    def _sweep(self):
+        for job_id in self.backend.expired(time.time() - self.result_ttl):
+            self.backend.drop(job_id)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queued": self.backend.queued(),
+            "running": self._running,
+            "workers": self.workers,
+            "capacity": self.max_queued,
+            "avg_run_seconds": round(self._avg_seconds, 3),
+        }
@@ -0,0 +1,469 @@
+import asyncio
+import collections
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+
+HEDGE = os.getenv("LLM_HEDGE", "1") != "0"
+HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "3.0"))   # hedge delay until an endpoint has MIN_SAMPLES latencies
+HEDGE_MIN_DELAY = 0.25                                     # never hedge sooner than this, whatever the p95
+HEDGE_QUANTILE = 0.95
+LATENCY_WINDOW = 200                                       # recent successful calls kept per endpoint
+MIN_SAMPLES = 20
+BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))            # recent calls the failure rate is taken over
+BREAKER_THRESHOLD = float(os.getenv("LLM_BREAKER_THRESHOLD", "0.5"))   # failure rate that opens the circuit
+BREAKER_MIN_CALLS = 5
+BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))      # seconds open before a probe call
+
+LLM_HEDGES = metrics.counter("llm_hedged_requests_total", "Hedge requests sent to an alternate endpoint, by endpoint.")
+LLM_WINS = metrics.counter("llm_endpoint_wins_total", "Calls answered by each endpoint, by whether it was the hedge/failover.")
+LLM_BREAKER_OPENS = metrics.counter("llm_breaker_opened_total", "Times an endpoint's circuit breaker opened.")
+
+
+class CircuitOpen(RuntimeError):
+    """
+    No endpoint is accepting calls (all circuit breakers are open).
+    """
+
+
+def is_endpoint_failure(exc: BaseException) -> bool:
+    """
+    Whether an error says the endpoint is unhealthy: timeouts, connection errors,
+    5xx and 429. Other client errors (400 prompt too long, 401 bad key) and local
+    errors don't count against its breaker.
+    """
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status >= 500 or status == 429
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    try:
+        import requests
+        if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+            return True
+    except ImportError:
+        pass
+    try:
+        import httpx
+        if isinstance(exc, httpx.TransportError):
+            return True
+    except ImportError:
+        pass
+    return False
+
+
+class CircuitBreaker:
+    """
+    Failure-rate breaker over the last `window` calls. Opens when at least
+    `min_calls` were seen and `threshold` of them failed; after `cooldown` seconds
+    a single probe call is let through (half-open) and its outcome closes or
+    re-opens the circuit.
+    """
+
+    def __init__(
+        self,
+        window: int = BREAKER_WINDOW,
+        threshold: float = BREAKER_THRESHOLD,
+        min_calls: int = BREAKER_MIN_CALLS,
+        cooldown: float = BREAKER_COOLDOWN
+    ):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._results: Deque[bool] = collections.deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Whether a call may go out now. In half-open state only one caller gets True
+        until that call is recorded.
+        """
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.cooldown:
+                    return False
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, ok: bool, name: str = ""):
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+                if ok:
+                    self.state = "closed"
+                    self._results.clear()
+                else:
+                    self._open(name)
+                return
+            self._results.append(ok)
+            failures = self._results.count(False)
+            if len(self._results) >= self.min_calls and failures >= self.threshold * len(self._results):
+                self._open(name)
+
+    def release(self):
+        """
+        Give up a half-open probe without an outcome (the call was cancelled), so
+        the next caller may probe.
+        """
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+
+    def _open(self, name: str):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        LLM_BREAKER_OPENS.inc(endpoint=name)
+
+
+class Endpoint:
+    """
+    One model endpoint (model id + chat completions URL) with its recent latencies
+    and circuit breaker. url=None means the caller's default URL.
+    """
+
+    def __init__(self, model: str, url: Optional[str] = None, breaker: Optional[CircuitBreaker] = None):
+        self.model = model
+        self.url = url
+        self.name = model if url is None else f"{model}@{url}"
+        self.breaker = breaker or CircuitBreaker()
+        self._latencies: Deque[float] = collections.deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: Optional[float], ok: bool, breaker: bool = True):
+        """
+        Record a finished call; seconds=None records the outcome only (e.g. streams,
+        whose duration isn't comparable to a full response). breaker=False keeps
+        the outcome out of the circuit breaker.
+        """
+        if ok and seconds is not None:
+            with self._lock:
+                self._latencies.append(seconds)
+        if breaker:
+            self.breaker.record(ok, self.name)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self) -> float:
+        """
+        How long to wait on this endpoint before hedging: its observed p95, or
+        HEDGE_DELAY until there are MIN_SAMPLES latencies.
+        """
+        with self._lock:
+            enough = len(self._latencies) >= MIN_SAMPLES
+        if not enough:
+            return HEDGE_DELAY
+        return max(HEDGE_MIN_DELAY, self.quantile(HEDGE_QUANTILE) or HEDGE_DELAY)
+
+
+class EndpointPool:
+    """
+    Ordered list of interchangeable endpoints (first = preferred). call() sends to
+    the first endpoint whose breaker allows it; if no answer arrives within that
+    endpoint's p95, a hedge goes to the next one and whichever answers first wins.
+    An error fails over to the next endpoint straight away. Endpoints with an open
+    breaker are skipped until their cooldown passes; only timeouts, connection
+    errors, 5xx and 429 count as failures. With a single endpoint there is nothing
+    to fail over to, so no breaker is consulted and calls always go out.
+    """
+
+    def __init__(self, endpoints: List[Endpoint], hedge: bool = HEDGE, workers: int = 32):
+        if not endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.hedge = hedge and len(endpoints) > 1
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm")
+
+    @classmethod
+    def from_env(cls, default_model: str, spec: Optional[str] = None) -> "EndpointPool":
+        """
+        Endpoints from LLM_ENDPOINTS, a comma-separated list of "model" or
+        "model@url" entries; default_model alone if unset.
+        """
+        spec = os.getenv("LLM_ENDPOINTS", "") if spec is None else spec
+        endpoints = []
+        for item in filter(None, (s.strip() for s in spec.split(","))):
+            model, _, url = item.partition("@")
+            endpoints.append(Endpoint(model.strip(), url.strip() or None))
+        return cls(endpoints or [Endpoint(default_model)])
+
+    @property
+    def failover(self) -> bool:
+        return len(self.endpoints) > 1
+
+    def _next(self, tried: List[Endpoint]) -> Optional[Endpoint]:
+        for ep in self.endpoints:
+            if ep not in tried and (not self.failover or ep.breaker.allow()):
+                tried.append(ep)
+                return ep
+        return None
+
+    def _observe(self, ep: Endpoint, seconds: Optional[float], error: Optional[BaseException] = None):
+        # an error the endpoint answered with (4xx, bad payload) still shows it is up;
+        # it counts as a success for the breaker, which also resolves a half-open probe
+        ok = error is None or not is_endpoint_failure(error)
+        ep.observe(seconds if error is None else None, ok, breaker=self.failover)
+
+    def _timed(self, ep: Endpoint, fn: Callable[[Endpoint], T]) -> T:
+        started = time.perf_counter()
+        try:
+            result = fn(ep)
+        except Exception as e:
+            self._observe(ep, None, e)
+            raise
+        self._observe(ep, time.perf_counter() - started)
+        return result
+
+    def call(self, fn: Callable[[Endpoint], T]) -> T:
+        """
+        fn(endpoint) -> result, hedged and failed over as described above.
+        Losing requests run to completion in the background (their latency still
+        counts); the last error is raised if every endpoint fails.
+        """
+        tried: List[Endpoint] = []
+        first = self._next(tried)
+        if first is None:
+            raise CircuitOpen("all LLM endpoints have open circuit breakers")
+        if not self.failover:
+            return self._timed(first, fn)
+
+        pending: Dict[Future, Endpoint] = {self._pool.submit(self._timed, first, fn): first}
+        hedge_at = time.monotonic() + first.hedge_delay() if self.hedge else None
+        error: Optional[BaseException] = None
+        while pending:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedge_at = None  # at most one hedge per call
+                alt = self._next(tried)
+                if alt is not None:
+                    LLM_HEDGES.inc(endpoint=alt.name)
+                    pending[self._pool.submit(self._timed, alt, fn)] = alt
+                continue
+            for future in done:
+                ep = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                LLM_WINS.inc(endpoint=ep.name, role="primary" if ep is first else "alternate")
+                return result
+            if not pending:
+                hedge_at = None
+                alt = self._next(tried)
+                if alt is not None:
+                    pending[self._pool.submit(self._timed, alt, fn)] = alt
+        raise error if error is not None else CircuitOpen("all LLM endpoints have open circuit breakers")
+
+    async def acall(self, fn: Callable[[Endpoint], Awaitable[T]]) -> T:
+        """
+        Async call(): same hedging and failover on the running loop; the losing
+        request is cancelled (and not counted) once a winner is in.
+        """
+        async def timed(ep: Endpoint) -> T:
+            started = time.perf_counter()
+            try:
+                result = await fn(ep)
+            except asyncio.CancelledError:
+                if self.failover:
+                    ep.breaker.release()
+                raise
+            except Exception as e:
+                self._observe(ep, None, e)
+                raise
+            self._observe(ep, time.perf_counter() - started)
+            return result
+
+        tried: List[Endpoint] = []
+        first = self._next(tried)
+        if first is None:
+            raise CircuitOpen("all LLM endpoints have open circuit breakers")
+        if not self.failover:
+            return await timed(first)
+
+        pending: Dict[asyncio.Task, Endpoint] = {asyncio.ensure_future(timed(first)): first}
+        hedge_at = time.monotonic() + first.hedge_delay() if self.hedge else None
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None
+                    alt = self._next(tried)
+                    if alt is not None:
+                        LLM_HEDGES.inc(endpoint=alt.name)
+                        pending[asyncio.ensure_future(timed(alt))] = alt
+                    continue
+                for task in done:
+                    ep = pending.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    LLM_WINS.inc(endpoint=ep.name, role="primary" if ep is first else "alternate")
+                    return task.result()
+                if not pending:
+                    hedge_at = None
+                    alt = self._next(tried)
+                    if alt is not None:
+                        pending[asyncio.ensure_future(timed(alt))] = alt
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error if error is not None else CircuitOpen("all LLM endpoints have open circuit breakers")
+
+    def first(self, fn: Callable[[Endpoint], T]) -> T:
+        """
+        Sequential failover without hedging, for calls that can't be duplicated
+        (streams): fn(endpoint) for each allowed endpoint until one succeeds.
+        Only the outcome is recorded, not the latency.
+        """
+        tried: List[Endpoint] = []
+        error: Optional[BaseException] = None
+        while True:
+            ep = self._next(tried)
+            if ep is None:
+                break
+            try:
+                result = fn(ep)
+            except Exception as e:
+                self._observe(ep, None, e)
+                error = e
+                continue
+            self._observe(ep, None)
+            return result
+        raise error if error is not None else CircuitOpen("all LLM endpoints have open circuit breakers")
+
+    def stats(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for ep in self.endpoints:
+            for q in (0.5, 0.95):
+                value = ep.quantile(q)
+                if value is not None:
+                    out[f"{ep.name}:p{int(q * 100)}_seconds"] = round(value, 4)
+            out[f"{ep.name}:breaker_open"] = 0 if ep.breaker.state == "closed" else 1
+        return out
+
+
+def _stub_server(delay: float, tail: float, tail_delay: float, error_rate: float):
+    # OpenAI-style chat completions stub: `delay` per call, `tail` of calls take
+    # `tail_delay` instead, `error_rate` of calls answer 500
+    import json
+    import random
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(tail_delay if random.random() < tail else delay)
+            if random.random() < error_rate:
+                status, data = 500, {"error": {"message": "injected failure"}}
+            else:
+                status, data = 200, {"model": body["model"], "choices": [{"message": {"content": "ok from " + body["model"]}}]}
+            raw = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+
+def demo(calls: int = 300, concurrency: int = 8, tail: float = 0.05, tail_delay: float = 2.0,
+         error_rate: float = 0.0, down: bool = False) -> Dict[str, Any]:
+    """
+    Run `calls` requests against two local stub endpoints (primary with injected
+    tail latency/errors, alternate healthy, or dead with down=True) through
+    call_llama, once with a single endpoint and once hedged, and report latency
+    percentiles, errors and hedge/win counts.
+    """
+    import LLM
+
+    primary, primary_url = _stub_server(0.05, tail, tail_delay, error_rate)
+    alternate, alternate_url = _stub_server(0.08, 0.0, 0.0, 1.0 if down else 0.0)
+    os.environ.setdefault("OPENROUTER_API_KEY", "stub")
+    out: Dict[str, Any] = {"calls": calls, "tail": tail, "tail_delay": tail_delay, "error_rate": error_rate}
+
+    def run(label: str, pool: EndpointPool):
+        LLM.ENDPOINTS = pool
+        latencies: List[float] = []
+        errors = 0
+
+        def one(i: int):
+            nonlocal errors
+            started = time.perf_counter()
+            try:
+                LLM.call_llama(f"demo {label} {i}", use_cache=False)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+        with ThreadPoolExecutor(max_workers=concurrency) as ex:
+            list(ex.map(one, range(calls)))
+        latencies.sort()
+        pct = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1) if latencies else None
+        out[label] = {"p50_ms": pct(0.5), "p95_ms": pct(0.95), "p99_ms": pct(0.99), "max_ms": pct(1.0),
+                      "errors": errors, "endpoints": pool.stats()}
+
+    run("single", EndpointPool([Endpoint("stub/primary", primary_url)], hedge=False))
+    hedged = EndpointPool([Endpoint("stub/primary", primary_url), Endpoint("stub/alternate", alternate_url)])
+    run("hedged", hedged)
+
+    # a half-open probe that fails with a non-endpoint error must not strand the endpoint
+    probe = EndpointPool([Endpoint("stub/primary", primary_url, CircuitBreaker(cooldown=0.0)),
+                          Endpoint("stub/alternate", alternate_url)], hedge=False)
+    probe.endpoints[0].breaker._open("stub/primary")
+
+    def bad_format(ep: Endpoint) -> str:
+        if ep is probe.endpoints[0]:
+            raise RuntimeError("Unexpected LLM response format")
+        return ep.name
+    try:
+        probe.call(bad_format)
+    except RuntimeError:
+        pass
+    out["probe_recovered"] = probe.call(lambda ep: ep.name) == probe.endpoints[0].name
+    primary.shutdown()
+    alternate.shutdown()
+    return out
+
+
+if __name__ == "__main__":
+    import argparse, json
+    parser = argparse.ArgumentParser(description="Hedged LLM endpoint pool demo against local stub servers")
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--tail", type=float, default=0.05, help="Fraction of primary calls that are slow.")
+    parser.add_argument("--tail-delay", type=float, default=2.0, help="Seconds a slow primary call takes.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of primary calls answering 500.")
+    parser.add_argument("--alternate-down", action="store_true", help="Make the alternate endpoint fail every call.")
+    args = parser.parse_args()
+    print(json.dumps(demo(args.calls, args.concurrency, args.tail, args.tail_delay, args.error_rate, args.alternate_down), indent=2))
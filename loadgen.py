@@ -0,0 +1,333 @@
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from bench import Suite, _meta, percentiles
+
+ENDPOINTS = ("run", "history", "export")
+DEFAULT_MIX = "run=0.8,history=0.15,export=0.05"
+QUERY_CHARS = 300          # long log bodies are cut to this many characters
+
+
+def load_queries(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Queries from a JSONL log. Each line may carry "query" (else "title", else the
+    start of "body", so a backlog like requests.jsonl replays as-is) and optionally
+    "session_id", "user_name" and "chat_mode".
+    """
+    out: List[Dict[str, Any]] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(rec, dict):
+                continue
+            query = rec.get("query") or rec.get("title") or (rec.get("body") or "")[:QUERY_CHARS]
+            if not query:
+                continue
+            q = {k: rec[k] for k in ("session_id", "user_name", "chat_mode") if k in rec}
+            q["query"] = query
+            out.append(q)
+            if limit and len(out) >= limit:
+                break
+    if not out:
+        raise ValueError(f"no queries found in {path}")
+    return out
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """
+    "run=0.8,history=0.15,export=0.05" -> normalized weights per endpoint.
+    """
+    mix: Dict[str, float] = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"unknown endpoint '{name}' (choose from {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError("mix weights must add up to more than 0")
+    return {k: v / total for k, v in mix.items()}
+
+
+class Replay:
+    """
+    Replays a query log against a running app: /api/run with the logged queries,
+    plus /api/history and /api/export_pdf for users that already have history, in
+    the proportions of `mix`. Log lines without a session are spread over `users`
+    simulated users. closed_loop() and open_loop() each run one load step and
+    summarize it; a 429 from the job queue counts as an error (reported separately).
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        queries: List[Dict[str, Any]],
+        mix: Optional[Dict[str, float]] = None,
+        users: int = 10,
+        timeout: float = 120.0,
+        seed: Optional[int] = None
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.queries = queries
+        self.mix = mix or parse_mix(DEFAULT_MIX)
+        self.users = max(1, users)
+        self.timeout = timeout
+        self._rng = random.Random(seed)
+        self._cursor = itertools.count()
+        self._known: List[str] = []     # users with at least one successful run
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._tag = f"load-{int(time.time())}"
+
+    def _session(self) -> requests.Session:
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = requests.Session()
+        return s
+
+    def _next(self) -> Tuple[str, Dict[str, Any]]:
+        with self._lock:
+            endpoint = self._rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            if endpoint != "run" and self._known:
+                return endpoint, {"name": self._rng.choice(self._known)}
+            i = next(self._cursor)
+        q = dict(self.queries[i % len(self.queries)])
+        user = q.get("user_name") or q.get("session_id") or f"{self._tag}-u{i % self.users}"
+        q.setdefault("session_id", user)
+        q.setdefault("user_name", user)
+        return "run", q
+
+    def send(self) -> Dict[str, Any]:
+        """
+        One request chosen by the mix; {"endpoint", "status", "seconds"[, "error"]}.
+        """
+        endpoint, args = self._next()
+        s = self._session()
+        t = time.perf_counter()
+        rec: Dict[str, Any] = {"endpoint": endpoint}
+        try:
+            if endpoint == "run":
+                resp = s.post(f"{self.base_url}/api/run", json=args, timeout=self.timeout)
+            elif endpoint == "history":
+                resp = s.get(f"{self.base_url}/api/history", params={"name": args["name"], "limit": 20}, timeout=self.timeout)
+            else:
+                resp = s.get(f"{self.base_url}/api/export_pdf", params={"name": args["name"]}, timeout=self.timeout)
+            resp.content
+            rec["status"] = resp.status_code
+            if resp.status_code >= 400:
+                rec["error"] = resp.text.strip()[:200]
+            elif endpoint == "run":
+                with self._lock:
+                    if args["user_name"] not in self._known:
+                        self._known.append(args["user_name"])
+        except requests.RequestException as e:
+            rec["status"] = "error"
+            rec["error"] = f"{type(e).__name__}: {e}"[:200]
+        rec["seconds"] = time.perf_counter() - t
+        return rec
+
+    def closed_loop(self, concurrency: int, duration: float, max_requests: Optional[int] = None, think: float = 0.0) -> Dict[str, Any]:
+        """
+        `concurrency` clients each sending their next request as soon as the last
+        one returns (plus `think` seconds), for `duration` seconds or `max_requests`.
+        """
+        records: List[Dict[str, Any]] = []
+        sent = itertools.count()
+        stop = time.monotonic() + duration
+
+        def client():
+            while time.monotonic() < stop and (max_requests is None or next(sent) < max_requests):
+                rec = self.send()
+                with self._lock:
+                    records.append(rec)
+                if think:
+                    time.sleep(think)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(max(1, concurrency))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self._summary(records, time.perf_counter() - started, {"mode": "closed", "concurrency": concurrency})
+
+    def open_loop(self, rate: float, duration: float, max_inflight: int = 64) -> Dict[str, Any]:
+        """
+        Poisson arrivals at `rate` per second for `duration` seconds, whether or not
+        earlier requests have returned (up to `max_inflight` at once). Latency is
+        measured from each request's scheduled arrival, so time spent waiting for a
+        free slot counts against the server instead of being hidden.
+        """
+        records: List[Dict[str, Any]] = []
+        pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="loadgen")
+        futures = []
+
+        def arrival(scheduled: float):
+            rec = self.send()
+            rec["seconds"] = time.perf_counter() - scheduled
+            with self._lock:
+                records.append(rec)
+
+        started = time.perf_counter()
+        at = started
+        while True:
+            at += self._rng.expovariate(rate)
+            if at - started >= duration:
+                break
+            delay = at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(arrival, at))
+        wait(futures)
+        pool.shutdown()
+        step = {"mode": "open", "rate": rate, "offered": len(futures)}
+        return self._summary(records, time.perf_counter() - started, step)
+
+    @staticmethod
+    def _summary(records: List[Dict[str, Any]], wall: float, step: Dict[str, Any]) -> Dict[str, Any]:
+        def ok(r: Dict[str, Any]) -> bool:
+            return isinstance(r["status"], int) and r["status"] < 400
+
+        status: Dict[str, int] = {}
+        for r in records:
+            status[str(r["status"])] = status.get(str(r["status"]), 0) + 1
+        good = [r for r in records if ok(r)]
+        out = dict(step)
+        out.update({
+            "completed": len(records),
+            "seconds": round(wall, 3),
+            "throughput": round(len(good) / wall, 2) if wall else None,
+            "error_rate": round(1 - len(good) / len(records), 4) if records else None,
+            "status": status,
+            "latency_ms": percentiles([r["seconds"] for r in good]),
+            "endpoints": {},
+        })
+        for ep in ENDPOINTS:
+            mine = [r for r in records if r["endpoint"] == ep]
+            if mine:
+                errors = [r for r in mine if not ok(r)]
+                out["endpoints"][ep] = {"count": len(mine), "errors": len(errors),
+                                        "latency_ms": percentiles([r["seconds"] for r in mine if ok(r)])}
+                if errors:
+                    out["endpoints"][ep]["first_error"] = errors[0].get("error")
+        return out
+
+
+@contextmanager
+def local_app(latency: float = 0.05, fail_rate: float = 0.0) -> Iterator[str]:
+    """
+    Serve app.py on an ephemeral port in this process, wired to bench.py's fake
+    upstreams and a throwaway state directory; yields the base URL.
+    """
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    with Suite(latency=latency, fail_rate=fail_rate):
+        import app
+        server = make_server("127.0.0.1", 0, app.app, threaded=True, request_handler=QuietHandler)
+        thread = threading.Thread(target=server.serve_forever, name="loadgen-app", daemon=True)
+        thread.start()
+        try:
+            yield f"http://127.0.0.1:{server.server_port}"
+        finally:
+            server.shutdown()
+
+
+def curve_table(steps: List[Dict[str, Any]]) -> str:
+    """
+    The throughput vs. latency curve as a text table, one row per step.
+    """
+    rows = [f"{'step':>10} {'done':>6} {'ok/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}"]
+    for s in steps:
+        label = f"c={s['concurrency']}" if s["mode"] == "closed" else f"{s['rate']}/s"
+        lat = s["latency_ms"]
+        rows.append(f"{label:>10} {s['completed']:>6} {s['throughput'] or 0:>8} {lat.get('p50', '-'):>9} "
+                    f"{lat.get('p95', '-'):>9} {lat.get('p99', '-'):>9} {(s['error_rate'] or 0) * 100:>6.1f}%")
+    return "\n".join(rows)
+
+
+def run_steps(replay: Replay, mode: str, levels: List[float], duration: float, **kwargs) -> List[Dict[str, Any]]:
+    steps = []
+    for level in levels:
+        if mode == "closed":
+            step = replay.closed_loop(int(level), duration, kwargs.get("max_requests"), kwargs.get("think", 0.0))
+        else:
+            step = replay.open_loop(level, duration, kwargs.get("max_inflight", 64))
+        print(curve_table([step]).splitlines()[-1], file=sys.stderr)
+        steps.append(step)
+    return steps
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay a JSONL query log against app.py and report throughput vs. latency")
+    parser.add_argument("--log", default="requests.jsonl", help="JSONL query log to replay.")
+    parser.add_argument("--url", help="Base URL of a running app (e.g. http://127.0.0.1:5000).")
+    parser.add_argument("--local", action="store_true", help="Serve the app in-process against bench.py's fake upstreams.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake upstream latency (--local).")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fake upstream failure rate (--local).")
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="Closed-loop client counts, one step each.")
+    parser.add_argument("--rate", default="1,2,5,10", help="Open-loop arrival rates (requests/s), one step each.")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per step.")
+    parser.add_argument("--requests", type=int, help="Closed loop: stop a step after this many requests.")
+    parser.add_argument("--think", type=float, default=0.0, help="Closed loop: pause between a client's requests.")
+    parser.add_argument("--max-inflight", type=int, default=64, help="Open loop: cap on concurrent requests.")
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--limit", type=int, help="Replay only the first N log lines.")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--out", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+
+    if bool(args.url) == args.local:
+        parser.error("pass exactly one of --url or --local")
+    queries = load_queries(args.log, args.limit)
+    levels = [float(x) for x in (args.concurrency if args.mode == "closed" else args.rate).split(",") if x.strip()]
+
+    def replay_against(url: str) -> List[Dict[str, Any]]:
+        replay = Replay(url, queries, parse_mix(args.mix), args.users, args.timeout, args.seed)
+        print(curve_table([]), file=sys.stderr)
+        return run_steps(replay, args.mode, levels, args.duration, max_requests=args.requests,
+                         think=args.think, max_inflight=args.max_inflight)
+
+    if args.local:
+        with local_app(args.latency, args.fail_rate) as url:
+            steps = replay_against(url)
+    else:
+        steps = replay_against(args.url)
+
+    report = {
+        "meta": _meta(),
+        "config": {"log": args.log, "queries": len(queries), "target": args.url or "local", "mode": args.mode,
+                   "duration": args.duration, "mix": parse_mix(args.mix), "users": args.users},
+        "steps": steps,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,193 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+from budget import estimate_tokens, truncate_tokens
+from store import SessionStore
+
+MEMORY_TURNS = int(os.getenv("MEMORY_TURNS", "3"))                       # newest turns kept verbatim
+MEMORY_TURN_TOKENS = int(os.getenv("MEMORY_TURN_TOKENS", "160"))         # cap per verbatim turn
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "300"))   # hard cap for the rolling summary
+MEMORY_FOLD_BATCH = int(os.getenv("MEMORY_FOLD_BATCH", "3"))             # fold once this many turns left the window
+MEMORY_FOLD_MAX = 12                                                     # turns per summarization call
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def _turn_text(entry: Dict[str, Any], max_tokens: int = MEMORY_TURN_TOKENS) -> str:
+    q = truncate_tokens(entry.get("query") or "", max_tokens // 4)
+    a = truncate_tokens(entry.get("summary") or "", max_tokens - estimate_tokens(q))
+    return f"Q: {q}\nA: {a}"
+
+
+def _keep_tail(text: str, max_tokens: int) -> str:
+    # drop the oldest sentences first
+    sentences = _SENTENCE_RE.split(text.strip())
+    while len(sentences) > 1 and estimate_tokens(" ".join(sentences)) > max_tokens:
+        sentences.pop(0)
+    return truncate_tokens(" ".join(sentences), max_tokens)
+
+
+def _llm_fold(summary: str, turns: str, max_tokens: int) -> str:
+    from LLM import call_llama
+    prompt = (
+        "You maintain a running summary of a research conversation. Merge the new turns "
+        "into the summary: keep the topics, facts, decisions and open questions, drop filler. "
+        f"Use at most {int(max_tokens * 0.7)} words.\n\n"
+        f"Current summary:\n{summary or '(empty)'}\n\nNew turns:\n{turns}\n\nUpdated summary:"
+    )
+    return call_llama(prompt, max_tokens=max_tokens, temperature=0.1)
+
+
+def _extractive_fold(summary: str, turns: List[Dict[str, Any]], max_tokens: int) -> str:
+    # used when the LLM is unavailable: question plus first sentence of each answer
+    parts = [summary] if summary else []
+    for e in turns:
+        answer = _SENTENCE_RE.split((e.get("summary") or "").strip())[0]
+        parts.append(f"Asked: {e.get('query', '')} - {answer}")
+    return _keep_tail(" ".join(parts), max_tokens)
+
+
+class ConversationMemory:
+    """
+    Per-session memory for prompts: the newest `turns` entries verbatim plus a
+    rolling summary of everything older, capped at `summary_tokens`, so the context
+    stays the same size however long a session runs.
+
+    Older turns are folded into the summary off the request path: note() queues the
+    session on a background worker once `fold_batch` turns have left the verbatim
+    window. The summary, how many entries it covers and where the last of them
+    starts in the log are kept in a sidecar file next to the session log
+    (<session>.memory.json), so a fold reads only the entries after that point.
+    """
+
+    def __init__(
+        self,
+        store: SessionStore,
+        turns: int = MEMORY_TURNS,
+        summary_tokens: int = MEMORY_SUMMARY_TOKENS,
+        fold_batch: int = MEMORY_FOLD_BATCH,
+        fold: Optional[Callable[[str, str, int], str]] = None
+    ):
+        self.store = store
+        self.turns = turns
+        self.summary_tokens = summary_tokens
+        self.fold_batch = max(1, fold_batch)
+        self._fold_fn = fold or _llm_fold
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+
+    def _state(self, session_id: str) -> Dict[str, Any]:
+        state = self.store.load_sidecar(session_id, "memory") or {}
+        return {
+            "summary": state.get("summary", ""),
+            "folded": int(state.get("folded", 0)),
+            "through": state.get("through", ""),
+            "offset": state.get("offset"),
+        }
+
+    def _unfolded(
+        self,
+        session_id: str,
+        state: Dict[str, Any],
+        limit: Optional[int] = None
+    ) -> Tuple[List[Tuple[int, Dict[str, Any]]], bool]:
+        """
+        (offset, entry) for the entries after the last folded one (at most the newest
+        `limit`), oldest first, read backwards from the end of the log. The boundary
+        is the folded entry's offset, checked against its timestamp; if the log was
+        rewritten since, the timestamp alone. The flag is False if no boundary was
+        found (the log no longer holds the folded entries), in which case every entry
+        is returned.
+        """
+        out: List[Tuple[int, Dict[str, Any]]] = []
+        mark, through = state["offset"], state["through"]
+        for offset, entry in self.store.iter_reverse(session_id):
+            if limit is not None and len(out) >= limit:
+                return out[::-1], True
+            ts = entry.get("timestamp") or ""
+            if mark is not None and offset <= mark:
+                if offset == mark and ts == through:
+                    return out[::-1], True
+                mark = None
+            if mark is None and through and ts <= through:
+                return out[::-1], True
+            out.append((offset, entry))
+        return out[::-1], not through
+
+    def context(self, session_id: str) -> str:
+        """
+        Prompt context for the next request: rolling summary + the turns after it
+        (the last `turns`, plus up to fold_batch - 1 waiting to be folded).
+        Reads the sidecar and the log tail only. The turns are the ones after the
+        last folded entry's log offset: log order is not timestamp order (run_many
+        appends in submission order).
+        """
+        state = self._state(session_id)
+        parts: List[str] = []
+        if state["summary"]:
+            parts.append(f"Summary of the earlier conversation: {state['summary']}")
+        unfolded, _ = self._unfolded(session_id, state, limit=self.turns + self.fold_batch - 1)
+        recent = [e for _, e in unfolded] or self.store.tail(session_id, self.turns)
+        if recent:
+            parts.append("Recent turns:\n" + "\n\n".join(_turn_text(e) for e in recent))
+        return "\n\n".join(parts)
+
+    def note(self, session_id: str):
+        """
+        Call after appending an entry; schedules a fold if one is due.
+        """
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._pool.submit(self._fold_pending, session_id)
+
+    def _fold_pending(self, session_id: str):
+        try:
+            self.fold(session_id)
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._pending.discard(session_id)
+
+    def fold(self, session_id: str, force: bool = False) -> bool:
+        """
+        Fold turns that left the verbatim window into the rolling summary.
+        Returns True if the summary changed.
+        """
+        state = self._state(session_id)
+        unfolded, found = self._unfolded(session_id, state)
+        if not found:
+            # log was rewritten without the folded turns (restore/replace): start over
+            state = {"summary": "", "folded": 0, "through": "", "offset": None}
+        upto = max(0, len(unfolded) - self.turns)
+        if upto < (1 if force else self.fold_batch):
+            return False
+        with metrics.span("memory.fold"):
+            summary = state["summary"]
+            for start in range(0, upto, MEMORY_FOLD_MAX):
+                batch = [e for _, e in unfolded[start:min(upto, start + MEMORY_FOLD_MAX)]]
+                turns = "\n\n".join(_turn_text(e) for e in batch)
+                try:
+                    merged = self._fold_fn(summary, turns, self.summary_tokens).strip()
+                except Exception:
+                    merged = ""
+                summary = merged or _extractive_fold(summary, batch, self.summary_tokens)
+                summary = truncate_tokens(summary, self.summary_tokens)
+        offset, last = unfolded[upto - 1]
+        self.store.save_sidecar(session_id, "memory", {
+            "summary": summary,
+            "folded": state["folded"] + upto,
+            # timestamp and log offset of the last folded entry; newer ones are still shown verbatim
+            "through": last.get("timestamp") or "",
+            "offset": offset,
+            "updated": datetime.utcnow().isoformat() + "Z",
+        })
+        return True
@@ -0,0 +1,203 @@
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels(key: LabelKey, extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """
+    Monotonic counter with optional labels (Prometheus "counter").
+    """
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(f"{self.name}{_labels(k)} {_fmt(v)}" for k, v in items)
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative-bucket latency histogram with optional labels (Prometheus "histogram").
+    """
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values: Dict[LabelKey, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                # bucket counts, then sum and count
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, row in items:
+            for bound, count in zip(self.buckets, row):
+                le = 'le="%s"' % _fmt(bound)
+                lines.append(f"{self.name}_bucket{_labels(key, le)} {_fmt(count)}")
+            lines.append(f"{self.name}_sum{_labels(key)} {row[-2]!r}")
+            lines.append(f"{self.name}_count{_labels(key)} {_fmt(row[-1])}")
+        return lines
+
+
+class _Gauges:
+    """
+    Gauges read from a callback at scrape time, e.g. cache statistics.
+    fn returns {label value: number}.
+    """
+
+    def __init__(self, name: str, help: str, label: str, fn: Callable[[], Dict[str, float]]):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.fn()
+        except Exception:
+            return lines
+        lines.extend(f'{self.name}{{{self.label}="{_escape(str(k))}"}} {_fmt(v)}' for k, v in sorted(values.items()))
+        return lines
+
+
+_REGISTRY: Dict[str, object] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def counter(name: str, help: str) -> Counter:
+    with _REGISTRY_LOCK:
+        return _REGISTRY.setdefault(name, Counter(name, help))
+
+
+def histogram(name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    with _REGISTRY_LOCK:
+        return _REGISTRY.setdefault(name, Histogram(name, help, buckets))
+
+
+def gauges(name: str, help: str, label: str, fn: Callable[[], Dict[str, float]]):
+    with _REGISTRY_LOCK:
+        _REGISTRY[name] = _Gauges(name, help, label, fn)
+
+
+def render() -> str:
+    """
+    Everything registered, in the Prometheus text exposition format (0.0.4).
+    """
+    with _REGISTRY_LOCK:
+        metrics = [_REGISTRY[name] for name in sorted(_REGISTRY)]
+    lines: List[str] = []
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+SPAN_SECONDS = histogram("research_span_seconds", "Time spent in each pipeline step.")
+SPAN_ERRORS = counter("research_span_errors_total", "Pipeline steps that raised.")
+
+_trace: ContextVar[Optional[List[Dict[str, object]]]] = ContextVar("research_trace", default=None)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Time a pipeline step into research_span_seconds{span=name}, and into the
+    current trace() if there is one.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        SPAN_ERRORS.inc(span=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        SPAN_SECONDS.observe(elapsed, span=name)
+        spans = _trace.get()
+        if spans is not None:
+            spans.append({"span": name, "ms": round(elapsed * 1000, 2)})
+
+
+def timed(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Decorator form of span() for plain and async functions.
+    """
+    def wrap(fn: Callable[..., Any]) -> Callable[..., Any]:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def arun(*args: Any, **kwargs: Any) -> Any:
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return arun
+
+        @functools.wraps(fn)
+        def run(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return fn(*args, **kwargs)
+        return run
+    return wrap
+
+
+@contextmanager
+def trace() -> Iterator[List[Dict[str, object]]]:
+    """
+    Collect the spans finished inside the block (this thread/task and anything run
+    via contextvars.copy_context()) as [{"span": name, "ms": ...}], in finish order.
+    """
+    spans: List[Dict[str, object]] = []
+    token = _trace.set(spans)
+    try:
+        yield spans
+    finally:
+        _trace.reset(token)
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+USER_AGENT = "AI-Research-Assistant/1.0 (+https://github.com/Moin9054/AI-Research-Assistant)"
+
+UPSTREAM_SECONDS = metrics.histogram("upstream_request_seconds", "Outbound HTTP attempts by upstream (time to response headers).")
+UPSTREAM_REQUESTS = metrics.counter("upstream_requests_total", "Outbound HTTP attempts by upstream and status ('error' for connection failures/timeouts).")
+UPSTREAM_RETRIES = metrics.counter("upstream_retries_total", "Outbound HTTP retries by upstream.")
+
+
+class Upstream:
+    """
+    Connection pool and retry policy for one upstream host.
+
+    Every setting can be overridden from the environment with the upstream's name as
+    prefix, e.g. OPENROUTER_READ_TIMEOUT=60, DDG_RETRIES=0, WIKIPEDIA_POOL_SIZE=4.
+    A server's Retry-After is always waited out in full; when it is longer than
+    retry_after_max (or the caller's deadline) the response is returned instead.
+    pool_hosts is how many hosts keep their own keep-alive pool (an upstream name
+    can cover several, e.g. the LLM endpoints); with fewer, hosts evict each other.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 30.0,
+        pool_size: int = 10,
+        pool_hosts: int = 1,
+        retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        retry_after_max: float = 120.0
+    ):
+        prefix = name.upper()
+        self.name = name
+        self.connect_timeout = float(os.getenv(f"{prefix}_CONNECT_TIMEOUT", connect_timeout))
+        self.read_timeout = float(os.getenv(f"{prefix}_READ_TIMEOUT", read_timeout))
+        self.pool_size = int(os.getenv(f"{prefix}_POOL_SIZE", pool_size))
+        self.pool_hosts = max(1, int(os.getenv(f"{prefix}_POOL_HOSTS", pool_hosts)))
+        self.async_pool_size = int(os.getenv(f"{prefix}_ASYNC_POOL_SIZE", 100))
+        self.retries = int(os.getenv(f"{prefix}_RETRIES", retries))
+        self.backoff_base = float(os.getenv(f"{prefix}_BACKOFF_BASE", backoff_base))
+        self.backoff_max = float(os.getenv(f"{prefix}_BACKOFF_MAX", backoff_max))
+        self.retry_after_max = float(os.getenv(f"{prefix}_RETRY_AFTER_MAX", retry_after_max))
+        self._session: Optional[requests.Session] = None
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_hosts, pool_maxsize=self.pool_size, pool_block=False)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                s.headers["User-Agent"] = USER_AGENT
+                self._session = s
+            return self._session
+
+    def async_client(self):
+        """
+        httpx.AsyncClient for the running event loop (clients can't be shared across loops).
+        """
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError("The async path requires the 'httpx' package. Install with: pip install httpx")
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None or client.is_closed:
+                limits = httpx.Limits(max_connections=self.async_pool_size, max_keepalive_connections=self.pool_size * self.pool_hosts)
+                client = httpx.AsyncClient(limits=limits, headers={"User-Agent": USER_AGENT})
+                self._async_clients[loop] = client
+            return client
+
+    def backoff(self, attempt: int, resp: Optional[Any] = None) -> float:
+        """
+        Delay before retry number attempt+1: Retry-After as sent if the server sent
+        one, otherwise exponential backoff with full jitter.
+        """
+        if resp is not None:
+            after = _retry_after(resp.headers.get("Retry-After"))
+            if after is not None:
+                return after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def _observe(name: str, started: float, status: Any):
+    UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream=name)
+    UPSTREAM_REQUESTS.inc(upstream=name, status=str(status))
+
+
+def _llm_hosts() -> int:
+    """
+    Distinct hosts in LLM_ENDPOINTS ("model" or "model@url" entries, see
+    llm_pool.EndpointPool.from_env); entries without a URL share the default one.
+    """
+    items = [item.strip() for item in os.getenv("LLM_ENDPOINTS", "").split(",") if item.strip()]
+    return max(1, len({urlsplit(item.partition("@")[2].strip()).netloc for item in items}))
+
+
+UPSTREAMS: Dict[str, Upstream] = {
+    "openrouter": Upstream("openrouter", read_timeout=30.0, pool_hosts=_llm_hosts()),
+    "ddg": Upstream("ddg", read_timeout=8.0),
+    "wikipedia": Upstream("wikipedia", read_timeout=8.0),
+}
+
+
+def upstream(name: str) -> Upstream:
+    up = UPSTREAMS.get(name)
+    if up is None:
+        up = UPSTREAMS.setdefault(name, Upstream(name))
+    return up
+
+
+def request(
+    name: str,
+    method: str,
+    url: str,
+    timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+    retries: Optional[int] = None,
+    **kwargs: Any
+) -> requests.Response:
+    """
+    Send a request through the named upstream's pooled session, retrying connection
+    errors, timeouts and 429/5xx responses. `timeout` overrides the read timeout;
+    `deadline` (time.monotonic() value) stops retries that could not finish in time;
+    `retries` overrides the upstream's retry count.
+    The last response is returned as-is (callers decide whether to raise_for_status).
+    """
+    up = upstream(name)
+    read_timeout = up.read_timeout if timeout is None else timeout
+    max_retries = up.retries if retries is None else retries
+    attempt = 0
+    while True:
+        timeouts: Tuple[float, float] = (up.connect_timeout, read_timeout)
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            timeouts = (max(0.05, min(up.connect_timeout, left)), max(0.05, min(read_timeout, left)))
+        resp = None
+        started = time.perf_counter()
+        try:
+            resp = up.session.request(method, url, timeout=timeouts, **kwargs)
+            _observe(name, started, resp.status_code)
+            if resp.status_code not in RETRY_STATUSES:
+                return resp
+        except (requests.ConnectionError, requests.Timeout):
+            _observe(name, started, "error")
+            if attempt >= max_retries:
+                raise
+        if attempt >= max_retries:
+            return resp
+        delay = up.backoff(attempt, resp)
+        if delay > up.retry_after_max or (deadline is not None and time.monotonic() + delay >= deadline):
+            if resp is not None:
+                return resp
+            raise requests.Timeout(f"{name}: retry budget exhausted")
+        if resp is not None:
+            resp.close()
+        UPSTREAM_RETRIES.inc(upstream=name)
+        time.sleep(delay)
+        attempt += 1
+
+
+async def arequest(
+    name: str,
+    method: str,
+    url: str,
+    timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+    retries: Optional[int] = None,
+    **kwargs: Any
+):
+    """
+    Async counterpart of request() on a pooled httpx.AsyncClient, with the same
+    retry/backoff policy. Returns an httpx.Response.
+    """
+    import httpx
+
+    up = upstream(name)
+    client = up.async_client()
+    read_timeout = up.read_timeout if timeout is None else timeout
+    max_retries = up.retries if retries is None else retries
+    attempt = 0
+    while True:
+        connect = up.connect_timeout
+        read = read_timeout
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            connect, read = max(0.05, min(connect, left)), max(0.05, min(read, left))
+        resp = None
+        started = time.perf_counter()
+        try:
+            resp = await client.request(method, url, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+            _observe(name, started, resp.status_code)
+            if resp.status_code not in RETRY_STATUSES:
+                return resp
+        except (httpx.TransportError, httpx.TimeoutException):
+            _observe(name, started, "error")
+            if attempt >= max_retries:
+                raise
+        if attempt >= max_retries:
+            return resp
+        delay = up.backoff(attempt, resp)
+        if delay > up.retry_after_max or (deadline is not None and time.monotonic() + delay >= deadline):
+            if resp is not None:
+                return resp
+            raise httpx.TimeoutException(f"{name}: retry budget exhausted")
+        UPSTREAM_RETRIES.inc(upstream=name)
+        await asyncio.sleep(delay)
+        attempt += 1
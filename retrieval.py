@@ -0,0 +1,242 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+INDEX_FILE = ".knowledge_index.json"
+INDEX_VERSION = 2
+PASSAGE_CHARS = 800
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"\w+")
+_PARA_RE = re.compile(r"\S.*?(?=\n\s*\n|\Z)", re.S)
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def split_passages(text: str, max_chars: int = PASSAGE_CHARS) -> List[Tuple[int, int]]:
+    """
+    Split text into (start, end) character spans of at most max_chars.
+    Paragraphs are kept whole where possible, short neighbours are merged and
+    long ones are cut at whitespace.
+    """
+    spans: List[Tuple[int, int]] = []
+    for m in _PARA_RE.finditer(text):
+        start = m.start()
+        end = start + len(m.group().rstrip())
+        while end - start > max_chars:
+            cut = text.rfind(" ", start + 1, start + max_chars)
+            if cut <= start:
+                cut = start + max_chars
+            spans.append((start, cut))
+            start = cut
+            while start < end and text[start].isspace():
+                start += 1
+        if start < end:
+            spans.append((start, end))
+
+    merged: List[Tuple[int, int]] = []
+    for start, end in spans:
+        if merged and end - merged[-1][0] <= max_chars:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class KnowledgeIndex:
+    """
+    Persistent BM25 inverted index over passages of the .txt files in a knowledge folder.
+
+    postings: term -> {passage id: term frequency}
+    passages: passage id -> {"file", "start", "end", "length", "text"}
+    files:    file name -> {"mtime", "size", "passages"}
+
+    The index is loaded from disk once, then refreshed incrementally: only files whose
+    mtime/size changed since the last scan are re-read and re-tokenized.
+    """
+
+    def __init__(self, docs_folder: str = "knowledge", index_file: Optional[str] = None, refresh_interval: float = 5.0):
+        self.docs_folder = docs_folder
+        self.index_file = index_file or os.path.join(docs_folder, INDEX_FILE)
+        self.refresh_interval = refresh_interval
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.passages: Dict[str, Dict[str, Any]] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.total_length = 0
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._last_refresh = 0.0
+        self._load()
+        self.refresh()
+
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return
+        if data.get("version") != INDEX_VERSION:
+            return
+        self.files = data.get("files", {})
+        self.passages = data.get("passages", {})
+        self.postings = data.get("postings", {})
+        self.total_length = sum(p["length"] for p in self.passages.values())
+
+    def _save(self):
+        data = {
+            "version": INDEX_VERSION,
+            "files": self.files,
+            "passages": self.passages,
+            "postings": self.postings,
+        }
+        # unique per writer, so workers saving at the same time never share a tmp file
+        tmp = f"{self.index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.index_file)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _unindex(self, fname: str):
+        meta = self.files.pop(fname, None)
+        if not meta:
+            return
+        for pid in meta.get("passages", []):
+            passage = self.passages.pop(pid, None)
+            if not passage:
+                continue
+            self.total_length -= passage["length"]
+            for term in set(tokenize(passage["text"])):
+                plist = self.postings.get(term)
+                if plist is None:
+                    continue
+                plist.pop(pid, None)
+                if not plist:
+                    del self.postings[term]
+
+    def _index(self, fname: str, stat: os.stat_result):
+        path = os.path.join(self.docs_folder, fname)
+        try:
+            with open(path, "r", encoding="utf-8", errors="ignore") as fh:
+                text = fh.read()
+        except Exception:
+            text = ""
+        pids: List[str] = []
+        for n, (start, end) in enumerate(split_passages(text)):
+            pid = f"{fname}#{n}"
+            chunk = text[start:end]
+            tokens = tokenize(chunk)
+            if not tokens:
+                continue
+            for term, tf in Counter(tokens).items():
+                self.postings.setdefault(term, {})[pid] = tf
+            self.passages[pid] = {"file": fname, "start": start, "end": end, "length": len(tokens), "text": chunk}
+            self.total_length += len(tokens)
+            pids.append(pid)
+        self.files[fname] = {"mtime": stat.st_mtime, "size": stat.st_size, "passages": pids}
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Re-index files that were added, changed or removed since the last scan.
+        Scans at most once per refresh_interval unless force=True. Returns True if the index changed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_refresh and now - self._last_refresh < self.refresh_interval:
+                return False
+            self._last_refresh = now
+
+            seen: Dict[str, os.stat_result] = {}
+            if os.path.isdir(self.docs_folder):
+                for entry in os.scandir(self.docs_folder):
+                    if entry.is_file() and entry.name.lower().endswith(".txt"):
+                        seen[entry.name] = entry.stat()
+
+            changed = False
+            for fname in [f for f in self.files if f not in seen]:
+                self._unindex(fname)
+                changed = True
+            for fname, stat in seen.items():
+                meta = self.files.get(fname)
+                if meta and meta.get("mtime") == stat.st_mtime and meta.get("size") == stat.st_size:
+                    continue
+                self._unindex(fname)
+                self._index(fname, stat)
+                changed = True
+
+            if changed:
+                self.generation += 1
+                try:
+                    self._save()
+                except Exception:
+                    pass
+            return changed
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[float, str]]:
+        """
+        Rank passages with BM25, touching only the postings of the query terms.
+        Returns [(score, passage id)] best first.
+        """
+        self.refresh()
+        scores: Dict[str, float] = {}
+        with self._lock:
+            n = len(self.passages)
+            if not n:
+                return []
+            avgdl = self.total_length / n
+            for term in set(tokenize(query)):
+                plist = self.postings.get(term)
+                if not plist:
+                    continue
+                idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+                for pid, tf in plist.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.passages[pid]["length"] / avgdl)
+                    scores[pid] = scores.get(pid, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(((s, pid) for pid, s in scores.items()), reverse=True)
+        return ranked[:k]
+
+    def passage(self, pid: str) -> Dict[str, Any]:
+        """
+        Return a passage in the retriever's doc shape, with its source file and offsets.
+        """
+        with self._lock:
+            p = self.passages.get(pid)
+        if not p:
+            return {}
+        return {
+            "id": f"{p['file']}#{p['start']}-{p['end']}",
+            "title": p["file"],
+            "text": p["text"],
+            "source": p["file"],
+            "start": p["start"],
+            "end": p["end"],
+        }
+
+
+_INDEXES: Dict[str, KnowledgeIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_index(docs_folder: str = "knowledge", index_file: Optional[str] = None) -> KnowledgeIndex:
+    """
+    Return the shared index for a folder, building or loading it on first use.
+    """
+    key = os.path.abspath(docs_folder)
+    with _INDEXES_LOCK:
+        idx = _INDEXES.get(key)
+        if idx is None:
+            idx = KnowledgeIndex(docs_folder, index_file=index_file)
+            _INDEXES[key] = idx
+        return idx
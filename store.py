@@ -0,0 +1,562 @@
+import errno
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+
+try:
+    import fcntl
+except ImportError:  # Windows: thread locks only, single worker process
+    fcntl = None
+
+STATE_DIR = os.getenv("STATE_DIR", "state")
+LEGACY_STATE_FILE = "state.json"
+FSYNC = os.getenv("STATE_FSYNC", "0") == "1"
+SHARDS = int(os.getenv("STATE_SHARDS", "64"))
+
+
+def _atomic_write(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _parse_lines(raw: bytes) -> List[Dict[str, Any]]:
+    out = []
+    for line in raw.split(b"\n"):
+        if not line.strip():
+            continue
+        try:
+            out.append(json.loads(line))
+        except ValueError:
+            continue  # torn write from a crash; dropped on the next compaction
+    return out
+
+
+class _SessionLock:
+    """
+    Re-entrant lock for one session: a thread lock for this process plus a POSIX
+    byte-range lock (one byte per session hash) on the shard's lock file for other
+    worker processes. Sessions never contend with each other, even within a shard.
+    """
+
+    def __init__(self, fd: Optional[int], offset: int):
+        self._fd = fd
+        self._offset = offset
+        self._rlock = threading.RLock()
+        self._depth = 0
+
+    def __enter__(self):
+        self._rlock.acquire()
+        self._depth += 1
+        if self._depth == 1 and self._fd is not None:
+            try:
+                self._lock_range()
+            except Exception:
+                self._depth -= 1
+                self._rlock.release()
+                raise
+        return self
+
+    def _lock_range(self):
+        # POSIX locks belong to the process, so threads waiting on different sessions
+        # can look like a lock cycle to the kernel; back off and retry on EDEADLK
+        delay = 0.001
+        while True:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._offset)
+                return
+            except OSError as e:
+                if e.errno != errno.EDEADLK:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        try:
+            if self._depth == 0 and self._fd is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._offset)
+        finally:
+            self._rlock.release()
+
+
+def _hash(session_id: str) -> int:
+    return zlib.crc32(session_id.encode("utf-8"))
+
+
+def _norm(name: str) -> str:
+    return (name or "").strip().lower()
+
+
+def _entry_name(entry: Optional[Dict[str, Any]]) -> str:
+    return ((entry or {}).get("user") or {}).get("name", "")
+
+
+class SessionStore:
+    """
+    Append-only session storage: one JSONL log per session, one history entry per line,
+    sharded into hash-bucket directories (state/sessions/<bucket>/<session>.jsonl).
+
+    Adding an entry is a single O_APPEND write, so a request no longer re-reads and
+    re-serializes every user's history. last_summary / user_name are taken from the
+    last entry, which is found by reading the log backwards from the end.
+    Logs with torn lines are rewritten atomically by a background compactor.
+
+    Every write and rewrite of a session holds that session's lock, so several threads
+    or worker processes can share one state directory without losing entries.
+
+    state/names.json maps each session to the normalized user name of its latest
+    entry, so lookups by name read only that user's sessions. It is updated when a
+    session's name changes and rebuilt from the logs if missing or stale.
+    """
+
+    def __init__(
+        self,
+        root: str = STATE_DIR,
+        legacy_file: Optional[str] = LEGACY_STATE_FILE,
+        compact_interval: float = 300.0,
+        shards: int = SHARDS
+    ):
+        self.root = root
+        self.shards = shards
+        self.sessions_dir = os.path.join(root, "sessions")
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._dirty: Set[str] = set()
+        self._shard_fds: Dict[str, Optional[int]] = {}
+        self._session_locks: Dict[str, _SessionLock] = {}
+        self.names_file = os.path.join(root, "names.json")
+        self._session_names: Dict[str, str] = {}
+        self._by_name: Dict[str, Set[str]] = {}
+        self._names_mtime: Optional[int] = None
+        with self.session_lock("\0migrate"):
+            self._migrate_flat()
+            if legacy_file:
+                self._migrate_legacy(legacy_file)
+        with self.session_lock("\0names"):
+            if not self._load_names() or set(self._session_names) != set(self.session_ids()):
+                self.rebuild_name_index()
+        if compact_interval:
+            t = threading.Thread(target=self._compactor, args=(compact_interval,), daemon=True)
+            t.start()
+
+    def _shard(self, session_id: str) -> str:
+        return "%02x" % (_hash(session_id) % self.shards)
+
+    def _path(self, session_id: str) -> str:
+        shard_dir = os.path.join(self.sessions_dir, self._shard(session_id))
+        return os.path.join(shard_dir, quote(session_id, safe="") + ".jsonl")
+
+    def _shard_fd(self, shard: str) -> Optional[int]:
+        # kept open for the process lifetime: closing any fd on a file drops the
+        # process's POSIX locks on it
+        fd = self._shard_fds.get(shard)
+        if fd is None and fcntl is not None:
+            shard_dir = os.path.join(self.sessions_dir, shard)
+            os.makedirs(shard_dir, exist_ok=True)
+            fd = os.open(os.path.join(shard_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            self._shard_fds[shard] = fd
+        return fd
+
+    def session_lock(self, session_id: str) -> _SessionLock:
+        """
+        Return the (re-entrant, cross-process) lock that serializes writes to a session.
+        """
+        with self._lock:
+            lock = self._session_locks.get(session_id)
+            if lock is None:
+                lock = _SessionLock(self._shard_fd(self._shard(session_id)), _hash(session_id) % 0x7FFFFFFF)
+                self._session_locks[session_id] = lock
+            return lock
+
+    def _migrate_flat(self):
+        """
+        Move logs from the unsharded layout (state/sessions/<session>.jsonl) into buckets.
+        """
+        for name in os.listdir(self.sessions_dir):
+            src = os.path.join(self.sessions_dir, name)
+            if name.endswith(".jsonl") and os.path.isfile(src):
+                dst = self._path(unquote(name[:-len(".jsonl")]))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(src, dst)
+
+    def _migrate_legacy(self, legacy_file: str):
+        """
+        Import a state.json written by older versions, once.
+        """
+        if not os.path.exists(legacy_file) or self.session_ids():
+            return
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except Exception:
+            return
+        self.replace_all(state)
+        os.replace(legacy_file, legacy_file + ".migrated")
+
+    def session_ids(self) -> List[str]:
+        out = []
+        try:
+            shards = os.listdir(self.sessions_dir)
+        except FileNotFoundError:
+            return []
+        for shard in shards:
+            shard_dir = os.path.join(self.sessions_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            out.extend(unquote(n[:-len(".jsonl")]) for n in os.listdir(shard_dir) if n.endswith(".jsonl"))
+        return out
+
+    def append_entry(self, session_id: str, entry: Dict[str, Any]):
+        data = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        path = self._path(session_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.session_lock(session_id), open(path, "a+b") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # previous writer died mid-line; keep this record on its own line
+                    data = b"\n" + data
+                    self._dirty.add(session_id)
+            f.write(data)
+            f.flush()
+            if FSYNC:
+                os.fsync(f.fileno())
+        self._index_name(session_id, _entry_name(entry))
+
+    def _read(self, session_id: str):
+        try:
+            with open(self._path(session_id), "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return [], False
+        entries = _parse_lines(raw)
+        torn = raw.count(b"\n") != len(entries) or (bool(raw) and not raw.endswith(b"\n"))
+        return entries, torn
+
+    def history(self, session_id: str) -> List[Dict[str, Any]]:
+        entries, torn = self._read(session_id)
+        if torn:
+            self._dirty.add(session_id)
+        return entries
+
+    def iter_entries(self, session_id: str) -> Iterator[Dict[str, Any]]:
+        """
+        Yield valid entries oldest first, reading the log line by line.
+        """
+        try:
+            f = open(self._path(session_id), "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def version(self, session_id: str) -> str:
+        """
+        Cheap change marker for a session log (size and mtime); "" if it doesn't exist.
+        """
+        try:
+            st = os.stat(self._path(session_id))
+        except FileNotFoundError:
+            return ""
+        return f"{st.st_size}-{st.st_mtime_ns}"
+
+    def iter_reverse(
+        self,
+        session_id: str,
+        end: Optional[int] = None,
+        block: int = 65536
+    ) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Yield (offset, entry) newest first, reading the log backwards in blocks.
+        offset is where the entry's line starts; pass it as `end` to resume below it.
+        """
+        try:
+            f = open(self._path(session_id), "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            pos = size if end is None else max(0, min(end, size))
+            buf = b""
+            while pos > 0:
+                step = min(block, pos)
+                pos -= step
+                f.seek(pos)
+                buf = f.read(step) + buf
+                # the first line may be cut off unless we reached the start of the file
+                cut = 0 if pos == 0 else buf.find(b"\n") + 1
+                if not cut and pos:
+                    continue
+                chunk, buf = buf[cut:], buf[:cut]
+                lines = []
+                offset = pos + cut
+                for line in chunk.split(b"\n"):
+                    lines.append((offset, line))
+                    offset += len(line) + 1
+                for offset, line in reversed(lines):
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    yield offset, entry
+
+    def tail(self, session_id: str, n: int, block: int = 8192) -> List[Dict[str, Any]]:
+        """
+        Return the newest n valid entries (oldest first) without reading the whole log.
+        """
+        if n <= 0:
+            return []
+        out = [entry for _, entry in itertools.islice(self.iter_reverse(session_id, block=block), n)]
+        return out[::-1]
+
+    def last_entry(self, session_id: str, block: int = 8192) -> Optional[Dict[str, Any]]:
+        """
+        Return the newest valid entry without reading the whole log.
+        """
+        entries = self.tail(session_id, 1, block)
+        return entries[0] if entries else None
+
+    def load_sidecar(self, session_id: str, kind: str) -> Optional[Dict[str, Any]]:
+        """
+        Read a JSON document kept next to the session log (e.g. derived memory).
+        """
+        try:
+            with open(self._path(session_id)[:-len(".jsonl")] + f".{kind}.json", "rb") as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_sidecar(self, session_id: str, kind: str, data: Dict[str, Any]):
+        path = self._path(session_id)[:-len(".jsonl")] + f".{kind}.json"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    def session_meta(self, session_id: str) -> Optional[Dict[str, str]]:
+        last = self.last_entry(session_id)
+        if last is None:
+            return None
+        return {
+            "last_summary": last.get("summary") or "",
+            "user_name": (last.get("user") or {}).get("name", ""),
+        }
+
+    def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Return a session in the legacy state.json shape, or None if it has no log.
+        """
+        history = self.history(session_id)
+        if not history and not os.path.exists(self._path(session_id)):
+            return None
+        last = history[-1] if history else {}
+        return {
+            "history": history,
+            "last_summary": last.get("summary") or "",
+            "user_name": (last.get("user") or {}).get("name", ""),
+        }
+
+    def load_all(self) -> Dict[str, Any]:
+        sessions = {}
+        for sid in self.session_ids():
+            session = self.get_session(sid)
+            if session is not None:
+                sessions[sid] = session
+        return {"sessions": sessions}
+
+    def replace_all(self, state: Dict[str, Any]):
+        """
+        Rewrite every session from a full state dict (legacy save_state path).
+        """
+        for sid, session in state.get("sessions", {}).items():
+            self.write_session(sid, session.get("history", []))
+
+    def write_session(self, session_id: str, history: List[Dict[str, Any]]):
+        data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in history).encode("utf-8")
+        path = self._path(session_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.session_lock(session_id):
+            _atomic_write(path, data)
+        self._index_name(session_id, _entry_name(history[-1] if history else None))
+
+    def _set_names(self, session_names: Dict[str, str]):
+        by_name: Dict[str, Set[str]] = {}
+        for sid, name in session_names.items():
+            by_name.setdefault(_norm(sid), set()).add(sid)
+            if name:
+                by_name.setdefault(name, set()).add(sid)
+        self._session_names = session_names
+        self._by_name = by_name
+
+    def _load_names(self) -> bool:
+        try:
+            mtime = os.stat(self.names_file).st_mtime_ns
+            with open(self.names_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self._set_names(data.get("sessions", {}))
+        self._names_mtime = mtime
+        return True
+
+    def _save_names(self):
+        data = json.dumps({"sessions": self._session_names}, ensure_ascii=False).encode("utf-8")
+        _atomic_write(self.names_file, data)
+        self._names_mtime = os.stat(self.names_file).st_mtime_ns
+
+    def _names_current(self):
+        # another worker process may have added sessions since we last loaded
+        try:
+            mtime = os.stat(self.names_file).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._names_mtime:
+            with self.session_lock("\0names"):
+                self._load_names()
+
+    def rebuild_name_index(self):
+        """
+        Recompute the name index from the tail of every session log.
+        """
+        with self.session_lock("\0names"):
+            self._set_names({sid: _norm(_entry_name(self.last_entry(sid))) for sid in self.session_ids()})
+            self._save_names()
+
+    def _index_name(self, session_id: str, user_name: str):
+        name = _norm(user_name)
+        if self._session_names.get(session_id) == name:
+            return
+        with self.session_lock("\0names"):
+            self._load_names()
+            if self._session_names.get(session_id) == name:
+                return
+            session_names = dict(self._session_names)
+            session_names[session_id] = name
+            self._set_names(session_names)
+            self._save_names()
+
+    def sessions_for_name(self, name: str) -> List[str]:
+        """
+        Return ids of sessions whose id or latest user name matches name (case-insensitive).
+        """
+        self._names_current()
+        return sorted(self._by_name.get(_norm(name), ()))
+
+    def compact(self, session_id: str, force: bool = False):
+        """
+        Rewrite a session log with only its valid lines, atomically.
+        """
+        with self.session_lock(session_id):
+            entries, torn = self._read(session_id)
+            if torn or force:
+                self.write_session(session_id, entries)
+
+    def compact_dirty(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for sid in dirty:
+            try:
+                self.compact(sid)
+            except Exception:
+                pass
+
+    def _compactor(self, interval: float):
+        while True:
+            time.sleep(interval)
+            self.compact_dirty()
+
+
+_STORES: Dict[str, SessionStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_store(root: str = STATE_DIR) -> SessionStore:
+    key = os.path.abspath(root)
+    with _STORES_LOCK:
+        store = _STORES.get(key)
+        if store is None:
+            store = SessionStore(root)
+            _STORES[key] = store
+        return store
+
+
+def _stress_worker(root: str, worker: int, threads: int, entries: int, sessions: int):
+    store = SessionStore(root, legacy_file=None, compact_interval=0)
+
+    def work(t: int):
+        for i in range(entries):
+            sid = f"user{(worker + t + i) % sessions}"
+            store.append_entry(sid, {"query": f"{worker}-{t}-{i}", "summary": "", "user": {"name": sid}})
+            if i % 10 == 0:
+                store.compact(sid, force=True)
+
+    pool = [threading.Thread(target=work, args=(t,)) for t in range(threads)]
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+
+
+def stress(root: str, procs: int = 4, threads: int = 4, entries: int = 200, sessions: int = 3) -> Dict[str, Any]:
+    """
+    Hammer one store from several processes and threads (appends mixed with forced
+    rewrites) and check that every entry survived exactly once.
+    """
+    import multiprocessing
+
+    start = time.perf_counter()
+    workers = [multiprocessing.Process(target=_stress_worker, args=(root, w, threads, entries, sessions)) for w in range(procs)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    store = SessionStore(root, legacy_file=None, compact_interval=0)
+    seen: List[str] = []
+    for sid in store.session_ids():
+        seen.extend(e["query"] for e in store.history(sid))
+    expected = procs * threads * entries
+    return {
+        "expected": expected,
+        "stored": len(seen),
+        "unique": len(set(seen)),
+        "lost": expected - len(set(seen)),
+        "seconds": round(elapsed, 3),
+        "appends_per_sec": round(expected / elapsed, 1) if elapsed else None,
+    }
+
+
+if __name__ == "__main__":
+    import argparse, sys, tempfile
+    parser = argparse.ArgumentParser(description="Session store tools")
+    parser.add_argument("--stress", action="store_true", help="Run a multi-process lost-update stress test.")
+    parser.add_argument("--root", default=None, help="State directory (default: a temp dir)")
+    parser.add_argument("--procs", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--entries", type=int, default=200)
+    parser.add_argument("--sessions", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.stress:
+        root = args.root or tempfile.mkdtemp(prefix="store-stress-")
+        out = stress(root, args.procs, args.threads, args.entries, args.sessions)
+        print(json.dumps(out, indent=2))
+        sys.exit(0 if out["lost"] == 0 and out["stored"] == out["expected"] else 1)
+    parser.print_help()
@@ -0,0 +1,361 @@
+import bz2
+import gzip
+import heapq
+import json
+import math
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+import zlib
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from retrieval import tokenize
+
+DUMP_VERSION = 1
+WIKI_DUMP_DIR = os.getenv("WIKI_DUMP_DIR", "")
+SPILL_ENTRIES = 2_000_000      # (hash, doc) pairs sorted in memory before spilling a run
+MAX_POSTINGS = 20_000          # at most this much of one postings list is walked per query
+PROBE_DF = 2_000               # terms more common than this are probed per candidate instead
+RERANK = 50
+
+# Layout of an ingested dump directory (all arrays in native byte order):
+#   abstracts.bin  title + b"\0" + abstract, UTF-8, back to back
+#   docs.bin       per doc two Q: offset, title bytes << 32 | abstract bytes
+#   titles.bin     sorted Q: crc32(normalized title) << 32 | doc
+#   terms.bin      sorted Q: crc32(term) << 32 | doc, one per distinct term per doc
+#   meta.json      counts, version, byte order
+_TITLE_PREFIX = "Wikipedia: "
+
+
+def _normalize_title(title: str) -> str:
+    return " ".join(title.replace("_", " ").split()).casefold()
+
+
+def _hash(text: str) -> int:
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def _open(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def iter_abstracts(path: str) -> Iterator[Tuple[str, str]]:
+    """
+    Stream (title, abstract) pairs from a dump, without loading it.
+    Accepts the Wikipedia abstracts XML dump (*-abstract.xml[.gz|.bz2]), JSON lines
+    with "title" and "abstract" (or "text"), or tab-separated "title<TAB>abstract" lines.
+    """
+    base = path[:-3] if path.endswith(".gz") else path[:-4] if path.endswith(".bz2") else path
+    with _open(path) as fh:
+        if base.endswith(".xml"):
+            root = None
+            for event, elem in ET.iterparse(fh, events=("start", "end")):
+                if root is None:
+                    root = elem
+                if event != "end" or elem.tag != "doc":
+                    continue
+                title = (elem.findtext("title") or "").strip()
+                if title.startswith(_TITLE_PREFIX):
+                    title = title[len(_TITLE_PREFIX):]
+                abstract = (elem.findtext("abstract") or "").strip()
+                if title and abstract:
+                    yield title, abstract
+                root.clear()
+            return
+        for raw in fh:
+            line = raw.decode("utf-8", "replace").rstrip("\n")
+            if not line.strip():
+                continue
+            if base.endswith((".jsonl", ".json")):
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                title, abstract = str(rec.get("title", "")), str(rec.get("abstract") or rec.get("text") or "")
+            else:
+                title, _, abstract = line.partition("\t")
+            title, abstract = title.strip(), abstract.strip()
+            if title and abstract:
+                yield title, abstract
+
+
+class _Spiller:
+    """
+    External sort of uint64 keys: sorted runs of SPILL_ENTRIES are written to temp
+    files and merged at the end, so memory stays bounded whatever the dump size.
+    """
+
+    def __init__(self, tmp: str, name: str, limit: int = SPILL_ENTRIES):
+        self.tmp = tmp
+        self.name = name
+        self.limit = limit
+        self.buf = array("Q")
+        self.runs: List[str] = []
+
+    def add(self, key: int):
+        self.buf.append(key)
+        if len(self.buf) >= self.limit:
+            self._spill()
+
+    def _spill(self):
+        if not self.buf:
+            return
+        path = os.path.join(self.tmp, f"{self.name}.{len(self.runs)}")
+        with open(path, "wb") as fh:
+            array("Q", sorted(self.buf)).tofile(fh)
+        self.runs.append(path)
+        self.buf = array("Q")
+
+    @staticmethod
+    def _read(path: str, block: int = 65536) -> Iterator[int]:
+        with open(path, "rb") as fh:
+            while True:
+                chunk = array("Q")
+                try:
+                    chunk.fromfile(fh, block)
+                except EOFError:
+                    pass
+                if not chunk:
+                    return
+                yield from chunk
+
+    def finish(self, out_path: str) -> int:
+        self._spill()
+        count = 0
+        out = array("Q")
+        with open(out_path, "wb") as fh:
+            for key in heapq.merge(*[self._read(p) for p in self.runs]):
+                out.append(key)
+                if len(out) >= 65536:
+                    out.tofile(fh)
+                    count += len(out)
+                    out = array("Q")
+            out.tofile(fh)
+            count += len(out)
+        for p in self.runs:
+            os.remove(p)
+        return count
+
+
+def ingest(source: str, out_dir: str, spill_entries: int = SPILL_ENTRIES, log_every: int = 0) -> Dict[str, int]:
+    """
+    Build a dump directory from `source` (see iter_abstracts). The new directory
+    replaces `out_dir` only once it is complete.
+    """
+    out_dir = os.path.abspath(out_dir)
+    parent = os.path.dirname(out_dir)
+    os.makedirs(parent, exist_ok=True)
+    build = tempfile.mkdtemp(prefix=".wikidump-", dir=parent)
+    try:
+        titles = _Spiller(build, "titles", spill_entries)
+        terms = _Spiller(build, "terms", spill_entries)
+        docs = array("Q")
+        n = 0
+        offset = 0
+        with open(os.path.join(build, "abstracts.bin"), "wb") as ab, open(os.path.join(build, "docs.bin"), "wb") as dh:
+            for title, abstract in iter_abstracts(source):
+                t, a = title.encode("utf-8"), abstract.encode("utf-8")
+                ab.write(t + b"\0" + a)
+                docs.append(offset)
+                docs.append(len(t) << 32 | len(a))
+                offset += len(t) + 1 + len(a)
+                titles.add(_hash(_normalize_title(title)) << 32 | n)
+                for term in set(tokenize(title + " " + abstract)):
+                    terms.add(_hash(term) << 32 | n)
+                n += 1
+                if len(docs) >= 65536:
+                    docs.tofile(dh)
+                    docs = array("Q")
+                if log_every and n % log_every == 0:
+                    print(f"{n} docs", file=sys.stderr)
+            docs.tofile(dh)
+        postings = terms.finish(os.path.join(build, "terms.bin"))
+        titles.finish(os.path.join(build, "titles.bin"))
+        meta = {"version": DUMP_VERSION, "docs": n, "postings": postings, "byteorder": sys.byteorder, "source": os.path.basename(source)}
+        with open(os.path.join(build, "meta.json"), "w", encoding="utf-8") as fh:
+            json.dump(meta, fh)
+
+        old = None
+        if os.path.exists(out_dir):
+            old = out_dir + ".old"
+            shutil.rmtree(old, ignore_errors=True)
+            os.replace(out_dir, old)
+        os.replace(build, out_dir)
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+        return {"docs": n, "postings": postings}
+    except BaseException:
+        shutil.rmtree(build, ignore_errors=True)
+        raise
+
+
+class WikiDump:
+    """
+    Read side of an ingested dump: memory-mapped arrays, nothing is loaded up front.
+    Lookups return docs shaped like graph._wiki_summary ("wiki:<title>").
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as fh:
+            self.meta = json.load(fh)
+        if self.meta.get("version") != DUMP_VERSION or self.meta.get("byteorder") != sys.byteorder:
+            raise RuntimeError(f"{path}: incompatible wiki dump, re-run ingestion")
+        self.size = int(self.meta["docs"])
+        self._files = []
+        self._abstracts = self._map("abstracts.bin")
+        self._docs = self._map("docs.bin", "Q")
+        self._titles = self._map("titles.bin", "Q")
+        self._terms = self._map("terms.bin", "Q")
+
+    def _map(self, name: str, fmt: Optional[str] = None):
+        fh = open(os.path.join(self.path, name), "rb")
+        self._files.append(fh)
+        if os.fstat(fh.fileno()).st_size == 0:
+            return memoryview(b"").cast(fmt) if fmt else b""
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mm).cast(fmt) if fmt else mm
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _range(self, arr, h: int) -> Tuple[int, int]:
+        lo = bisect_left(arr, h << 32)
+        hi = bisect_left(arr, (h + 1) << 32, lo)
+        return lo, hi
+
+    def title(self, doc: int) -> str:
+        offset, lengths = self._docs[2 * doc], self._docs[2 * doc + 1]
+        return self._abstracts[offset:offset + (lengths >> 32)].decode("utf-8")
+
+    def entry(self, doc: int) -> Tuple[str, str]:
+        offset, lengths = self._docs[2 * doc], self._docs[2 * doc + 1]
+        tlen, alen = lengths >> 32, lengths & 0xFFFFFFFF
+        raw = self._abstracts[offset:offset + tlen + 1 + alen]
+        return raw[:tlen].decode("utf-8"), raw[tlen + 1:].decode("utf-8")
+
+    def doc(self, doc: int) -> Dict[str, str]:
+        title, abstract = self.entry(doc)
+        return {"id": f"wiki:{title}", "title": f"Wikipedia: {title}", "text": abstract}
+
+    def lookup_title(self, title: str) -> Optional[int]:
+        norm = _normalize_title(title)
+        lo, hi = self._range(self._titles, _hash(norm))
+        for i in range(lo, hi):
+            doc = self._titles[i] & 0xFFFFFFFF
+            if _normalize_title(self.title(doc)) == norm:
+                return doc
+        return None
+
+    def search(self, query: str, k: int = 1) -> List[Tuple[float, int]]:
+        """
+        Exact title match first, then docs ranked by summed idf of matching query
+        terms; the top candidates are re-checked against their text (hash collisions)
+        and boosted by title overlap. Returns [(score, doc)].
+        """
+        exact = self.lookup_title(query)
+        terms = list(dict.fromkeys(tokenize(query)))
+        scores: Dict[int, float] = {}
+        if self.size:
+            # rarest terms first; once there are candidates, common terms are only
+            # probed for those docs instead of walking their whole postings list
+            ranges = sorted(((self._range(self._terms, _hash(t)), t) for t in terms), key=lambda x: x[0][1] - x[0][0])
+            for (lo, hi), term in ranges:
+                df = hi - lo
+                if not df:
+                    continue
+                idf = math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+                if scores and df > PROBE_DF:
+                    h = _hash(term) << 32
+                    for doc in scores:
+                        i = bisect_left(self._terms, h | doc, lo, hi)
+                        if i < hi and self._terms[i] == h | doc:
+                            scores[doc] += idf
+                    continue
+                for i in range(lo, min(hi, lo + MAX_POSTINGS)):
+                    doc = self._terms[i] & 0xFFFFFFFF
+                    scores[doc] = scores.get(doc, 0.0) + idf
+        candidates = heapq.nlargest(RERANK, scores.items(), key=lambda x: x[1])
+        ranked: List[Tuple[float, int]] = []
+        for doc, _ in candidates:
+            title, abstract = self.entry(doc)
+            title_tokens = set(tokenize(title))
+            words = title_tokens | set(tokenize(abstract))
+            matched = [t for t in terms if t in words]
+            if not matched:
+                continue
+            score = scores[doc] * len(matched) / len(terms)
+            score *= 1.0 + sum(1 for t in matched if t in title_tokens) / len(terms)
+            ranked.append((score, doc))
+        ranked.sort(key=lambda x: (-x[0], x[1]))
+        if exact is not None:
+            ranked = [(float("inf"), exact)] + [r for r in ranked if r[1] != exact]
+        return ranked[:k]
+
+    def lookup(self, query: str, k: int = 1) -> List[Dict[str, str]]:
+        return [self.doc(doc) for _, doc in self.search(query, k=k)]
+
+    def close(self):
+        for fh in self._files:
+            fh.close()
+
+
+_DUMPS: Dict[str, Tuple[Optional[Tuple[int, int]], Optional[WikiDump]]] = {}
+_DUMPS_LOCK = threading.Lock()
+
+
+def get_wiki_dump(path: str = WIKI_DUMP_DIR) -> Optional[WikiDump]:
+    """
+    Shared WikiDump for `path`, or None if no dump has been ingested there.
+    Reopened when meta.json appears or changes, so a dump ingested while the
+    process runs is picked up without a restart.
+    """
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    try:
+        st = os.stat(os.path.join(path, "meta.json"))
+        stamp: Optional[Tuple[int, int]] = (st.st_ino, st.st_mtime_ns)
+    except OSError:
+        stamp = None
+    with _DUMPS_LOCK:
+        cached = _DUMPS.get(path)
+        if cached is None or cached[0] != stamp:
+            # a replaced dump is left to the garbage collector: requests may still be reading its maps
+            _DUMPS[path] = cached = (stamp, WikiDump(path) if stamp else None)
+        return cached[1]
+
+
+if __name__ == "__main__":
+    import argparse, time
+    parser = argparse.ArgumentParser(description="Offline Wikipedia abstracts index")
+    parser.add_argument("--ingest", metavar="DUMP", help="Abstracts dump (.xml[.gz|.bz2]), .jsonl or title<TAB>abstract file")
+    parser.add_argument("--out", default=WIKI_DUMP_DIR or "wikidump", help="Index directory (default: $WIKI_DUMP_DIR or ./wikidump)")
+    parser.add_argument("--query", "-q", default=None, help="Look a query up in the index")
+    parser.add_argument("-k", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.ingest:
+        t = time.time()
+        out = ingest(args.ingest, args.out, log_every=100_000)
+        out["seconds"] = round(time.time() - t, 1)
+        print(json.dumps(out))
+    if args.query:
+        dump = get_wiki_dump(args.out)
+        if dump is None:
+            sys.exit(f"no index in {args.out}")
+        t = time.time()
+        docs = dump.lookup(args.query, k=args.k)
+        print(json.dumps({"ms": round((time.time() - t) * 1000, 2), "docs": docs}, indent=2, ensure_ascii=False))
+    if not args.ingest and not args.query:
+        parser.print_help()